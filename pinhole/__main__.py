@@ -1,8 +1,7 @@
 from pinhole.collector import collector_add_subparser_args
-from fastapi_cli.cli import main as fastapi_main
 
 from argparse import ArgumentParser, Namespace
-from os.path import realpath, join, dirname
+from os.path import realpath, join, dirname, isdir
 from os import environ
 from sys import argv
 
@@ -18,8 +17,10 @@ def parse_args() -> Namespace:
     apiserver.add_argument("project", type=str)
     apiserver.add_argument("--port", type=int, default=8801,
                            help="the listening port of the apiserver")
+    apiserver.add_argument("--workers", type=int, default=1,
+                           help="the number of apiserver processes, each with its own database connections")
     apiserver.add_argument("--dev", action='store_true',
-                           help='run as development mode in FastAPI')
+                           help='run as development mode, reloading on changes')
 
     ###########################################################################
     # APP Server Arguments
@@ -35,16 +36,27 @@ def parse_args() -> Namespace:
 
 
 def run_apiserver(args: Namespace) -> None:
-    api_server_path = join(dirname(realpath(argv[0])), "servers", "apiserver", "main.py")
-    argv.clear()
-    argv.extend([
-        "fastapi",
-        "dev" if args.dev else "run",
-        api_server_path,
-        "--port", args.port
-    ])
-    environ['PINHOLE_PROJECT'] = args.project
-    fastapi_main()
+    import uvicorn
+    from pinhole.project import Project
+
+    # the workers load the project on their own, so it is created beforehand
+    # rather than by each of them at the same time
+    project_path = realpath(args.project)
+    if not isdir(project_path):
+        Project.create(project_path).close()
+
+    environ['PINHOLE_PROJECT'] = project_path
+
+    # uvicorn picks uvloop and httptools when they are installed, and idle
+    # connections are kept long enough for the pooled clients to reuse them
+    uvicorn.run(
+        "pinhole.servers.apiserver.main:app",
+        host="127.0.0.1" if args.dev else "0.0.0.0",
+        port=args.port,
+        workers=1 if args.dev else max(args.workers, 1),
+        reload=args.dev,
+        timeout_keep_alive=30
+    )
 
 
 def run_appserver(args: Namespace) -> None:
@@ -7,13 +7,22 @@ from pinhole.project import RemoteProject
 from pinhole.models.deepseek import DeepSeekChatModel
 from pinhole.models.openai import OpenaiChatModel
 from pinhole.models.glm import GLMChatModel
-from pinhole.models.base import ChatContext, ChatModel
+from pinhole.models.base import ChatContext, ChatModel, Currency, Role
+from pinhole.models.batch import BatchClient
+from pinhole.models.hedging import HedgeBudget, Hedging
 from pinhole.models.profiler import Profiler
+from pinhole.models.cache import ResponseCache, SqliteResponseCache
+from pinhole.models.router import Router
+from pinhole.models.scheduler import Scheduler, Status, Task, TaskAbandoned
+from pinhole.models.summarizer import ChunkedSummarizer
+from pinhole.models.tokens import estimate_tokens, estimate_tokens_of_size
 
-from argparse import ArgumentParser, Namespace
+from argparse import ArgumentParser, ArgumentTypeError, Namespace
 from loguru import logger
-from typing import List, Union
+from typing import Any, Callable, Dict, Generic, Iterator, List, Tuple, TypeVar, Union
 from typing import Optional
+from os.path import expanduser, join
+from threading import Lock
 
 import requests
 
@@ -29,11 +38,33 @@ def collector_add_subparser_args(parser: ArgumentParser) -> None:
                         help="run the LLM-based summarization procedure")
     parser.add_argument("--crawling", action="store_true",
                         help="run the crawling spiders")
+    parser.add_argument("--deadline", type=float, default=None,
+                        help="stop starting new summarizations after the given number of minutes")
+    parser.add_argument("--publisher-weights", type=parse_weights, default="",
+                        help="prioritize publishers when summarizing, e.g. 'arxiv=2,lwn=0.5'. " +
+                             "newer items are summarized first and a weight of 2 halves the age of an item")
+    parser.add_argument("--hedge-budget", type=parse_budget, default="CNY=10,USD=1",
+                        help="the amount to spend per currency on requests hedging slow models, e.g. " +
+                             "'CNY=10,USD=1'. a request taking longer than usual is sent to the next model as well")
+    parser.add_argument("--response-cache", type=str,
+                        default=join(expanduser("~"), ".cache", "pinhole", "responses.db"),
+                        help="the database keeping model responses to reuse for identical requests, " +
+                             "'' disables the cache")
+    parser.add_argument("--batch", action="store_true",
+                        help="summarize through the batch API of OpenAI instead, at about half the price. " +
+                             "the answers of the batches submitted by earlier runs are stored first")
+    parser.add_argument("--batch-wait", type=float, default=0,
+                        help="the number of minutes to wait for the batches to complete, in batch mode")
+    parser.add_argument("--batch-dir", type=str, default=join(expanduser("~"), ".cache", "pinhole", "batches"),
+                        help="the directory keeping the state and the input files of the batches")
+    parser.add_argument("--usd-rate", type=float, default=7.2,
+                        help="the CNY value of a USD, to compare the costs of models priced in either")
 
 
 def crawler(args: Namespace) -> None:
     logger.info("crawler use following spiders")
     spider_instances: List[PinholeSpider] = []
+    known_urls = project.get_known_url_filter()
 
     if args.spider is not None:
         spider_names = {name.strip() for name in args.spider.split(',')}
@@ -47,6 +78,7 @@ def crawler(args: Namespace) -> None:
         spider_names.remove(spider.__name__)
         logger.info(f" - {spider.__name__}")
         spider_instance = spider()
+        spider_instance.set_known_urls(known_urls, project)
         spider_instance.start()
         spider_instances.append(spider_instance)
 
@@ -61,32 +93,200 @@ def crawler(args: Namespace) -> None:
     logger.info(f"{len(spider_instances)} spiders finished with {len(artifacts)} artifacts")
 
     nadded = 0
-    existing_urls = {dref.url for dref in project.get_document_refs()}
-    existing_urls.update({pref.url for pref in project.get_publication_refs()})
-
-    for artifact in artifacts:
-        if isinstance(artifact, Document) and artifact.url not in existing_urls:
-            try:
-                project.create_document(artifact)
-                nadded += 1
-            except Exception as ex:
-                logger.error(f"failed to create document at {artifact.url}: {ex}")
-        elif isinstance(artifact, Publication) and artifact.url not in existing_urls:
-            try:
-                project.create_publication(artifact)
-                nadded += 1
-            except Exception as ex:
-                logger.error(f"failed to create publication at {artifact.url}: {ex}")
+    exists = project.exists([artifact.url for artifact in artifacts])
+    documents = [a for a, e in zip(artifacts, exists) if isinstance(a, Document) and not e]
+    publications = [a for a, e in zip(artifacts, exists) if isinstance(a, Publication) and not e]
+
+    try:
+        ids = project.create_documents(documents)
+        nadded += sum(1 for id in ids if id >= 0)
+    except Exception as ex:
+        logger.error(f"failed to create {len(documents)} documents: {ex}")
+
+    try:
+        ids = project.create_publications(publications)
+        nadded += sum(1 for id in ids if id >= 0)
+    except Exception as ex:
+        logger.error(f"failed to create {len(publications)} publications: {ex}")
 
     logger.info(f"{nadded} new artifacts are added to the project")
 
 
+Ref = TypeVar("Ref", DocumentRef, PublicationRef)
+Item = TypeVar("Item", Document, Publication)
+
+
+def prefetch(refs: List[Ref], fetch: Callable[[List[int]], List[Optional[Item]]],
+             batch_size: int = 20) -> Iterator[Tuple[Ref, Optional[Item]]]:
+    """ Pairs each ref with its full item, fetching them `batch_size` at a time
+    as the iteration goes. """
+    for i in range(0, len(refs), batch_size):
+        batch = refs[i:i + batch_size]
+        yield from zip(batch, fetch([ref.id for ref in batch]))
+
+
+class Loader(Generic[Item]):
+    """ Loads items for the tasks that need them, fetching the whole batch of
+    `batch_size` ids an item belongs to on its first use. Items are neither
+    fetched one by one nor all held at once: each is kept until released. """
+
+    def __init__(self, ids: List[int], fetch: Callable[[List[int]], List[Optional[Item]]],
+                 batch_size: int = 20) -> None:
+        self.__fetch: Callable[[List[int]], List[Optional[Item]]] = fetch
+        self.__batch_of = {id: i // batch_size for i, id in enumerate(ids)}
+        self.__unfetched = {i // batch_size: ids[i:i + batch_size] for i in range(0, len(ids), batch_size)}
+        self.__items: Dict[int, Optional[Item]] = {}
+        self.__lock = Lock()
+
+    def load(self, item_id: int) -> Optional[Item]:
+        with self.__lock:
+            if item_id not in self.__items:
+                batch = self.__unfetched.pop(self.__batch_of[item_id], None) or [item_id]
+                self.__items.update(zip(batch, self.__fetch(batch)))
+
+            return self.__items[item_id]
+
+    def release(self, item_id: int) -> None:
+        with self.__lock:
+            self.__items.pop(item_id, None)
+
+
+def parse_amounts(text: str) -> Dict[str, float]:
+    """ Parses 'key=value,...' arguments. """
+    amounts: Dict[str, float] = {}
+    for item in filter(None, text.split(',')):
+        key, sep, value = item.partition('=')
+        if not sep or not key.strip():
+            raise ArgumentTypeError(f"expected 'key=value' pairs separated by ',', got '{item}'")
+
+        try:
+            amounts[key.strip()] = float(value)
+        except ValueError:
+            raise ArgumentTypeError(f"'{value}' is not a number in '{item}'")
+
+    return amounts
+
+
+def parse_weights(text: str) -> Dict[str, float]:
+    weights = parse_amounts(text)
+    for publisher, weight in weights.items():
+        if not weight > 0:
+            raise ArgumentTypeError(f"the weight of {publisher} must be positive, got {weight}")
+
+    return weights
+
+
+def parse_budget(text: str) -> Dict[Currency, float]:
+    budget: Dict[Currency, float] = {}
+    for currency, amount in parse_amounts(text).items():
+        if currency not in Currency.__members__:
+            raise ArgumentTypeError(f"unknown currency {currency}, expected one of {', '.join(Currency.__members__)}")
+        if amount < 0:
+            raise ArgumentTypeError(f"the budget in {currency} must not be negative, got {amount}")
+        budget[Currency(currency)] = amount
+
+    return budget
+
+
+def make_scheduler(args: Namespace, models: List[ChatModel]) -> Scheduler:
+    deadline = None if args.deadline is None else args.deadline * 60
+    return Scheduler(models, deadline=deadline, weights=args.publisher_weights)
+
+
+def open_response_cache(args: Namespace) -> Optional[ResponseCache]:
+    if not args.response_cache:
+        return None
+
+    return SqliteResponseCache(args.response_cache)
+
+
+def make_router(args: Namespace, models: List[ChatModel], profiler: Profiler) -> Router:
+    profiler.rates = {Currency.CNY: 1.0, Currency.USD: args.usd_rate}
+    return Router(models, rates=profiler.rates, profiler=profiler)
+
+
+def make_hedging(args: Namespace, models: List[ChatModel]) -> Hedging:
+    return Hedging(models, HedgeBudget(args.hedge_budget))
+
+
+# tokens of the context window kept free for the answer of a batch request
+BATCH_ANSWER_TOKENS = 4096
+
+
+def summarize_in_batches(args: Namespace, name: str, system_prompt: str, prompt_template: str,
+                         titles: Dict[int, str], load: Callable[[int], Optional[str]],
+                         build: Callable[[int, str, str], Summary]) -> Dict[int, str]:
+    """ Summarizes the items of the given titles through the batch API.
+
+    The answers of the batches that ended are stored first, then the items
+    that are neither summarized nor in a running batch are submitted, with
+    their content from `load`, in the order of `titles`. The contents of the items longer than the
+    context window are returned instead, to be summarized part by part. """
+    profiler = Profiler()
+    model = OpenaiChatModel(model=OpenaiChatModel.Model.GPT_4O)
+    model.profiler = profiler
+    client = BatchClient(model, join(args.batch_dir, f"{name}s.json"))
+    unsummarized = set(titles)
+
+    def ingest(custom_id: str, answer: str) -> None:
+        item_id = int(custom_id)
+        # answers of a batch are passed again if a run stopped while storing them
+        if item_id not in unsummarized:
+            return
+
+        project.create_summary(build(item_id, model.pretty_name(), answer))
+        unsummarized.discard(item_id)
+        logger.info(f"summary created for {name} {item_id}: {titles[item_id]}")
+
+    client.collect(ingest)
+
+    pending = {int(custom_id) for custom_id in client.pending()}
+    contexts: Dict[str, ChatContext] = {}
+    too_long: Dict[int, str] = {}
+    for item_id in titles:
+        if item_id not in unsummarized or item_id in pending:
+            continue
+
+        content = load(item_id)
+        if content is None:
+            logger.error(f"failed to load the content of {name} {item_id}: {titles[item_id]}")
+            continue
+
+        prompt = prompt_template.format(title=titles[item_id], content=content)
+        if estimate_tokens(system_prompt + prompt) + BATCH_ANSWER_TOKENS > model.context_window():
+            logger.info(f"{name} {item_id} is too long for a batch request, it is split: {titles[item_id]}")
+            too_long[item_id] = content
+            continue
+
+        context = ChatContext(model, system_prompt=system_prompt)
+        context.history.append((Role.USER, prompt))
+        contexts[str(item_id)] = context
+
+    if contexts:
+        client.submit(contexts)
+
+    nrunning = client.wait(ingest, args.batch_wait * 60)
+    if nrunning > 0:
+        logger.info(f"{nrunning} batches of {name} summaries are still running, to be collected by a later run")
+
+    profiler.print_stats()
+    return too_long
+
+
 def summarize_documents(args: Namespace) -> None:
     profiler = Profiler()
-    models: List[ChatModel] = [DeepSeekChatModel(), OpenaiChatModel()]
+    models: List[ChatModel] = [
+        GLMChatModel(model=GLMChatModel.Model.GLM4_FLASH),
+        DeepSeekChatModel(),
+        OpenaiChatModel(model=OpenaiChatModel.Model.GPT_4O)
+    ]
+    cache = open_response_cache(args)
     for model in models:
         model.profiler = profiler
+        model.cache = cache
 
+    router = make_router(args, models, profiler)
+    hedging = make_hedging(args, router.by_cost())
     system_prompt = "你是一个熟悉计算机领域的自身研究者，你的输出以Markdown格式给出。"
     prompt_template = """
     请阅读以下文章内容并用中文给出简单总结，同时列出其中你认为最有价值的核心内容。
@@ -96,38 +296,98 @@ def summarize_documents(args: Namespace) -> None:
     {content}
     """
 
-    def generate_summary(document: Document) -> Optional[Summary]:
-        for model in models:
-            try:
-                ctx = ChatContext(model, system_prompt=system_prompt)
-                resp = ctx.chat(prompt_template.format(title=document.title, content=document.content))
-                summary = Summary.build(dref.id, -1, model.pretty_name(), resp)
-                return summary
-            except Exception as ex:
-                logger.warning(f"model {model.pretty_name()} reports failure: {ex}")
+    # pages longer than the context window are summarized part by part
+    map_template = """
+    以下是文章的第{index}/{total}部分，请用中文提取这一部分的要点，保留关键的事实、数据和结论，不超过500字。
 
-        return None
+    # {title}
+
+    {content}
+    """
+    reduce_template = """
+    以下是一篇文章各部分的要点，请据此用中文给出简单总结，同时列出其中你认为最有价值的核心内容。
+
+    # {title}
+
+    {content}
+    """
+    summarizer = ChunkedSummarizer(system_prompt, prompt_template, map_template, reduce_template,
+                                   router.checked(hedging.chat))
+
+    def summary_task(dref: DocumentRef, ninput_tokens: int, load: Callable[[int], Optional[str]]) -> Task[Summary]:
+        def generate_summary(model: ChatModel) -> Summary:
+            content = load(dref.id)
+            if content is None:
+                raise TaskAbandoned(f"failed to load the content of document {dref.id}")
+
+            ctx, resp = summarizer.summarize(model, dref.title, content)
+            return Summary.build(dref.id, -1, ctx.model.pretty_name(), resp)
+
+        # routed when the task is about to run, so that the ranking reflects
+        # the capacity left to each model at that time
+        return Task(f"document {dref.id}", generate_summary, dref.date, dref.publisher,
+                    route=lambda: router.route(ninput_tokens))
+
+    drefs_to_summary = project.get_unsummarized_document_refs()
+    # the documents are routed by their size, and their content is fetched in
+    # batches by the tasks that run first and released once they completed
+    documents = Loader([dref.id for dref in drefs_to_summary], project.get_documents)
+
+    def load_content(document_id: int) -> Optional[str]:
+        document = documents.load(document_id)
+        return None if document is None else document.content
+
+    load: Callable[[int], Optional[str]] = load_content
+    release: Callable[[int], Any] = documents.release
+    if args.batch:
+        def load_document(document_id: int) -> Optional[str]:
+            # the requests keep the content, so the loader does not need to
+            content = load_content(document_id)
+            documents.release(document_id)
+            return content
+
+        # only the documents too long for a batch request are left
+        too_long = summarize_in_batches(
+            args, "document", system_prompt, prompt_template,
+            {dref.id: dref.title for dref in drefs_to_summary}, load_document,
+            lambda document_id, model, content: Summary.build(document_id, -1, model, content)
+        )
+        drefs_to_summary = [dref for dref in drefs_to_summary if dref.id in too_long]
+        sizes: List[Optional[int]] = [len(too_long[dref.id].encode('utf8')) for dref in drefs_to_summary]
+        load, release = too_long.get, too_long.pop
+    else:
+        sizes = project.get_document_sizes([dref.id for dref in drefs_to_summary])
+
+    drefs: Dict[int, DocumentRef] = {}
+    tasks: List[Task[Summary]] = []
+    for dref, size in zip(drefs_to_summary, sizes):
+        if size is None:
+            continue
 
-    drefs_to_summary: List[DocumentRef] = []
-    for dref in project.get_document_refs():
-        if project.get_summary_of_document(dref.id) is None:
-            drefs_to_summary.append(dref)
-
-    drefs_to_summary.sort(key=lambda dref: dref.date, reverse=True)
-    N = len(drefs_to_summary)
-    for i, dref in enumerate(drefs_to_summary):
-        document = project.get_document(dref.id)
-        assert document is not None
-        summary = generate_summary(document)
-        if summary is not None:
-            project.create_summary(summary)
+        prompt = prompt_template.format(title=dref.title, content="")
+        task = summary_task(dref, estimate_tokens(system_prompt + prompt) + estimate_tokens_of_size(size), load)
+        drefs[id(task)] = dref
+        tasks.append(task)
+
+    N = len(tasks)
+    for i, outcome in enumerate(make_scheduler(args, models).run(tasks)):
+        dref = drefs[id(outcome.task)]
+        release(dref.id)
+        if outcome.result is not None:
+            project.create_summary(outcome.result)
             logger.info(f"({i}/{N}) summary created for document {dref.id}: {dref.title}")
+        elif outcome.status is Status.EXPIRED:
+            logger.warning(f"({i}/{N}) summarization of document {dref.id} is postponed: {dref.title}")
         else:
             logger.error(f"({i}/{N}) failed to summarize document {dref.id}: {dref.title}")
 
     profiler.print_stats()
 
 
+# the estimated tokens of the content of an arxiv paper of usual length
+TYPICAL_PAPER_TOKENS = 20000
+
+
 def summarize_publications(args: Namespace) -> None:
     profiler = Profiler()
     models: List[ChatModel] = [
@@ -135,9 +395,13 @@ def summarize_publications(args: Namespace) -> None:
         OpenaiChatModel(model=OpenaiChatModel.Model.GPT_4O)
     ]
 
+    cache = open_response_cache(args)
     for model in models:
         model.profiler = profiler
+        model.cache = cache
 
+    router = make_router(args, models, profiler)
+    hedging = make_hedging(args, router.by_cost())
     system_prompt = "你是一个熟悉计算机领域的自身研究者，你的输出以Markdown格式给出。"
     prompt_template = """
     请阅读以下论文内容并用中文给出详细总结，包含论文提出的科研问题，解决方法，核心创新点以及效果总结。
@@ -150,46 +414,90 @@ def summarize_publications(args: Namespace) -> None:
     {content}
     """
 
-    def summarize_arxiv(pref: PublicationRef) -> Optional[Summary]:
-        content = load_arxiv_content(pref.domain_identifier)
-        if content is None:
-            logger.error(f"failed to get content of arxiv document {pref.domain_identifier}")
-            return None
-
-        for model in models:
-            try:
-                ctx = ChatContext(model, system_prompt=system_prompt)
-                s = ctx.chat(prompt_template.format(title=pref.title, content=content))
-                summary = Summary.build(-1, pref.id, model.pretty_name(), s)
-                return summary
-            except Exception as ex:
-                logger.warning(f"model {model.pretty_name()} reports failure: {ex}")
+    # papers longer than the context window are summarized section by section
+    map_template = """
+    以下是论文的第{index}/{total}部分，请用中文提取这一部分的要点，包括涉及的科研问题、方法细节、实验设置与结果，
+    不超过800字。
 
-        return None
+    # 论文标题: {title}
+
+    # 论文内容
+
+    {content}
+    """
+    reduce_template = """
+    以下是一篇论文各部分的要点，请据此用中文给出详细总结，包含论文提出的科研问题，解决方法，核心创新点以及效果总结。
+    同时请基于你的经验对于论文方法的可扩展性和应用价值进行评价。
+
+    # 论文标题: {title}
+
+    # 各部分要点
+
+    {content}
+    """
+    summarizer = ChunkedSummarizer(system_prompt, prompt_template, map_template, reduce_template,
+                                   router.checked(hedging.chat))
+
+    def arxiv_task(pref: PublicationRef, publisher: str, content: Optional[str] = None) -> Task[Summary]:
+        contents: List[str] = [] if content is None else [content]
+
+        def summarize_arxiv(model: ChatModel) -> Summary:
+            # the paper is downloaded by the first model and kept for the fallbacks
+            if not contents:
+                content = load_arxiv_content(pref.domain_identifier)
+                if content is None:
+                    raise TaskAbandoned(f"failed to get content of arxiv document {pref.domain_identifier}")
+                contents.append(content)
+
+            ctx, s = summarizer.summarize(model, pref.title, contents[0])
+            return Summary.build(-1, pref.id, ctx.model.pretty_name(), s)
 
-    prefs_to_summarize: List[PublicationRef] = []
-    for pref in project.get_publication_refs():
-        if project.get_summary_of_publication(pref.id) is None:
-            prefs_to_summarize.append(pref)
+        # papers are mostly downloaded by their tasks, so they are routed by
+        # the size of a typical paper, when the task is about to run
+        ninput_tokens = TYPICAL_PAPER_TOKENS if content is None else estimate_tokens(system_prompt + content)
+        return Task(f"publication {pref.id}", summarize_arxiv, pref.date, publisher,
+                    route=lambda: router.route(ninput_tokens))
 
-    prefs_to_summarize.sort(key=lambda p: p.date, reverse=True)
+    prefs_to_summarize = project.get_unsummarized_publication_refs()
 
-    N = len(prefs_to_summarize)
-    for i, pref in enumerate(prefs_to_summarize):
-        publication = project.get_publication(pref.id)
+    arxiv_refs: Dict[int, PublicationRef] = {}
+    for pref, publication in prefetch(prefs_to_summarize, project.get_publications):
         if publication is None:
             continue
 
-        summary: Optional[Summary] = None
         if publication.publisher == 'arxiv':
-            summary = summarize_arxiv(pref)
+            arxiv_refs[pref.id] = pref
         else:
             logger.warning(f"unknown publisher {publication.publisher} {publication.title}")
 
-        if summary is not None:
-            logger.debug(summary.content)
-            project.create_summary(summary)
+    contents: Dict[int, str] = {}
+    if args.batch:
+        # only the papers too long for a batch request are left, with the
+        # content already downloaded
+        contents = summarize_in_batches(
+            args, "publication", system_prompt, prompt_template,
+            {pref.id: pref.title for pref in arxiv_refs.values()},
+            lambda publication_id: load_arxiv_content(arxiv_refs[publication_id].domain_identifier),
+            lambda publication_id, model, content: Summary.build(-1, publication_id, model, content)
+        )
+        arxiv_refs = {pref_id: pref for pref_id, pref in arxiv_refs.items() if pref_id in contents}
+
+    prefs: Dict[int, PublicationRef] = {}
+    tasks: List[Task[Summary]] = []
+    for pref in arxiv_refs.values():
+        task = arxiv_task(pref, 'arxiv', contents.get(pref.id))
+        prefs[id(task)] = pref
+        tasks.append(task)
+
+    N = len(tasks)
+    for i, outcome in enumerate(make_scheduler(args, models).run(tasks)):
+        pref = prefs[id(outcome.task)]
+        if outcome.result is not None:
+            logger.debug(outcome.result.content)
+            project.create_summary(outcome.result)
             logger.info(f"({i}/{N}) summary created for publication {pref.id}: {pref.title}")
+        elif outcome.status is Status.EXPIRED:
+            logger.warning(f"({i}/{N}) summarization of publication {pref.id} is postponed: {pref.title}")
         else:
             logger.error(f"({i}/{N}) failed to summarize publication {pref.id}: {pref.title}")
 
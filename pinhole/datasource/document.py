@@ -1,84 +1,71 @@
-from pinhole.datasource.utils import str2hexstr, hexstr2str
-
 from pydantic.dataclasses import dataclass
-from pydantic import RootModel
+from pydantic import TypeAdapter
 
 from datetime import datetime
+from typing import Any, Sequence
 
 
-@dataclass(repr=False)
+@dataclass(repr=False, slots=True)
 class Document:
-    _title: str
+    title: str
     date: datetime
-    _url: str
-    _publisher: str
-    _content: str
+    url: str
+    publisher: str
+    content: str
 
     def __repr__(self) -> str:
         return f"<Document {self.title}: {self.date} />"
 
-    @property
-    def title(self) -> str:
-        return bytes.fromhex(self._title).decode('utf8')
-
     def set_title(self, title: str) -> None:
-        self._title = title.encode('utf8').hex()
-
-    @property
-    def url(self) -> str:
-        return bytes.fromhex(self._url).decode('utf8')
-
-    @property
-    def publisher(self) -> str:
-        return bytes.fromhex(self._publisher).decode('utf8')
-
-    @property
-    def content(self) -> str:
-        return bytes.fromhex(self._content).decode('utf8')
+        self.title = title
 
     def set_content(self, content: str) -> None:
-        self._content = content.encode('utf8').hex()
+        self.content = content
 
     @classmethod
     def build(cls, title: str, date: datetime, url: str, publisher: str, content: str) -> 'Document':
-        _title = title.encode('utf8').hex()
-        _url = url.encode('utf8').hex()
-        _publisher = publisher.encode('utf8').hex()
-        _content = content.encode('utf8').hex()
-        return Document(_title, date, _url, _publisher, _content)
+        return Document(title, date, url, publisher, content)
+
+    @classmethod
+    def from_row(cls, row: Sequence[Any]) -> 'Document':
+        """ Builds a document from a (title, date, url, publisher, content) database
+        row without validation, the date being a timestamp. """
+        document = cls.__new__(cls)
+        document.title, date, document.url, document.publisher, document.content = row
+        document.date = datetime.fromtimestamp(date)
+        return document
 
     @classmethod
     def from_json(cls, content: str) -> 'Document':
-        return RootModel[Document].model_validate(content).root
+        return DOCUMENT_ADAPTER.validate_python(content)
 
 
-@dataclass
+@dataclass(slots=True)
 class DocumentRef:
     id: int
-    _title: str
+    title: str
     date: datetime
-    _url: str
-    _publisher: str
-
-    @property
-    def title(self) -> str:
-        return bytes.fromhex(self._title).decode('utf8')
-
-    @property
-    def url(self) -> str:
-        return bytes.fromhex(self._url).decode('utf8')
-
-    @property
-    def publisher(self) -> str:
-        return bytes.fromhex(self._publisher).decode('utf8')
+    url: str
+    publisher: str
 
     @classmethod
     def build(cls, id: int, title: str, date: datetime, url: str, publisher: str) -> 'DocumentRef':
-        _title = title.encode('utf8').hex()
-        _url = url.encode('utf8').hex()
-        _publisher = publisher.encode('utf8').hex()
-        return DocumentRef(id, _title, date, _url, _publisher)
+        return DocumentRef(id, title, date, url, publisher)
+
+    @classmethod
+    def from_row(cls, row: Sequence[Any]) -> 'DocumentRef':
+        """ Builds a ref from an (id, title, date, url, publisher) database row
+        without validation, the date being a timestamp. """
+        dref = cls.__new__(cls)
+        dref.id, dref.title, date, dref.url, dref.publisher = row
+        dref.date = datetime.fromtimestamp(date)
+        return dref
 
     @classmethod
     def from_json(cls, content: str) -> 'DocumentRef':
-        return RootModel[DocumentRef].model_validate(content).root
+        return DOCUMENT_REF_ADAPTER.validate_python(content)
+
+
+# validators built once instead of on every `from_json` call
+DOCUMENT_ADAPTER = TypeAdapter(Document)
+DOCUMENT_REF_ADAPTER = TypeAdapter(DocumentRef)
@@ -1,25 +1,23 @@
-from pinhole.datasource.utils import hexstr2str, str2hexstr
-
 from pydantic.dataclasses import dataclass, Field
-from pydantic.root_model import RootModel
-from typing import List, Literal
+from pydantic import TypeAdapter
+from typing import Any, List, Literal, Sequence
 from datetime import datetime
 
 
 PublicationType = Literal['journal', 'conference', 'preprint', 'article']
 
 
-@dataclass
+@dataclass(slots=True)
 class Publication:
-    _title: str
-    _authors: str
+    title: str
+    authors: List[str]
     date: datetime
-    _booktitle: str
-    _url: str
-    _publisher: str
-    _domain_identifier: str
+    booktitle: str
+    url: str
+    publisher: str
+    domain_identifier: str
     type: PublicationType
-    _abstract: str = ""
+    abstract: str = ""
 
     @classmethod
     def build(cls, title: str,
@@ -32,79 +30,54 @@ class Publication:
               type: PublicationType = 'article',
               abstract: str = "") -> 'Publication':
 
-        pub = Publication("", "", date, "", "", "", "", type)
-        pub.set_title(title)
-        pub.set_authors(authors)
-        pub.set_booktitle(booktitle)
-        pub.set_url(url)
-        pub.set_publisher(publisher)
-        pub.set_domain_identifier(domain_identifier)
-        pub.set_abstract(abstract)
+        return Publication(title, authors, date, booktitle, url, publisher, domain_identifier, type, abstract)
 
+    @classmethod
+    def from_row(cls, row: Sequence[Any]) -> 'Publication':
+        """ Builds a publication from a (title, authors, date, booktitle, url,
+        publisher, domain_identifier, type, abstract) database row without
+        validation, the authors being joined by '|' and the date being a timestamp. """
+        pub = cls.__new__(cls)
+        (pub.title, authors, date, pub.booktitle, pub.url, pub.publisher,
+         pub.domain_identifier, pub.type, pub.abstract) = row
+        pub.authors = authors.split("|")
+        pub.date = datetime.fromtimestamp(date)
         return pub
 
-    @property
-    def title(self) -> str:
-        return hexstr2str(self._title)
-
     def set_title(self, title: str) -> None:
-        self._title = str2hexstr(title)
-
-    @property
-    def authors(self) -> List[str]:
-        return [hexstr2str(a) for a in self._authors.split("|")]
-
-    def set_authors(self, authors: List[str]):
-        self._authors = "|".join(str2hexstr(a) for a in authors)
+        self.title = title
 
-    @property
-    def booktitle(self) -> str:
-        return hexstr2str(self._booktitle)
+    def set_authors(self, authors: List[str]) -> None:
+        self.authors = authors
 
     def set_booktitle(self, booktitle: str) -> None:
-        self._booktitle = str2hexstr(booktitle)
-
-    @property
-    def url(self) -> str:
-        return hexstr2str(self._url)
+        self.booktitle = booktitle
 
     def set_url(self, url: str) -> None:
-        self._url = str2hexstr(url)
-
-    @property
-    def domain_identifier(self) -> str:
-        return hexstr2str(self._domain_identifier)
+        self.url = url
 
     def set_domain_identifier(self, domain_identifier: str) -> None:
-        self._domain_identifier = str2hexstr(domain_identifier)
-
-    @property
-    def publisher(self) -> str:
-        return hexstr2str(self._publisher)
+        self.domain_identifier = domain_identifier
 
     def set_publisher(self, publisher: str) -> None:
-        self._publisher = str2hexstr(publisher)
-
-    @property
-    def abstract(self) -> str:
-        return hexstr2str(self._abstract)
+        self.publisher = publisher
 
     def set_abstract(self, abstract: str) -> None:
-        self._abstract = str2hexstr(abstract)
+        self.abstract = abstract
 
     @classmethod
     def from_json(cls, data: str) -> 'Publication':
-        return RootModel[Publication].model_validate(data).root
+        return PUBLICATION_ADAPTER.validate_python(data)
 
 
-@dataclass
+@dataclass(slots=True)
 class PublicationRef:
     id: int
-    _title: str
+    title: str
     date: datetime
-    _booktitle: str
-    _url: str
-    _domain_identifier: str
+    booktitle: str
+    url: str
+    domain_identifier: str
     type: PublicationType
 
     @classmethod
@@ -116,42 +89,34 @@ class PublicationRef:
               domain_identifier: str = "",
               type: PublicationType = 'article') -> 'PublicationRef':
 
-        pub = PublicationRef(id, "", date, "", "", "", type)
-        pub.set_title(title)
-        pub.set_booktitle(booktitle)
-        pub.set_url(url)
-        pub.set_domain_identifier(domain_identifier)
+        return PublicationRef(id, title, date, booktitle, url, domain_identifier, type)
 
-        return pub
-
-    @property
-    def title(self) -> str:
-        return hexstr2str(self._title)
+    @classmethod
+    def from_row(cls, row: Sequence[Any]) -> 'PublicationRef':
+        """ Builds a ref from an (id, title, date, booktitle, url, domain_identifier,
+        type) database row without validation, the date being a timestamp. """
+        pref = cls.__new__(cls)
+        pref.id, pref.title, date, pref.booktitle, pref.url, pref.domain_identifier, pref.type = row
+        pref.date = datetime.fromtimestamp(date)
+        return pref
 
     def set_title(self, title: str) -> None:
-        self._title = str2hexstr(title)
-
-    @property
-    def booktitle(self) -> str:
-        return hexstr2str(self._booktitle)
+        self.title = title
 
     def set_booktitle(self, booktitle: str) -> None:
-        self._booktitle = str2hexstr(booktitle)
-
-    @property
-    def url(self) -> str:
-        return hexstr2str(self._url)
+        self.booktitle = booktitle
 
     def set_url(self, url: str) -> None:
-        self._url = str2hexstr(url)
-
-    @property
-    def domain_identifier(self) -> str:
-        return hexstr2str(self._domain_identifier)
+        self.url = url
 
     def set_domain_identifier(self, domain_identifier: str) -> None:
-        self._domain_identifier = str2hexstr(domain_identifier)
+        self.domain_identifier = domain_identifier
 
     @classmethod
     def from_json(cls, data: str) -> 'PublicationRef':
-        return RootModel[PublicationRef].model_validate(data).root
+        return PUBLICATION_REF_ADAPTER.validate_python(data)
+
+
+# validators built once instead of on every `from_json` call
+PUBLICATION_ADAPTER = TypeAdapter(Publication)
+PUBLICATION_REF_ADAPTER = TypeAdapter(PublicationRef)
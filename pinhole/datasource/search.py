@@ -0,0 +1,28 @@
+from pydantic.dataclasses import dataclass
+from pydantic import TypeAdapter
+from typing import Literal
+from datetime import datetime
+
+
+SearchKind = Literal['document', 'publication']
+
+
+@dataclass
+class SearchHit:
+    """ A document or publication matched by a full-text search. Lower scores
+    rank better, following the convention of the sqlite bm25() function. """
+    kind: SearchKind
+    id: int
+    title: str
+    date: datetime
+    url: str
+    publisher: str
+    score: float
+
+    @classmethod
+    def from_json(cls, data: str) -> 'SearchHit':
+        return SEARCH_HIT_ADAPTER.validate_python(data)
+
+
+# validators built once instead of on every `from_json` call
+SEARCH_HIT_ADAPTER = TypeAdapter(SearchHit)
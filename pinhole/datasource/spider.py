@@ -1,5 +1,7 @@
 from pinhole.datasource.document import Document
 from pinhole.datasource.publication import Publication
+from pinhole.project import AbstractProject
+from pinhole.storage.bloom import BloomFilter
 from scrapy import Spider  # type: ignore
 from scrapy.crawler import CrawlerProcess  # type: ignore
 from loguru import logger
@@ -13,6 +15,33 @@ import json
 
 class PinholeSpider:
 
+    # urls of the articles that are already stored, see `set_known_urls`
+    known_urls: Optional[BloomFilter] = None
+    project: Optional[AbstractProject] = None
+
+    def set_known_urls(self, known_urls: BloomFilter, project: Optional[AbstractProject] = None) -> None:
+        """ Lets the spider skip articles that are already stored. Since the
+        filter has false positives, the urls it reports as known are confirmed
+        with `project` if one is given, otherwise they are skipped as well. """
+        self.known_urls = known_urls
+        self.project = project
+
+    def filter_unknown_urls(self, urls: List[str]) -> List[str]:
+        """ Returns the urls among `urls` that are not known to be stored. """
+        if self.known_urls is None:
+            return urls
+
+        maybe_known = [url for url in urls if url in self.known_urls]
+        if maybe_known and self.project is not None:
+            known = {url for url, exists in zip(maybe_known, self.project.exists(maybe_known)) if exists}
+        else:
+            known = set(maybe_known)
+
+        if known:
+            logger.debug(f"skip {len(known)} known urls out of {len(urls)}")
+
+        return [url for url in urls if url not in known]
+
     def get_name(self) -> str:
         raise NotImplementedError
 
@@ -74,7 +103,7 @@ class PinholeScrapySpider(PinholeSpider, Spider):
         }
 
         cp = CrawlerProcess(settings=settings)
-        cp.crawl(type(self))
+        cp.crawl(type(self), known_urls=self.known_urls, project=self.project)
         cp.start()
 
     def get_name(self) -> str:
@@ -101,7 +130,7 @@ class PinholeScrapySpider(PinholeSpider, Spider):
         with open(self.temp_file, "r") as ftemp:
             data = ftemp.read()
             for item in json.loads(data):
-                if "_abstract" in item:
+                if "abstract" in item:
                     publication = Publication.from_json(item)
                     artifacts.append(publication)
                 else:
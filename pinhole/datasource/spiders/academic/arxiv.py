@@ -27,8 +27,12 @@ class ArxivBase(PinholeScrapySpider):
         yield publication
 
     def parse(self, response: Response, **kwargs: Any) -> Any:
-        for article_addr in response.xpath("//div[@id='dlpage']//a[@title='Abstract']/@href").getall():
-            yield response.follow(article_addr, self.parse_article)
+        article_urls = [
+            response.urljoin(article_addr)
+            for article_addr in response.xpath("//div[@id='dlpage']//a[@title='Abstract']/@href").getall()
+        ]
+        for article_url in self.filter_unknown_urls(article_urls):
+            yield response.follow(article_url, self.parse_article)
 
         # the first 'small' indicates the top pager in this page
         for pager in response.xpath("//div[@id='dlpage']/small[1]/a/@href").getall():
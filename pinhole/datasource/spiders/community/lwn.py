@@ -59,6 +59,7 @@ class LwnHeadline(PinholeScrapySpider):
     def parse(self, response: Response, **kwargs: Any) -> Any:
         blocks = response.text.split('&&')
 
+        headlines: Dict[str, Document] = {}
         for block in blocks[1:]:
             lines = block.splitlines()
             if len(lines) < 4:
@@ -71,7 +72,10 @@ class LwnHeadline(PinholeScrapySpider):
                 continue
 
             date = dateparser.parse(date_string) or datetime.today()
-            self.temp_documents[url] = Document.build(title, date, url, f"LWN {channel}", "")
+            headlines[url] = Document.build(title, date, url, f"LWN {channel}", "")
+
+        for url in self.filter_unknown_urls(list(headlines)):
+            self.temp_documents[url] = headlines[url]
             yield response.follow(url, self.parse_article)
 
     def start_spiding(self, response: Response, **kwargs: Any):
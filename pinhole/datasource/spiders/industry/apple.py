@@ -32,6 +32,9 @@ class AppleSecurityBlog(PinholeScrapySpider):
 
     def parse(self, response: Response, **kwargs: Any) -> Any:
         content_json = json.loads(response.xpath("//script[@id='__NEXT_DATA__']/text()").get())
-        for item in content_json["props"]["pageProps"]["blogs"]:
-            slug = item["slug"]
-            yield response.follow(f"https://security.apple.com/blog/{slug}", self.parse_blog)
+        blog_urls = [
+            f"https://security.apple.com/blog/{item['slug']}"
+            for item in content_json["props"]["pageProps"]["blogs"]
+        ]
+        for blog_url in self.filter_unknown_urls(blog_urls):
+            yield response.follow(blog_url, self.parse_blog)
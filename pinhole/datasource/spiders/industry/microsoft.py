@@ -27,8 +27,8 @@ class MicrosoftSecurityBlog(PinholeScrapySpider):
             return
 
         self.visited_urls.add(response.url)
-        article_links = response.xpath("//article//a/@href").getall()
-        for link in article_links:
+        article_links = [response.urljoin(link) for link in response.xpath("//article//a/@href").getall()]
+        for link in self.filter_unknown_urls(article_links):
             yield response.follow(link, self.parse)
 
         title = response.xpath("//header//h1/text()").get()
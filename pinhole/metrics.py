@@ -0,0 +1,170 @@
+""" Minimal in-process metrics rendered in the Prometheus text format.
+
+Metrics keep plain numbers per label set behind a lock, so updating them costs
+a dictionary lookup and a few additions, and nothing is allocated for label
+sets seen before. """
+from bisect import bisect_left
+from threading import Lock
+from typing import Dict, List, Sequence, Tuple
+
+
+LabelValues = Tuple[str, ...]
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def format_labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    pairs = [f'{name}="{escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Metric:
+    type = ""
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = ()) -> None:
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._lock = Lock()
+
+    def samples(self) -> List[str]:
+        raise NotImplementedError
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}"]
+        lines.extend(self.samples())
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = ()) -> None:
+        super().__init__(name, help, labels)
+        self.__values: Dict[LabelValues, float] = {}
+
+    def inc(self, *labels: str, amount: float = 1.0) -> None:
+        with self._lock:
+            self.__values[labels] = self.__values.get(labels, 0.0) + amount
+
+    def set(self, *labels: str, value: float) -> None:
+        """ Mirrors a total counted elsewhere, which must never decrease. """
+        with self._lock:
+            self.__values[labels] = value
+
+    def samples(self) -> List[str]:
+        with self._lock:
+            values = list(self.__values.items())
+
+        return [f"{self.name}{format_labels(self.labels, labels)} {value}" for labels, value in values]
+
+
+class Gauge(Metric):
+    type = "gauge"
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = ()) -> None:
+        super().__init__(name, help, labels)
+        self.__values: Dict[LabelValues, float] = {}
+
+    def inc(self, *labels: str, amount: float = 1.0) -> None:
+        with self._lock:
+            self.__values[labels] = self.__values.get(labels, 0.0) + amount
+
+    def dec(self, *labels: str, amount: float = 1.0) -> None:
+        self.inc(*labels, amount=-amount)
+
+    def set(self, *labels: str, value: float) -> None:
+        with self._lock:
+            self.__values[labels] = value
+
+    def samples(self) -> List[str]:
+        with self._lock:
+            values = list(self.__values.items())
+
+        return [f"{self.name}{format_labels(self.labels, labels)} {value}" for labels, value in values]
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = (),
+                 buckets: Sequence[float] = DEFAULT_BUCKETS) -> None:
+        super().__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets))
+        # per label set: the count of each bucket plus +Inf, then the sum
+        self.__values: Dict[LabelValues, List[float]] = {}
+
+    def observe(self, value: float, *labels: str) -> None:
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            counts = self.__values.get(labels)
+            if counts is None:
+                counts = self.__values[labels] = [0.0] * (len(self.buckets) + 2)
+
+            counts[index] += 1
+            counts[-1] += value
+
+    def samples(self) -> List[str]:
+        with self._lock:
+            values = [(labels, list(counts)) for labels, counts in self.__values.items()]
+
+        lines = []
+        for labels, counts in values:
+            cumulative = 0.0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                bucket_labels = format_labels(self.labels, labels, f'le="{le}"')
+                lines.append(f"{self.name}_bucket{bucket_labels} {cumulative}")
+
+            lines.append(f"{self.name}_sum{format_labels(self.labels, labels)} {counts[-1]}")
+            lines.append(f"{self.name}_count{format_labels(self.labels, labels)} {cumulative}")
+
+        return lines
+
+
+class Registry:
+    def __init__(self) -> None:
+        self.__metrics: Dict[str, Metric] = {}
+        self.__lock = Lock()
+
+    def register(self, metric: Metric) -> Metric:
+        with self.__lock:
+            if metric.name in self.__metrics:
+                raise ValueError(f"metric {metric.name} is already registered")
+            self.__metrics[metric.name] = metric
+
+        return metric
+
+    def counter(self, name: str, help: str, labels: Sequence[str] = ()) -> Counter:
+        metric = Counter(name, help, labels)
+        self.register(metric)
+        return metric
+
+    def gauge(self, name: str, help: str, labels: Sequence[str] = ()) -> Gauge:
+        metric = Gauge(name, help, labels)
+        self.register(metric)
+        return metric
+
+    def histogram(self, name: str, help: str, labels: Sequence[str] = (),
+                  buckets: Sequence[float] = DEFAULT_BUCKETS) -> Histogram:
+        metric = Histogram(name, help, labels, buckets)
+        self.register(metric)
+        return metric
+
+    def render(self) -> str:
+        with self.__lock:
+            metrics = list(self.__metrics.values())
+
+        return "\n".join(metric.render() for metric in metrics) + "\n"
+
+
+# the registry of the metrics of this process
+REGISTRY = Registry()
@@ -1,9 +1,15 @@
-from pinhole.models.profiler import Currency, Profiler, Statistics, Usage
+from pinhole.models.profiler import Currency, Profiler, StreamTiming, Usage
+from pinhole.models.limiter import KNOWN_LIMITS, Limits, RateLimiter, get_limiter
+from pinhole.models.tokens import estimate_tokens
+from pinhole.models.cache import CachedCompletion, ResponseCache, completion_key
 
 from loguru import logger
 
+from contextlib import contextmanager
 from dataclasses import dataclass, field
-from typing import List, Tuple, Optional
+from threading import local
+from time import monotonic
+from typing import Any, Dict, Generator, Iterator, List, Tuple, Optional
 from math import inf
 from enum import Enum
 
@@ -20,6 +26,9 @@ class ChatContext:
     task_identifier: str = "default"
     system_prompt: str = "You are a useful assistant."
     history: List[Tuple[Role, str]] = field(default_factory=list)
+    # whether the last answer came from the response cache of the model
+    # rather than from the model itself
+    cached: bool = field(default=False, compare=False)
 
     def fork(self) -> 'ChatContext':
         return ChatContext(
@@ -31,10 +40,45 @@ class ChatContext:
 
     def chat(self, message: str) -> str:
         self.history.append((Role.USER, message))
-        response = self.model.chat(self)
+        response = self.model.complete(self)
         self.history.append((Role.ASSISTANT, response))
         return response
 
+    def chat_stream(self, message: str,
+                    max_output_tokens: Optional[int] = None,
+                    max_cost: Optional[float] = None) -> Generator[str, None, None]:
+        """ Like `chat`, yielding the answer in pieces as they are generated.
+
+        The generation is cancelled once it is estimated to exceed
+        `max_output_tokens` or to cost more than `max_cost` (in the currency of
+        the model), or when the iterator is closed. The answer received so far
+        is added to the history in any case. """
+        self.history.append((Role.USER, message))
+        input_price, output_price, _ = self.model.price()
+        ninput_tokens = estimate_tokens(self.system_prompt + "".join(msg for _, msg in self.history))
+
+        pieces: List[str] = []
+        noutput_bytes = 0
+        stream = self.model.complete_stream(self)
+        try:
+            for delta in stream:
+                pieces.append(delta)
+                yield delta
+
+                noutput_bytes += len(delta.encode('utf8'))
+                noutput_tokens = noutput_bytes // 3
+                if max_output_tokens is not None and noutput_tokens >= max_output_tokens:
+                    logger.warning(f"{self.model.pretty_name()}: answer cut at {noutput_tokens} tokens")
+                    break
+
+                cost = (ninput_tokens * input_price + noutput_tokens * output_price) / 1E6
+                if max_cost is not None and cost > max_cost:
+                    logger.warning(f"{self.model.pretty_name()}: answer cut at a cost of {cost:.3f}")
+                    break
+        finally:
+            stream.close()
+            self.history.append((Role.ASSISTANT, "".join(pieces)))
+
     def summary(self) -> str:
         s = f"Model: {self.model.pretty_name()}\n\n"
         s += "====== SYSTEM ======\n"
@@ -59,10 +103,56 @@ class ChatContext:
         self.history.clear()
 
 
+# the usages reported by the requests of the current thread, collected while
+# a completion is made to be cached
+USAGE_CAPTURE = local()
+
+
+@contextmanager
+def capturing_usage(usages: List[Usage]) -> Iterator[None]:
+    outer = getattr(USAGE_CAPTURE, "usages", None)
+    USAGE_CAPTURE.usages = usages
+    try:
+        yield
+    finally:
+        USAGE_CAPTURE.usages = outer
+
+
+# the times the streamed requests of the current thread were sent, after
+# waiting for their rate limiter, collected while a stream is timed
+SEND_CAPTURE = local()
+
+
+@contextmanager
+def capturing_send_times(times: List[float]) -> Iterator[None]:
+    outer = getattr(SEND_CAPTURE, "times", None)
+    SEND_CAPTURE.times = times
+    try:
+        yield
+    finally:
+        SEND_CAPTURE.times = outer
+
+
+# why the streamed answers of the current thread ended, as reported by the
+# provider, collected to tell complete answers from cut ones
+FINISH_CAPTURE = local()
+
+
+@contextmanager
+def capturing_finish_reasons(reasons: List[str]) -> Iterator[None]:
+    outer = getattr(FINISH_CAPTURE, "reasons", None)
+    FINISH_CAPTURE.reasons = reasons
+    try:
+        yield
+    finally:
+        FINISH_CAPTURE.reasons = outer
+
+
 @dataclass
 class ChatModel:
 
     profiler: Optional[Profiler] = field(default=None, init=False)
+    cache: Optional[ResponseCache] = field(default=None, init=False)
 
     @property
     def support_system_prompt(self) -> bool:
@@ -72,12 +162,158 @@ class ChatModel:
     def support_tool_use(self) -> bool:
         return False
 
+    @property
+    def max_concurrency(self) -> int:
+        """ The number of requests that may be in flight at the same time on
+        the backend of the model, shared by all models of the backend. """
+        return 4
+
     def pretty_name(self) -> str:
         raise NotImplementedError
 
+    def limits(self) -> Limits:
+        """ The rate limits the provider imposes on the model. """
+        return KNOWN_LIMITS.get(self.pretty_name(), Limits())
+
+    @property
+    def limiter(self) -> RateLimiter:
+        return get_limiter(self.pretty_name(), self.limits())
+
     def chat(self, context: ChatContext) -> str:
         raise NotImplementedError
 
+    def chat_stream(self, context: ChatContext) -> Generator[str, None, None]:
+        """ Yields the answer in pieces as they are generated. Closing the
+        iterator stops the generation. Models without streaming support
+        yield the whole answer at once. Implementations report why the answer
+        ended with `notify_finish`. """
+        response = self.chat(context)
+        # `chat` only returns once the answer is complete
+        self.notify_finish("stop")
+        yield response
+
+    def parameters(self) -> Dict[str, Any]:
+        """ The request parameters besides the messages that affect the answers. """
+        return {}
+
+    def cache_key(self, context: ChatContext) -> str:
+        return completion_key({
+            "backend": type(self).__name__,
+            "model": self.pretty_name(),
+            "parameters": self.parameters(),
+            "system_prompt": context.system_prompt,
+            "history": [(role.value, msg) for role, msg in context.history]
+        })
+
+    def __lookup(self, key: str) -> Optional[str]:
+        assert self.cache is not None
+        try:
+            cached = self.cache.get(key)
+        except Exception as ex:
+            logger.warning(f"failed to look up the response cache: {ex}")
+            return None
+
+        if cached is None:
+            return None
+
+        if self.profiler is not None:
+            self.profiler.record_saved_usage(self, Usage(cached.ninput_tokens, cached.noutput_tokens))
+        return cached.response
+
+    def __store(self, key: str, response: str, usages: List[Usage]) -> None:
+        assert self.cache is not None
+        completion = CachedCompletion(
+            response,
+            sum(usage.ninput_tokens for usage in usages),
+            sum(usage.noutput_tokens for usage in usages)
+        )
+        try:
+            self.cache.put(key, completion)
+        except Exception as ex:
+            logger.warning(f"failed to store the response in the cache: {ex}")
+
+    def complete(self, context: ChatContext) -> str:
+        """ Answers the context with `chat`, unless the same request was answered
+        before and its answer is still in the cache of the model. """
+        context.cached = False
+        if self.cache is None:
+            return self.chat(context)
+
+        key = self.cache_key(context)
+        response = self.__lookup(key)
+        if response is not None:
+            context.cached = True
+            return response
+
+        usages: List[Usage] = []
+        with capturing_usage(usages):
+            response = self.chat(context)
+
+        self.__store(key, response, usages)
+        return response
+
+    def complete_stream(self, context: ChatContext) -> Generator[str, None, None]:
+        """ Like `complete`, yielding the answer of `chat_stream` as it comes.
+        The timing of the stream is reported to the profiler. Only an answer
+        the model finished normally is cached, not one cut short by closing
+        the iterator or by the limit on the output tokens. """
+        context.cached = False
+        key = self.cache_key(context) if self.cache is not None else None
+        if key is not None:
+            response = self.__lookup(key)
+            if response is not None:
+                context.cached = True
+                yield response
+                return
+
+        usages: List[Usage] = []
+        sent: List[float] = []
+        reasons: List[str] = []
+        pieces: List[str] = []
+        begin = monotonic()
+        first_token: Optional[float] = None
+        cancelled = False
+
+        stream = self.chat_stream(context)
+        try:
+            while True:
+                # usages are only captured while the model works, not while
+                # the caller does something else with the thread in between
+                with capturing_usage(usages), capturing_send_times(sent), capturing_finish_reasons(reasons):
+                    delta = next(stream, None)
+
+                # timed from the request rather than from the wait for the
+                # rate limiter, when the model tells
+                if sent:
+                    begin = sent[0]
+                if delta is None:
+                    break
+
+                if first_token is None and delta:
+                    first_token = monotonic() - begin
+                pieces.append(delta)
+                yield delta
+        except GeneratorExit:
+            cancelled = True
+            raise
+        finally:
+            stream.close()
+            if self.profiler is not None:
+                noutput_tokens = sum(usage.noutput_tokens for usage in usages)
+                if noutput_tokens == 0:
+                    noutput_tokens = estimate_tokens("".join(pieces))
+
+                timing = StreamTiming(first_token, monotonic() - begin, noutput_tokens, cancelled)
+                self.profiler.record_stream(self, timing)
+
+        if key is None:
+            return
+
+        if reasons and reasons[-1] == "stop":
+            self.__store(key, "".join(pieces), usages)
+        else:
+            logger.warning(f"{self.pretty_name()}: answer not cached, it ended with {reasons[-1] if reasons else None}")
+
     def fork(self) -> 'ChatModel':
         raise NotImplementedError
 
@@ -85,15 +321,40 @@ class ChatModel:
         """ Returns (price/million input tokens, price/million output tokens, currency unit) """
         return (inf, inf, Currency.CNY)
 
-    def notify_usage(self, n_input_tokens: int, n_output_tokens: int) -> None:
+    def batch_price(self) -> Tuple[float, float, Currency]:
+        """ Returns the price of the requests sent through a batch API, which
+        providers bill at about half the price of the same requests sent one
+        by one. """
+        input_price, output_price, currency = self.price()
+        return input_price / 2, output_price / 2, currency
+
+    def context_window(self) -> int:
+        """ Returns the number of tokens the model takes, the prompt and the
+        answer together. """
+        return 4096
+
+    def notify_sent(self, begin: float) -> None:
+        """ Reports the time (of `monotonic`) a streamed request was sent. """
+        captured = getattr(SEND_CAPTURE, "times", None)
+        if captured is not None:
+            captured.append(begin)
+
+    def notify_finish(self, reason: str) -> None:
+        """ Reports why a streamed answer ended, "stop" when it is complete. """
+        captured = getattr(FINISH_CAPTURE, "reasons", None)
+        if captured is not None:
+            captured.append(reason)
+
+    def notify_usage(self, n_input_tokens: int, n_output_tokens: int, batch: bool = False) -> None:
+        usage = Usage(n_input_tokens, n_output_tokens, batch=batch)
+        captured = getattr(USAGE_CAPTURE, "usages", None)
+        if captured is not None:
+            captured.append(usage)
+
         if self.profiler is None:
             return
 
-        if self not in self.profiler.stats:
-            self.profiler.stats[self] = Statistics(self)
-
-        stats = self.profiler.stats[self]
-        stats.usages.append(Usage(n_input_tokens, n_output_tokens))
+        self.profiler.record_usage(self, usage)
 
     def validate(self) -> bool:
         """ Validate whether the chat model is properly configured. """
@@ -0,0 +1,189 @@
+""" Requests sent through the batch API of OpenAI-compatible providers.
+
+Requests whose answers are not needed right away are written to a JSONL file,
+uploaded and run by the provider within a day, at about half the price and
+outside the rate limits of the interactive requests. The batches in flight
+are kept in a state file, so that a later run picks up the answers of the
+batches submitted by an earlier one:
+
+    client = BatchClient(model, "batches/documents.json")
+    client.collect(ingest)      # answers of the batches that completed
+    client.submit(contexts)     # new requests, skipping client.pending()
+    client.wait(ingest, 3600)   # polls until the batches complete
+
+The endpoints used are `/files`, `/files/{id}/content`, `/batches` and
+`/batches/{id}`. """
+from pinhole.models.base import ChatContext
+from pinhole.models.openai import OpenaiCompatibleChatModel
+
+from loguru import logger
+
+from dataclasses import asdict, dataclass, field
+from datetime import datetime
+from os import makedirs, replace
+from os.path import dirname, exists, join
+from time import monotonic, sleep, time
+from typing import Any, Callable, Dict, List, Optional, Set
+
+import json
+import requests
+
+
+# the batches that are still running on the provider
+RUNNING = {"validating", "in_progress", "finalizing", "cancelling"}
+
+# the limits on the number of requests of a batch and on the size of its
+# input file set by OpenAI
+MAX_REQUESTS = 50000
+MAX_INPUT_BYTES = 200 * 1024 * 1024
+
+
+@dataclass
+class PendingBatch:
+    id: str
+    input_file_id: str
+    custom_ids: List[str]
+    submitted: float = field(default_factory=time)
+
+
+class BatchClient:
+    """ Submits requests to the batch API of `model` and collects their
+    answers, keeping the batches in flight in the json file at `state_path`. """
+
+    def __init__(self, model: OpenaiCompatibleChatModel, state_path: str, timeout: float = 300) -> None:
+        if dirname(state_path):
+            makedirs(dirname(state_path), exist_ok=True)
+
+        self.model = model
+        self.state_path = state_path
+        self.timeout = timeout
+        self.__batches = self.__load()
+
+    def __load(self) -> List[PendingBatch]:
+        if not exists(self.state_path):
+            return []
+
+        with open(self.state_path) as f:
+            return [PendingBatch(**batch) for batch in json.load(f)["batches"]]
+
+    def __save(self) -> None:
+        # replaced at once, so that an interrupted run leaves the former state
+        temp_path = self.state_path + ".tmp"
+        with open(temp_path, "w") as f:
+            json.dump({"batches": [asdict(batch) for batch in self.__batches]}, f, indent=2)
+        replace(temp_path, self.state_path)
+
+    def __headers(self) -> Dict[str, str]:
+        # the content type is set by requests, as json or multipart
+        return {key: value for key, value in self.model.headers.items() if key.lower() != "content-type"}
+
+    def __call(self, method: str, path: str, **kwargs: Any) -> requests.Response:
+        resp = requests.request(method, f"{self.model.api_address}{path}", headers=self.__headers(),
+                                timeout=self.timeout, **kwargs)
+        if resp.status_code != 200:
+            raise Exception(f"{method} {path} failed: {resp.status_code} {resp.text}")
+
+        return resp
+
+    def pending(self) -> Set[str]:
+        """ The custom ids of the requests in flight. """
+        return {custom_id for batch in self.__batches for custom_id in batch.custom_ids}
+
+    def submit(self, contexts: Dict[str, ChatContext],
+               max_requests: int = MAX_REQUESTS, max_bytes: int = MAX_INPUT_BYTES) -> List[str]:
+        """ Submits the requests answering each context, by custom id, and
+        returns the ids of the batches created. The requests are split into
+        batches of at most `max_requests` requests and `max_bytes` bytes of
+        input file. """
+        batch_ids: List[str] = []
+        custom_ids: List[str] = []
+        lines: List[bytes] = []
+        nbytes = 0
+        for custom_id, context in contexts.items():
+            line = (json.dumps(self.model.batch_request(custom_id, context), ensure_ascii=False) + "\n").encode('utf8')
+            if lines and (len(lines) >= max_requests or nbytes + len(line) > max_bytes):
+                batch_ids.append(self.__submit(custom_ids, lines))
+                custom_ids, lines, nbytes = [], [], 0
+
+            custom_ids.append(custom_id)
+            lines.append(line)
+            nbytes += len(line)
+
+        if lines:
+            batch_ids.append(self.__submit(custom_ids, lines))
+
+        return batch_ids
+
+    def __submit(self, custom_ids: List[str], lines: List[bytes]) -> str:
+        # the input is kept next to the state, to look into failed batches
+        name = f"{self.model.pretty_name()}-{datetime.now():%Y%m%d-%H%M%S-%f}.jsonl"
+        path = join(dirname(self.state_path), name)
+        with open(path, "wb") as f:
+            f.writelines(lines)
+
+        with open(path, "rb") as f:
+            resp = self.__call("POST", "/files", data={"purpose": "batch"}, files={"file": (name, f)})
+        input_file_id = resp.json()["id"]
+
+        resp = self.__call("POST", "/batches", json={
+            "input_file_id": input_file_id,
+            "endpoint": "/v1/chat/completions",
+            "completion_window": "24h",
+        })
+        batch_id = resp.json()["id"]
+
+        self.__batches.append(PendingBatch(batch_id, input_file_id, custom_ids))
+        self.__save()
+        logger.info(f"batch {batch_id} of {len(custom_ids)} requests submitted to {self.model.pretty_name()}")
+        return batch_id
+
+    def __download(self, file_id: Optional[str]) -> List[Dict[str, Any]]:
+        if not file_id:
+            return []
+
+        resp = self.__call("GET", f"/files/{file_id}/content")
+        return [json.loads(line) for line in resp.text.splitlines() if line.strip()]
+
+    def collect(self, ingest: Callable[[str, str], None]) -> int:
+        """ Passes the custom id and the answer of every request of the
+        batches that ended to `ingest`, and returns the number of batches
+        still running. A batch is forgotten once all its answers are ingested,
+        so answers may be passed again after a crash. Failed requests are
+        dropped, to be submitted again. """
+        for batch in list(self.__batches):
+            info = self.__call("GET", f"/batches/{batch.id}").json()
+            status = info["status"]
+            if status in RUNNING:
+                continue
+
+            # expired and cancelled batches may have answered part of their requests
+            nanswers = 0
+            for line in self.__download(info.get("output_file_id")):
+                try:
+                    answer = self.model.batch_response(line)
+                except Exception as ex:
+                    logger.warning(f"batch {batch.id}: {line.get('custom_id')}: {ex}")
+                    continue
+
+                ingest(line["custom_id"], answer)
+                nanswers += 1
+
+            for line in self.__download(info.get("error_file_id")):
+                logger.warning(f"batch {batch.id}: {line.get('custom_id')} failed: {line.get('error')}")
+
+            logger.info(f"batch {batch.id} {status}: {nanswers} of {len(batch.custom_ids)} requests answered")
+            self.__batches.remove(batch)
+            self.__save()
+
+        return len(self.__batches)
+
+    def wait(self, ingest: Callable[[str, str], None], timeout: float, interval: float = 60) -> int:
+        """ Collects the answers until every batch ended or `timeout` seconds
+        passed, and returns the number of batches still running. """
+        deadline = monotonic() + timeout
+        nrunning = self.collect(ingest)
+        while nrunning > 0 and monotonic() + interval <= deadline:
+            sleep(interval)
+            nrunning = self.collect(ingest)
+
+        return nrunning
@@ -0,0 +1,135 @@
+""" Caches of chat completions.
+
+A completion is keyed by a hash of everything that determines it: the model,
+its parameters, the system prompt and the messages. Models are queried with
+temperature 0, so asking the same again would only pay for the same answer,
+e.g. when a crashed collector run is resumed or a summary was deleted. """
+from pinhole.storage.sqlite import ConnectionManager
+
+from loguru import logger
+
+from dataclasses import dataclass
+from os import makedirs
+from os.path import dirname
+from threading import Lock
+from time import time
+from typing import Any, Optional
+
+import hashlib
+import json
+
+
+@dataclass
+class CachedCompletion:
+    response: str
+    ninput_tokens: int
+    noutput_tokens: int
+
+
+def completion_key(description: Any) -> str:
+    """ Hashes the json-serializable description of a request. """
+    text = json.dumps(description, ensure_ascii=False, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(text.encode('utf8')).hexdigest()
+
+
+class ResponseCache:
+    """ The interface of the caches, which must be safe to use from several
+    threads at once. """
+
+    def get(self, key: str) -> Optional[CachedCompletion]:
+        raise NotImplementedError
+
+    def put(self, key: str, completion: CachedCompletion) -> None:
+        raise NotImplementedError
+
+
+class SqliteResponseCache(ResponseCache):
+    """ Keeps completions in a sqlite database, dropping those older than
+    `max_age` seconds and the least recently used ones once the responses take
+    more than `max_size` bytes. """
+
+    # the eviction runs once per this many insertions
+    EVICTION_INTERVAL = 100
+
+    def __init__(self, path: str, max_size: int = 1 << 30, max_age: float = 90 * 86400) -> None:
+        if dirname(path):
+            makedirs(dirname(path), exist_ok=True)
+
+        self.path = path
+        self.max_size = max_size
+        self.max_age = max_age
+        self.__connections = ConnectionManager(path)
+        self.__lock = Lock()
+        self.__ninserted = 0
+
+        with self.__connections.transaction() as cursor:
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS completions (
+                    key TEXT PRIMARY KEY,
+                    response TEXT NOT NULL,
+                    ninput_tokens INTEGER NOT NULL,
+                    noutput_tokens INTEGER NOT NULL,
+                    size INTEGER NOT NULL,
+                    created REAL NOT NULL,
+                    accessed REAL NOT NULL
+                )
+            """)
+            cursor.execute("CREATE INDEX IF NOT EXISTS completions_accessed ON completions (accessed)")
+
+        self.evict()
+
+    def get(self, key: str) -> Optional[CachedCompletion]:
+        cursor = self.__connections.cursor()
+        cursor.execute(
+            "SELECT response, ninput_tokens, noutput_tokens FROM completions WHERE key = ? AND created >= ?",
+            (key, time() - self.max_age)
+        )
+        row = cursor.fetchone()
+        if row is None:
+            return None
+
+        with self.__connections.transaction() as cursor:
+            cursor.execute("UPDATE completions SET accessed = ? WHERE key = ?", (time(), key))
+
+        return CachedCompletion(*row)
+
+    def put(self, key: str, completion: CachedCompletion) -> None:
+        now = time()
+        with self.__connections.transaction() as cursor:
+            cursor.execute(
+                "INSERT OR REPLACE INTO completions VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (key, completion.response, completion.ninput_tokens, completion.noutput_tokens,
+                 len(completion.response.encode('utf8')), now, now)
+            )
+
+        with self.__lock:
+            self.__ninserted += 1
+            should_evict = self.__ninserted % self.EVICTION_INTERVAL == 0
+
+        if should_evict:
+            self.evict()
+
+    def evict(self) -> None:
+        with self.__connections.transaction() as cursor:
+            cursor.execute("DELETE FROM completions WHERE created < ?", (time() - self.max_age,))
+            nexpired = cursor.rowcount
+
+            cursor.execute("SELECT COALESCE(SUM(size), 0) FROM completions")
+            excess = cursor.fetchone()[0] - self.max_size
+            nevicted = 0
+            if excess > 0:
+                # the least recently used responses adding up to the excess
+                cursor.execute("""
+                    DELETE FROM completions WHERE key IN (
+                        SELECT key FROM (
+                            SELECT key, size, SUM(size) OVER (ORDER BY accessed, key) AS total FROM completions
+                        ) WHERE total - size < ?
+                    )
+                """, (excess,))
+                nevicted = cursor.rowcount
+
+        if nexpired or nevicted:
+            logger.info(f"response cache: {nexpired} expired and {nevicted} least recently used responses dropped")
+
+    def close(self) -> None:
+        self.__connections.close()
@@ -33,6 +33,10 @@ class DeepSeekChatModel(OpenaiCompatibleChatModel):
     def model_name(self) -> str:
         return self.model.value
 
+    @property
+    def max_concurrency(self) -> int:
+        return 16
+
     def price(self) -> Tuple[float, float, Currency]:
         if self.model is self.Model.DEEPSEEK_CHAT:
             return 1, 2, Currency.CNY
@@ -41,6 +45,14 @@ class DeepSeekChatModel(OpenaiCompatibleChatModel):
 
         raise NotImplementedError(self.model)
 
+    def context_window(self) -> int:
+        if self.model is self.Model.DEEPSEEK_CHAT:
+            return 32768
+        elif self.model is self.Model.DEEPSEEK_CODER:
+            return 16384
+
+        raise NotImplementedError(self.model)
+
     def detect_error(self, response: Any) -> Tuple[bool, str]:
         if 'code' in response:
             if response['code'] == 10003:
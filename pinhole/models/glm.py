@@ -1,12 +1,14 @@
 from pinhole.models.base import ChatModel, ChatContext, Currency
+from pinhole.models.limiter import RateLimited, TransientError, parse_retry_after
+from pinhole.models.tokens import estimate_tokens
 
-from typing import Any, Dict, Tuple, List
+from typing import Any, Callable, Dict, Generator, Optional, Tuple, List
 from os import environ
 from dataclasses import dataclass
 from enum import Enum
 from loguru import logger
 
-from zhipuai import ZhipuAI  # type: ignore
+from zhipuai import ZhipuAI, APIStatusError, APITimeoutError, APIConnectionError  # type: ignore
 
 
 @dataclass
@@ -31,7 +33,8 @@ class GLMChatModel(ChatModel):
     @property
     def client(self) -> ZhipuAI:
         if not hasattr(self, "_client"):
-            client = ZhipuAI(api_key=self.api_key)
+            # retries are left to the limiter of the model
+            client = ZhipuAI(api_key=self.api_key, max_retries=0, timeout=self.limits().timeout)
             setattr(self, "_client", client)
             return client
         else:
@@ -63,20 +66,81 @@ class GLMChatModel(ChatModel):
 
         raise NotImplementedError(self.model)
 
-    def chat(self, context: ChatContext) -> str:
+    def context_window(self) -> int:
+        return 128000
+
+    def __sender(self, messages: List[Any], stream: bool) -> Callable[[float], Any]:
+        def send(timeout: float) -> Any:
+            try:
+                return self.client.chat.completions.create(
+                    model=self.model.value,
+                    messages=messages,
+                    tools=[],
+                    timeout=timeout,
+                    stream=stream
+                )
+            except APIStatusError as ex:
+                if ex.status_code == 429:
+                    raise RateLimited(str(ex), parse_retry_after(ex.response.headers.get("Retry-After")))
+                elif ex.status_code >= 500:
+                    raise TransientError(f"request failed: {ex.status_code}")
+                raise
+            except (APITimeoutError, APIConnectionError) as ex:
+                raise TransientError(f"request failed: {ex}")
+
+        return send
+
+    def __create(self, messages: List[Any]) -> Any:
+        def usage(completion: Any) -> Tuple[int, int]:
+            return completion.usage.prompt_tokens, completion.usage.completion_tokens
+
+        return self.limiter.call(self.__sender(messages, False), self.__estimate_tokens(messages), usage)
+
+    @staticmethod
+    def __estimate_tokens(messages: List[Any]) -> int:
+        return sum(
+            estimate_tokens(message["content"] if isinstance(message, dict) else message.content or "")
+            for message in messages
+        )
+
+    @staticmethod
+    def __messages(context: ChatContext) -> List[Dict[str, str]]:
         messages: List[Dict[str, str]] = []
         messages.append({"role": "system", "content": context.system_prompt})
 
         for r, msg in context.history:
             messages.append({"role": r.value, "content": msg})
 
+        return messages
+
+    def chat_stream(self, context: ChatContext) -> Generator[str, None, None]:
+        messages = self.__messages(context)
+        # the concurrency slot of the model is held until the stream ends
+        stream, lease = self.limiter.open(self.__sender(messages, True), self.__estimate_tokens(messages))
+        self.notify_sent(lease.begin)
+        usage: Optional[Tuple[int, int]] = None
+        try:
+            for chunk in stream:
+                if chunk.usage is not None:
+                    usage = chunk.usage.prompt_tokens, chunk.usage.completion_tokens
+                    self.notify_usage(*usage)
+
+                for choice in chunk.choices:
+                    if choice.delta.content:
+                        yield choice.delta.content
+                    if choice.finish_reason:
+                        self.notify_finish(choice.finish_reason)
+        finally:
+            # stops the generation when the caller leaves early
+            stream.response.close()
+            lease.close(*(usage or (None, None)))
+
+    def chat(self, context: ChatContext) -> str:
+        messages = self.__messages(context)
+
         finish_reason = "not_finished"
         while finish_reason != "stop":
-            completion = self.client.chat.completions.create(
-                model=self.model.value,
-                messages=messages,
-                tools=[]
-            )
+            completion = self.__create(messages)
 
             prompt_tokens = completion.usage.prompt_tokens
             completion_tokens = completion.usage.completion_tokens
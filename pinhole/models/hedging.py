@@ -0,0 +1,199 @@
+""" Hedged chat requests.
+
+A request is sent to its model and, if no answer came within the 95th
+percentile of the latencies observed for that model, the same request is sent
+as well to the next model of the chain whose context window takes it. The
+first successful answer is taken and the other request is ignored: a request
+in flight cannot be withdrawn from the provider, so it completes in the
+background and its usage is still recorded. Hedges are charged to a budget
+per currency and stop once it is spent, and the profiler reports how many were
+sent and won. """
+from pinhole.models.base import ChatContext, ChatModel, Currency
+from pinhole.models.tokens import estimate_tokens
+
+from loguru import logger
+
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, Future, wait
+from dataclasses import dataclass, field
+from threading import Lock, Thread
+from time import monotonic
+from typing import Deque, Dict, List, Optional, Set, Tuple
+
+
+# output tokens assumed for a hedge when reserving its cost
+EXPECTED_OUTPUT_TOKENS = 1000
+
+# the context that answered and the answer
+Answer = Tuple[ChatContext, str]
+# the request of a hedge, its model and the cost reserved for it
+Hedge = Tuple['Future[Answer]', ChatModel, float]
+
+
+class LatencyTracker:
+    """ The latencies of the latest successful requests of a model. """
+
+    def __init__(self, window: int = 200, min_samples: int = 20) -> None:
+        self.min_samples = min_samples
+        self.__samples: Deque[float] = deque(maxlen=window)
+        self.__lock = Lock()
+
+    def observe(self, latency: float) -> None:
+        with self.__lock:
+            self.__samples.append(latency)
+
+    def percentile(self, q: float) -> Optional[float]:
+        """ Returns None until enough requests were seen to tell. """
+        with self.__lock:
+            if len(self.__samples) < self.min_samples:
+                return None
+            samples = sorted(self.__samples)
+
+        return samples[min(int(len(samples) * q), len(samples) - 1)]
+
+
+@dataclass
+class HedgeBudget:
+    """ The amount that may be spent on hedges, per currency. Costs are
+    reserved from an estimate when a hedge is sent and settled on its answer. """
+
+    limits: Dict[Currency, float] = field(default_factory=dict)
+    spent: Dict[Currency, float] = field(default_factory=dict)
+    lock: Lock = field(default_factory=Lock, repr=False, compare=False)
+
+    def reserve(self, currency: Currency, cost: float) -> bool:
+        with self.lock:
+            spent = self.spent.get(currency, 0.0)
+            if spent + cost > self.limits.get(currency, 0.0):
+                return False
+
+            self.spent[currency] = spent + cost
+            return True
+
+    def settle(self, currency: Currency, reserved: float, cost: float) -> None:
+        with self.lock:
+            self.spent[currency] = self.spent.get(currency, 0.0) - reserved + cost
+
+
+def estimate_cost(model: ChatModel, ninput_tokens: int, noutput_tokens: int) -> Tuple[float, Currency]:
+    input_price, output_price, currency = model.price()
+    return (ninput_tokens * input_price + noutput_tokens * output_price) / 1E6, currency
+
+
+@dataclass
+class Hedging:
+    models: List[ChatModel]
+    budget: HedgeBudget = field(default_factory=HedgeBudget)
+    quantile: float = 0.95
+
+    def __post_init__(self) -> None:
+        self.latencies: Dict[ChatModel, LatencyTracker] = {model: LatencyTracker() for model in self.models}
+
+    def __send(self, context: ChatContext, message: str) -> 'Future[Answer]':
+        """ Runs the chat on a thread of its own, which is left running if the
+        answer is not needed anymore. """
+        future: 'Future[Answer]' = Future()
+
+        def run() -> None:
+            begin = monotonic()
+            try:
+                response = context.chat(message)
+            except Exception as ex:
+                future.set_exception(ex)
+                return
+
+            # answers from the response cache say nothing of the model
+            if context.model in self.latencies and not context.cached:
+                self.latencies[context.model].observe(monotonic() - begin)
+            future.set_result((context, response))
+
+        Thread(target=run, daemon=True).start()
+        return future
+
+    def __hedge_model(self, model: ChatModel, ninput_tokens: int) -> Optional[ChatModel]:
+        """ The next model of the chain after `model` whose context window
+        takes the request, since the chunks of a long text are sized for the
+        window of the model they are sent to. """
+        if model not in self.latencies:
+            return None
+
+        for hedge_model in self.models[self.models.index(model) + 1:]:
+            if ninput_tokens + EXPECTED_OUTPUT_TOKENS <= hedge_model.context_window():
+                return hedge_model
+
+        return None
+
+    def __hedge_delay(self, model: ChatModel) -> Optional[float]:
+        if model not in self.latencies:
+            return None
+
+        return self.latencies[model].percentile(self.quantile)
+
+    def chat(self, context: ChatContext, message: str) -> Answer:
+        """ Sends `message` in `context` and returns the context that answered
+        first, which is a fork of `context` possibly using the next model, along
+        with the answer. Raises the error of the model of `context` if neither
+        request succeeds. """
+        first = self.__send(context.fork(), message)
+        pending: Set['Future[Answer]'] = {first}
+        hedge: Optional[Hedge] = None
+
+        text = context.system_prompt + message + "".join(msg for _, msg in context.history)
+        ninput_tokens = estimate_tokens(text)
+        hedge_model = self.__hedge_model(context.model, ninput_tokens)
+        delay = None if hedge_model is None else self.__hedge_delay(context.model)
+        begin = monotonic()
+
+        while True:
+            timeout = None if delay is None else max(delay - (monotonic() - begin), 0)
+            done, pending = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+
+            for future in done:
+                if future.exception() is None:
+                    self.__finish(hedge, won=hedge is not None and future is hedge[0])
+                    return future.result()
+
+            if not pending:
+                self.__finish(hedge, won=False)
+                raise first.exception()  # type: ignore
+
+            if not done and hedge_model is not None:
+                # the hedge is sent at most once
+                delay = None
+                hedge = self.__start_hedge(context, message, hedge_model, ninput_tokens)
+                if hedge is not None:
+                    pending.add(hedge[0])
+
+    def __start_hedge(self, context: ChatContext, message: str, model: ChatModel,
+                      ninput_tokens: int) -> Optional[Hedge]:
+        reserved, currency = estimate_cost(model, ninput_tokens, EXPECTED_OUTPUT_TOKENS)
+        if not self.budget.reserve(currency, reserved):
+            logger.debug(f"hedge budget exhausted, not hedging {context.model.pretty_name()}")
+            return None
+
+        logger.debug(f"{context.model.pretty_name()} is slow, hedging with {model.pretty_name()}")
+        forked = context.fork()
+        forked.model = model
+        return self.__send(forked, message), model, reserved
+
+    def __finish(self, hedge: Optional[Hedge], won: bool) -> None:
+        """ Settles the cost of the hedge, once it answered or when it is not
+        needed anymore, and reports it to the profiler of its model. """
+        if hedge is None:
+            return
+
+        future, model, reserved = hedge
+        _, _, currency = model.price()
+
+        def settle(future: 'Future[Answer]') -> None:
+            cost = 0.0
+            if future.exception() is None:
+                hedged, response = future.result()
+                text = hedged.system_prompt + "".join(msg for _, msg in hedged.history[:-1])
+                cost, _ = estimate_cost(model, estimate_tokens(text), estimate_tokens(response))
+
+            self.budget.settle(currency, reserved, cost)
+            if model.profiler is not None:
+                model.profiler.record_hedge(model, won, cost)
+
+        future.add_done_callback(settle)
@@ -0,0 +1,306 @@
+""" Client-side rate limiting for chat models.
+
+Each model gets a `RateLimiter` shared by all its instances, which combines
+
+  - token buckets on requests/minute and tokens/minute, refilled continuously
+    so that requests are spread at the provider quota rather than sent in
+    bursts that get rejected,
+  - a concurrency limit adjusted AIMD-style: it shrinks by half when the
+    provider answers 429 and by a little when responses slow down, and grows
+    by about one per round of successful requests,
+  - a pause honoring `Retry-After`, applying to every request of the model.
+
+`RateLimiter.call` runs a request under these limits and retries rate
+limitations, timeouts and server errors with capped exponential backoff.
+`RateLimiter.open` does the same for a streamed response, which holds its
+concurrency slot until the stream is closed. """
+from loguru import logger
+
+from dataclasses import dataclass
+from email.utils import parsedate_to_datetime
+from math import inf
+from random import uniform
+from threading import Condition, Lock
+from time import monotonic, sleep, time
+from typing import Callable, Dict, Optional, Tuple, TypeVar
+
+
+T = TypeVar("T")
+
+
+@dataclass(frozen=True)
+class Limits:
+    requests_per_minute: float = inf
+    tokens_per_minute: float = inf
+    max_concurrency: int = 4
+    # seconds a single request may take
+    timeout: float = 300
+    max_retries: int = 5
+
+
+# Limits of the entry tiers of the providers. DeepSeek publishes no quota and
+# throttles by load, so it relies on the adaptive concurrency alone.
+KNOWN_LIMITS: Dict[str, Limits] = {
+    "deepseek-chat": Limits(max_concurrency=16),
+    "deepseek-coder": Limits(max_concurrency=16),
+    "gpt-4": Limits(requests_per_minute=500, tokens_per_minute=10000, max_concurrency=8),
+    "gpt-4o": Limits(requests_per_minute=500, tokens_per_minute=30000, max_concurrency=8),
+    "gpt-3.5-turbo": Limits(requests_per_minute=3500, tokens_per_minute=200000, max_concurrency=8),
+    "glm-4": Limits(max_concurrency=5),
+    "glm-4-air": Limits(max_concurrency=5),
+    "glm-4-flash": Limits(max_concurrency=5),
+}
+
+
+class RateLimited(Exception):
+    """ Raised by a request rejected for exceeding the quota of the provider. """
+
+    def __init__(self, message: str, retry_after: Optional[float] = None) -> None:
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class TransientError(Exception):
+    """ Raised by a request that failed in a way worth retrying, such as a
+    timeout or a server error. """
+
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """ Returns the seconds to wait given by a `Retry-After` header, which is
+    either a number of seconds or an http date. """
+    if not value:
+        return None
+
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+
+    try:
+        return max(parsedate_to_datetime(value).timestamp() - time(), 0.0)
+    except (TypeError, ValueError):
+        return None
+
+
+class TokenBucket:
+    """ Allows `rate` units per minute with bursts of up to `capacity` units.
+
+    Units are reserved ahead, so the balance may go below zero for a request
+    larger than the capacity and later requests wait until it is paid back. """
+
+    def __init__(self, rate: float, capacity: Optional[float] = None) -> None:
+        self.rate = rate / 60
+        # ten seconds worth of units by default
+        self.capacity = capacity if capacity is not None else max(rate / 6, 1)
+        self.__tokens = self.capacity
+        self.__updated = monotonic()
+        self.__lock = Lock()
+
+    def __refill(self, now: float) -> None:
+        self.__tokens = min(self.capacity, self.__tokens + (now - self.__updated) * self.rate)
+        self.__updated = now
+
+    def reserve(self, amount: float) -> float:
+        """ Takes `amount` units and returns the seconds to wait before using them. """
+        if self.rate == inf:
+            return 0.0
+
+        with self.__lock:
+            self.__refill(monotonic())
+            needed = min(amount, self.capacity)
+            delay = max(needed - self.__tokens, 0) / self.rate
+            self.__tokens -= amount
+            return delay
+
+    def available(self) -> float:
+        if self.rate == inf:
+            return inf
+
+        with self.__lock:
+            self.__refill(monotonic())
+            return self.__tokens
+
+    def adjust(self, amount: float) -> None:
+        """ Takes `amount` more units, or gives them back if negative, once the
+        actual usage of a request is known. """
+        if self.rate == inf:
+            return
+
+        with self.__lock:
+            self.__refill(monotonic())
+            self.__tokens = min(self.capacity, self.__tokens - amount)
+
+
+class AdaptiveConcurrency:
+    """ A concurrency limit between `minimum` and `maximum` adjusted by
+    additive increase and multiplicative decrease. """
+
+    def __init__(self, maximum: int, minimum: int = 1) -> None:
+        self.maximum = max(maximum, 1)
+        self.minimum = min(max(minimum, 1), self.maximum)
+        self.limit = float(self.maximum)
+        self.inflight = 0
+        # the fastest seconds per token seen recently, the reference
+        # telling whether the provider slows down under the current load
+        self.baseline: Optional[float] = None
+        self.__cond = Condition()
+
+    def acquire(self) -> None:
+        with self.__cond:
+            while self.inflight >= int(self.limit):
+                self.__cond.wait()
+            self.inflight += 1
+
+    def spare(self) -> int:
+        """ The number of requests that could start right now. """
+        with self.__cond:
+            return int(self.limit) - self.inflight
+
+    def release(self) -> None:
+        with self.__cond:
+            self.inflight -= 1
+            self.__cond.notify()
+
+    def __set_limit(self, limit: float) -> None:
+        self.limit = min(max(limit, self.minimum), self.maximum)
+        self.__cond.notify_all()
+
+    def throttled(self) -> None:
+        with self.__cond:
+            self.__set_limit(self.limit / 2)
+
+    def succeeded(self, latency: float, ninput_tokens: int, noutput_tokens: int) -> None:
+        # reading the prompt is roughly ten times faster per token than
+        # generating, so long prompts with short answers are not taken as slow
+        per_token = latency / max(noutput_tokens + ninput_tokens / 10, 1)
+        with self.__cond:
+            if self.baseline is None or per_token < self.baseline:
+                self.baseline = per_token
+            else:
+                # let the baseline drift up slowly so that one lucky response
+                # does not mark every later one as slow
+                self.baseline = self.baseline * 0.99 + per_token * 0.01
+
+            if per_token > self.baseline * 2:
+                self.__set_limit(self.limit * 0.9)
+            else:
+                self.__set_limit(self.limit + 1 / self.limit)
+
+
+class RateLimiter:
+
+    def __init__(self, name: str, limits: Limits) -> None:
+        self.name = name
+        self.limits = limits
+        self.requests = TokenBucket(limits.requests_per_minute)
+        self.tokens = TokenBucket(limits.tokens_per_minute)
+        self.concurrency = AdaptiveConcurrency(limits.max_concurrency)
+        self.__paused_until = 0.0
+
+    def pause(self, seconds: float) -> None:
+        self.__paused_until = max(self.__paused_until, monotonic() + seconds)
+
+    def has_capacity(self) -> bool:
+        """ Tells whether a request could start now without waiting for a
+        slot, a pause or the quota of requests. """
+        return self.concurrency.spare() > 0 and self.__paused_until <= monotonic() \
+            and self.requests.available() >= 1
+
+    def __wait(self, estimated_tokens: int) -> None:
+        delay = max(self.requests.reserve(1), self.tokens.reserve(estimated_tokens))
+        delay = max(delay, self.__paused_until - monotonic())
+        if delay > 0:
+            sleep(delay)
+
+    def __send(self, send: Callable[[float], T], estimated_tokens: int) -> Tuple[T, float]:
+        """ Runs `send(timeout)` within the limits, retrying it as needed, and
+        returns its result along with the time it was sent. The concurrency
+        slot of a successful request is left to the caller to release. """
+        for attempt in range(self.limits.max_retries + 1):
+            backoff = min(2 ** attempt, 60) * uniform(0.5, 1.0)
+
+            self.concurrency.acquire()
+            try:
+                self.__wait(estimated_tokens)
+                begin = monotonic()
+                return send(self.limits.timeout), begin
+            except RateLimited as ex:
+                self.concurrency.release()
+                self.concurrency.throttled()
+                delay = ex.retry_after if ex.retry_after is not None else backoff
+                # later requests wait for the pause as well
+                self.pause(delay)
+                logger.warning(f"{self.name}: rate limitation reached, retry after {delay:.1f} seconds")
+                last_error: Exception = ex
+            except TransientError as ex:
+                self.concurrency.release()
+                logger.warning(f"{self.name}: {ex}")
+                last_error = ex
+                if attempt < self.limits.max_retries:
+                    sleep(backoff)
+            except BaseException:
+                self.concurrency.release()
+                raise
+
+        raise Exception(f"{self.name}: request failed after {self.limits.max_retries + 1} attempts: {last_error}")
+
+    def __succeeded(self, begin: float, estimated_tokens: int, ninput: int, noutput: int) -> None:
+        self.tokens.adjust(ninput + noutput - estimated_tokens)
+        self.concurrency.succeeded(monotonic() - begin, ninput, noutput)
+
+    def call(self, send: Callable[[float], T], estimated_tokens: int,
+             usage: Callable[[T], Tuple[int, int]]) -> T:
+        """ Runs `send(timeout)` within the limits and returns its result.
+        `usage` tells the (input, output) tokens a result accounts for. """
+        result, begin = self.__send(send, estimated_tokens)
+        self.concurrency.release()
+
+        ninput, noutput = usage(result)
+        self.__succeeded(begin, estimated_tokens, ninput, noutput)
+        return result
+
+    def open(self, send: Callable[[float], T], estimated_tokens: int) -> Tuple[T, 'Lease']:
+        """ Runs `send(timeout)` for a streamed response like `call`, and
+        returns its result along with the lease of its concurrency slot,
+        which must be closed once the stream ends. """
+        result, begin = self.__send(send, estimated_tokens)
+        return result, Lease(self, begin, estimated_tokens, self.__succeeded)
+
+
+class Lease:
+    """ The concurrency slot held by a streamed response, from the time its
+    request was sent until the stream is closed. """
+
+    def __init__(self, limiter: RateLimiter, begin: float, estimated_tokens: int,
+                 succeeded: Callable[[float, int, int, int], None]) -> None:
+        # when the request was sent, after waiting for the limits
+        self.begin = begin
+        self.__limiter = limiter
+        self.__estimated_tokens = estimated_tokens
+        self.__succeeded = succeeded
+        self.__closed = False
+
+    def close(self, ninput_tokens: Optional[int] = None, noutput_tokens: Optional[int] = None) -> None:
+        """ Releases the slot, reporting the whole generation to the limiter
+        if its usage is known, i.e. when the stream was read to its end. """
+        if self.__closed:
+            return
+
+        self.__closed = True
+        self.__limiter.concurrency.release()
+        if ninput_tokens is not None and noutput_tokens is not None:
+            self.__succeeded(self.begin, self.__estimated_tokens, ninput_tokens, noutput_tokens)
+
+
+# the limiters of the models used in this process, by model name
+LIMITERS: Dict[str, RateLimiter] = {}
+LIMITERS_LOCK = Lock()
+
+
+def get_limiter(name: str, limits: Limits) -> RateLimiter:
+    """ Returns the limiter shared by the models named `name`. """
+    with LIMITERS_LOCK:
+        if name not in LIMITERS:
+            LIMITERS[name] = RateLimiter(name, limits)
+
+        return LIMITERS[name]
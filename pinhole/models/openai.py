@@ -1,9 +1,10 @@
 from pinhole.models.base import ChatContext, ChatModel, Currency
+from pinhole.models.limiter import RateLimited, TransientError, parse_retry_after
+from pinhole.models.tokens import estimate_tokens
 
 from loguru import logger
-from typing import Any, Dict, List, Tuple
+from typing import Any, Callable, Dict, Generator, List, Optional, Tuple
 from dataclasses import dataclass
-from time import sleep
 from enum import Enum
 from os import environ
 
@@ -32,6 +33,9 @@ class OpenaiCompatibleChatModel(ChatModel):
     def detect_error(self, response: Any) -> Tuple[bool, str]:
         return False, ""
 
+    def parameters(self) -> Dict[str, Any]:
+        return {"temperature": 0}
+
     def validate(self) -> bool:
         headers = {"Content-Type": "application/json"}
         headers.update(self.headers)
@@ -53,47 +57,144 @@ class OpenaiCompatibleChatModel(ChatModel):
         logger.critical(f"cannot find model {self.model_name} on the API server")
         return False
 
-    def __chat_post(self, headers: Dict[str, str], body: object) -> requests.Response:
-        while True:
-            resp = requests.post(
-                f"{self.api_address}/chat/completions",
-                headers=headers,
-                json=body
-            )
+    @staticmethod
+    def __estimate_tokens(body: Dict[str, Any]) -> int:
+        return sum(estimate_tokens(message["content"] or "") for message in body["messages"])
+
+    def __sender(self, headers: Dict[str, str], body: Dict[str, Any]) -> Callable[[float], Any]:
+        """ Returns the function sending the request to the limiter, which
+        returns the json answer, or the open response of a streaming request. """
+        stream = body.get("stream", False)
+
+        def send(timeout: float) -> Any:
+            try:
+                resp = requests.post(
+                    f"{self.api_address}/chat/completions",
+                    headers=headers,
+                    json=body,
+                    timeout=(10, timeout),
+                    stream=stream
+                )
+            except (requests.ConnectionError, requests.Timeout) as ex:
+                raise TransientError(f"request failed: {ex}")
 
             if resp.status_code == 200:
-                return resp
+                return resp if stream else resp.json()
             elif resp.status_code == 429:
-                logger.warning(f"rate limiatation reached, retry after 10 seconds")
-                sleep(10)
+                # running out of credits is reported with the same status, and
+                # waiting does not help with it
+                if "insufficient_quota" in resp.text:
+                    raise Exception(f"request failed: {resp.text}")
+                raise RateLimited(resp.text, parse_retry_after(resp.headers.get("Retry-After")))
+            elif resp.status_code >= 500:
+                raise TransientError(f"request failed: {resp.status_code}")
             elif resp.status_code == 400:
                 raise Exception(f"request failed: {resp.text}")
             else:
                 logger.warning(resp.text)
                 raise Exception(f"request failed: {resp.status_code}")
 
-    def chat(self, context: ChatContext) -> str:
+        return send
+
+    def __chat_post(self, headers: Dict[str, str], body: Dict[str, Any]) -> Any:
+        def usage(resp_json: Any) -> Tuple[int, int]:
+            # error bodies detected by `detect_error` come without usage
+            counts = resp_json.get("usage", {})
+            return counts.get("prompt_tokens", 0), counts.get("completion_tokens", 0)
+
+        return self.limiter.call(self.__sender(headers, body), self.__estimate_tokens(body), usage)
+
+    def __request(self, context: ChatContext) -> Tuple[Dict[str, str], Dict[str, Any]]:
         messages: List[Dict[str, str]] = []
         messages.append({"role": "system", "content": context.system_prompt})
 
         for r, msg in context.history:
             messages.append({"role": r.value, "content": msg})
 
-        request_body = {
+        request_body: Dict[str, Any] = {
             "model": self.model_name,
             "messages": messages,
-            "temperature": 0
+            **self.parameters()
         }
 
         headers = {"Content-Type": "application/json"}
         headers.update(self.headers)
+        return headers, request_body
+
+    def chat_stream(self, context: ChatContext) -> Generator[str, None, None]:
+        headers, request_body = self.__request(context)
+        request_body["stream"] = True
+        request_body["stream_options"] = {"include_usage": True}
+
+        # the concurrency slot of the model is held until the stream ends
+        resp, lease = self.limiter.open(self.__sender(headers, request_body), self.__estimate_tokens(request_body))
+        self.notify_sent(lease.begin)
+        usage: Optional[Tuple[int, int]] = None
+        try:
+            # server-sent events, one "data: <json>" line per chunk
+            for line in resp.iter_lines():
+                if not line.startswith(b"data:"):
+                    continue
+
+                data = line[5:].strip()
+                if data == b"[DONE]":
+                    break
+
+                chunk = json.loads(data)
+                has_error, reason = self.detect_error(chunk)
+                if has_error:
+                    raise Exception(reason)
+
+                if chunk.get("usage"):
+                    usage = chunk["usage"]["prompt_tokens"], chunk["usage"]["completion_tokens"]
+                    self.notify_usage(*usage)
+
+                for choice in chunk.get("choices", []):
+                    content = choice.get("delta", {}).get("content")
+                    if content:
+                        yield content
+                    if choice.get("finish_reason"):
+                        self.notify_finish(choice["finish_reason"])
+        finally:
+            resp.close()
+            lease.close(*(usage or (None, None)))
+
+    def batch_request(self, custom_id: str, context: ChatContext) -> Dict[str, Any]:
+        """ Returns the line of a batch input file asking for the answer to
+        `context`, which is identified by `custom_id` in the output file. """
+        _, request_body = self.__request(context)
+        return {"custom_id": custom_id, "method": "POST", "url": "/v1/chat/completions", "body": request_body}
+
+    def batch_response(self, line: Dict[str, Any]) -> str:
+        """ Returns the answer in a line of a batch output file, or raises if
+        the request failed or its answer was cut. """
+        if line.get("error"):
+            raise Exception(f"batch request failed: {line['error']}")
+
+        response = line["response"]
+        if response["status_code"] != 200:
+            raise Exception(f"batch request failed: {response['status_code']} {response['body']}")
+
+        resp_json = response["body"]
+        has_error, reason = self.detect_error(resp_json)
+        if has_error:
+            raise Exception(reason)
+
+        self.notify_usage(resp_json["usage"]["prompt_tokens"], resp_json["usage"]["completion_tokens"], batch=True)
+        choice = resp_json["choices"][0]
+        if choice["finish_reason"] != "stop":
+            raise Exception(f"batch answer cut short: {choice['finish_reason']}")
+
+        return choice["message"]["content"]
+
+    def chat(self, context: ChatContext) -> str:
+        headers, request_body = self.__request(context)
+        messages = request_body["messages"]
 
         finish_reason = "not_finished"
         while finish_reason != "stop":
 
-            resp = self.__chat_post(headers, request_body)
-
-            resp_json = resp.json()
+            resp_json = self.__chat_post(headers, request_body)
             has_error, reason = self.detect_error(resp_json)
             if has_error:
                 raise Exception(reason)
@@ -122,10 +223,12 @@ class OpenaiChatModel(OpenaiCompatibleChatModel):
 
     api_key: str = environ.get("OPENAI_API_KEY", "")
     model: Model = Model.GPT_35_TURBO
+    # the address of the api, which may be a compatible server instead
+    base_url: str = environ.get("OPENAI_BASE_URL", "https://api.openai.com/v1")
 
     @property
     def api_address(self) -> str:
-        return "https://api.openai.com/v1"
+        return self.base_url
 
     @property
     def headers(self) -> Dict[str, str]:
@@ -143,6 +246,10 @@ class OpenaiChatModel(OpenaiCompatibleChatModel):
     def support_tool_use(self) -> bool:
         return True
 
+    @property
+    def max_concurrency(self) -> int:
+        return 8
+
     def price(self) -> Tuple[float, float, Currency]:
         if self.model is self.Model.GPT_4:
             return (10, 30, Currency.USD)
@@ -151,5 +258,17 @@ class OpenaiChatModel(OpenaiCompatibleChatModel):
         if self.model is self.Model.GPT_35_TURBO:
             return (0.5, 1.5, Currency.USD)
 
+        raise NotImplementedError(self.model)
+
+    def context_window(self) -> int:
+        if self.model is self.Model.GPT_4:
+            return 8192
+        if self.model is self.Model.GPT_4O:
+            return 128000
+        if self.model is self.Model.GPT_35_TURBO:
+            return 16385
+
+        raise NotImplementedError(self.model)
+
     def __hash__(self) -> int:
         return id(self)
@@ -1,10 +1,12 @@
 from loguru import logger
 
 from enum import Enum
-from dataclasses import dataclass, field
+from dataclasses import dataclass, field, replace
 from collections import OrderedDict
-from typing import List, Tuple, TYPE_CHECKING
+from typing import Dict, List, Optional, Tuple, TYPE_CHECKING
+from statistics import median
 from datetime import datetime
+from threading import Lock
 
 
 if TYPE_CHECKING:
@@ -16,44 +18,171 @@ class Currency(Enum):
     CNY = "CNY"
 
 
+# the value of a unit of each currency in CNY, the currency that spend is
+# compared in
+DEFAULT_RATES: Dict[Currency, float] = {
+    Currency.CNY: 1.0,
+    Currency.USD: 7.2,
+}
+
+
 @dataclass
 class Usage:
     ninput_tokens: int
     noutput_tokens: int
     time: datetime = field(default_factory=datetime.now)
+    # whether the request went through a batch API, billed at its own price
+    batch: bool = False
+
+
+@dataclass
+class StreamTiming:
+    # seconds until the first piece of the answer, None if nothing came
+    time_to_first_token: Optional[float]
+    latency: float
+    noutput_tokens: int
+    cancelled: bool = False
+
+    @property
+    def tokens_per_second(self) -> Optional[float]:
+        if self.time_to_first_token is None or self.latency <= self.time_to_first_token:
+            return None
+
+        return self.noutput_tokens / (self.latency - self.time_to_first_token)
 
 
 @dataclass
 class Statistics:
     model: 'ChatModel'
     usages: List[Usage] = field(default_factory=list)
-
-    def get_token_count(self) -> Tuple[int, int]:
+    # requests sent to the model as hedges of a slow request to another one
+    nhedges: int = 0
+    nhedges_won: int = 0
+    hedge_cost: float = 0.0
+    # usages of the requests answered from the response cache instead
+    saved_usages: List[Usage] = field(default_factory=list)
+    streams: List[StreamTiming] = field(default_factory=list)
+
+    def get_token_count(self, saved: bool = False) -> Tuple[int, int]:
         ninput, noutput = 0, 0
-        for usage in self.usages:
+        for usage in self.saved_usages if saved else self.usages:
             ninput += usage.ninput_tokens
             noutput += usage.noutput_tokens
 
         return ninput, noutput
 
-    def get_token_cost(self) -> Tuple[str, str]:
-        ninput_tokens, noutput_tokens = self.get_token_count()
-        input_price, output_price, currency = self.model.price()
+    def get_cost(self, saved: bool = False) -> Tuple[float, float, Currency]:
+        """ Returns (cost of the input tokens, cost of the output tokens, currency unit) """
+        input_cost, output_cost = 0.0, 0.0
+        for usage in self.saved_usages if saved else self.usages:
+            input_price, output_price, currency = self.model.batch_price() if usage.batch else self.model.price()
+            input_cost += usage.ninput_tokens / 1E6 * input_price
+            output_cost += usage.noutput_tokens / 1E6 * output_price
+
+        _, _, currency = self.model.price()
+        return input_cost, output_cost, currency
 
-        input_cost = ninput_tokens / 1E6 * input_price
-        output_cost = noutput_tokens / 1E6 * output_price
+    def get_token_cost(self, saved: bool = False) -> Tuple[str, str]:
+        ninput_tokens, noutput_tokens = self.get_token_count(saved)
+        input_cost, output_cost, currency = self.get_cost(saved)
 
         str_input_cost = f"{ninput_tokens} ({input_cost:.3f}{currency.value})"
         str_output_cost = f"{noutput_tokens} ({output_cost:.3f}{currency.value})"
         return str_input_cost, str_output_cost
 
+    def get_stream_summary(self) -> str:
+        ttfts = [s.time_to_first_token for s in self.streams if s.time_to_first_token is not None]
+        speeds = [s.tokens_per_second for s in self.streams if s.tokens_per_second is not None]
+        latencies = [s.latency for s in self.streams]
+        ncancelled = sum(1 for s in self.streams if s.cancelled)
+
+        summary = f"{len(self.streams)} streams ({ncancelled} cancelled), median latency {median(latencies):.2f}s"
+        if ttfts:
+            summary += f", median time to first token {median(ttfts):.2f}s"
+        if speeds:
+            summary += f", median {median(speeds):.1f} tokens/s"
+        return summary
+
 
 @dataclass
 class Profiler:
     stats: OrderedDict['ChatModel', Statistics] = field(default_factory=OrderedDict)
+    # models report their usage from the threads of concurrent summarizations
+    lock: Lock = field(default_factory=Lock, repr=False, compare=False)
+    rates: Dict[Currency, float] = field(default_factory=lambda: dict(DEFAULT_RATES))
+    # the spend expected by the router for the requests it routed, in CNY
+    projected_spend: float = 0.0
+    nprojections: int = 0
+
+    def to_cny(self, amount: float, currency: Currency) -> float:
+        return amount * self.rates[currency]
+
+    def record_projection(self, cost: float) -> None:
+        with self.lock:
+            self.projected_spend += cost
+            self.nprojections += 1
+
+    def get_spend(self) -> float:
+        """ Returns the actual spend of all the models so far, in CNY. """
+        with self.lock:
+            costs = [stats.get_cost() for stats in self.stats.values()]
+
+        return sum(self.to_cny(input_cost + output_cost, currency) for input_cost, output_cost, currency in costs)
+
+    def record_usage(self, model: 'ChatModel', usage: Usage) -> None:
+        with self.lock:
+            if model not in self.stats:
+                self.stats[model] = Statistics(model)
+
+            self.stats[model].usages.append(usage)
+
+    def record_saved_usage(self, model: 'ChatModel', usage: Usage) -> None:
+        with self.lock:
+            if model not in self.stats:
+                self.stats[model] = Statistics(model)
+
+            self.stats[model].saved_usages.append(usage)
+
+    def record_stream(self, model: 'ChatModel', timing: StreamTiming) -> None:
+        with self.lock:
+            if model not in self.stats:
+                self.stats[model] = Statistics(model)
+
+            self.stats[model].streams.append(timing)
+
+    def record_hedge(self, model: 'ChatModel', won: bool, cost: float) -> None:
+        with self.lock:
+            if model not in self.stats:
+                self.stats[model] = Statistics(model)
+
+            stats = self.stats[model]
+            stats.nhedges += 1
+            stats.nhedges_won += 1 if won else 0
+            stats.hedge_cost += cost
 
     def print_stats(self) -> None:
+        with self.lock:
+            items = [
+                (model, replace(stats, usages=list(stats.usages), saved_usages=list(stats.saved_usages),
+                                streams=list(stats.streams)))
+                for model, stats in self.stats.items()
+            ]
+
         logger.info("========== model profiling statistics ==========")
-        for model, stats in self.stats.items():
+        for model, stats in items:
             input_cost, output_cost = stats.get_token_cost()
             logger.info(f"{model.pretty_name()}: input-tokens {input_cost}, output-tokens {output_cost}")
+            if stats.saved_usages:
+                input_cost, output_cost = stats.get_token_cost(saved=True)
+                logger.info(f"{model.pretty_name()}: {len(stats.saved_usages)} responses from the cache saved "
+                            f"input-tokens {input_cost}, output-tokens {output_cost}")
+            if stats.streams:
+                logger.info(f"{model.pretty_name()}: {stats.get_stream_summary()}")
+            if stats.nhedges > 0:
+                _, _, currency = model.price()
+                logger.info(f"{model.pretty_name()}: {stats.nhedges} hedges, {stats.nhedges_won} won, "
+                            f"costing {stats.hedge_cost:.3f}{currency.value}")
+
+        if self.nprojections > 0:
+            logger.info(f"spend of {self.nprojections} routed requests: projected {self.projected_spend:.3f}CNY, "
+                        f"actual {self.get_spend():.3f}CNY in total")
@@ -0,0 +1,82 @@
+""" Routing of requests to the cheapest model that can serve them.
+
+The models of a router are ranked for each request by the cost of the request
+in CNY, converted from the currency of each model at configured rates. Models
+whose context window cannot take the input come last, as they can only serve
+it part by part, and so do models without spare rate-limit capacity at the
+time of routing, so that a saturated provider is not queued up further while
+another one idles. The chain is tried in order, escalating to the next model
+when one fails or gives an answer too poor to keep, and the cost expected from
+the first model is reported to the profiler next to the actual spend. """
+from pinhole.models.base import ChatContext, ChatModel, Currency
+from pinhole.models.profiler import DEFAULT_RATES, Profiler
+
+from dataclasses import dataclass, field
+from typing import Callable, Dict, List, Optional, Tuple
+
+import re
+
+
+# phrases models start their answer with when they decline a request
+REFUSALS = re.compile(r"^\s*(I'm sorry|I am sorry|I cannot|I can't|Sorry|抱歉|对不起|很抱歉|我无法|我不能)", re.IGNORECASE)
+
+
+class LowQualityAnswer(Exception):
+    """ Raised for an answer not worth keeping, so that the request is
+    escalated to the next model. """
+
+
+@dataclass
+class Router:
+    models: List[ChatModel]
+    # the value of a unit of each currency in CNY
+    rates: Dict[Currency, float] = field(default_factory=lambda: dict(DEFAULT_RATES))
+    # output tokens expected for an answer
+    answer_tokens: int = 2048
+    # answers shorter than this many characters are taken as failures
+    min_answer_length: int = 50
+    profiler: Optional[Profiler] = None
+
+    def cost(self, model: ChatModel, ninput_tokens: int, noutput_tokens: int) -> float:
+        """ The cost of a request in CNY. """
+        input_price, output_price, currency = model.price()
+        return (ninput_tokens * input_price + noutput_tokens * output_price) / 1E6 * self.rates[currency]
+
+    def fits(self, model: ChatModel, ninput_tokens: int) -> bool:
+        return ninput_tokens + self.answer_tokens <= model.context_window()
+
+    def by_cost(self) -> List[ChatModel]:
+        """ The models from the cheapest to the most expensive for a typical
+        request, e.g. as the chain of a `Hedging`. """
+        return sorted(self.models, key=lambda model: self.cost(model, self.answer_tokens, self.answer_tokens))
+
+    def route(self, ninput_tokens: int) -> List[ChatModel]:
+        """ Returns the models to try in order for a request of
+        `ninput_tokens` estimated input tokens. """
+        def rank(model: ChatModel) -> Tuple[bool, bool, float]:
+            return (
+                not self.fits(model, ninput_tokens),
+                not model.limiter.has_capacity(),
+                self.cost(model, ninput_tokens, self.answer_tokens),
+            )
+
+        chain = sorted(self.models, key=rank)
+        if self.profiler is not None and chain:
+            self.profiler.record_projection(self.cost(chain[0], ninput_tokens, self.answer_tokens))
+
+        return chain
+
+    def acceptable(self, answer: str) -> bool:
+        return len(answer.strip()) >= self.min_answer_length and not REFUSALS.match(answer)
+
+    def checked(self, chat: Callable[[ChatContext, str], Tuple[ChatContext, str]]) \
+            -> Callable[[ChatContext, str], Tuple[ChatContext, str]]:
+        """ Wraps a chat function, such as `Hedging.chat`, to raise
+        `LowQualityAnswer` for the answers that are not acceptable. """
+        def checked_chat(context: ChatContext, message: str) -> Tuple[ChatContext, str]:
+            answered, answer = chat(context, message)
+            if not self.acceptable(answer):
+                raise LowQualityAnswer(f"{answered.model.pretty_name()} gave a poor answer: {answer[:80]!r}")
+            return answered, answer
+
+        return checked_chat
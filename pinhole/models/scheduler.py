@@ -0,0 +1,256 @@
+""" Runs tasks against chat models concurrently.
+
+Every backend (the class of a model, such as DeepSeek or OpenAI) gets its own
+queue and as many worker threads as its `max_concurrency`, so a slow or
+saturated provider never holds back the others. A task is tried with the
+models of the scheduler in order, or with its own: when a model fails, the
+task is queued for the next one and the worker moves on to other tasks
+instead of waiting for the retry. Queued tasks are taken newest first, and a
+publisher weight makes the items of a publisher look proportionally newer.
+
+A task may instead rank its models itself, e.g. with `Router.route`, which is
+then done when the task is about to run and again after each failure, so that
+the ranking reflects the load of the providers at that time. Such tasks wait
+in a shared queue from which the workers of every backend take them, and a
+worker hands a task to another backend only if it has an idle worker. """
+from pinhole.models.base import ChatModel
+
+from loguru import logger
+
+from dataclasses import dataclass, field
+from datetime import datetime
+from enum import Enum
+from heapq import heappop, heappush
+from itertools import count
+from queue import Empty, Queue
+from threading import Condition, Thread
+from time import monotonic
+from typing import Callable, Dict, Generic, Iterable, Iterator, List, Optional, Tuple, Type, TypeVar
+
+
+T = TypeVar("T")
+
+
+class TaskAbandoned(Exception):
+    """ Raised by a task that cannot succeed with any model, e.g. when its
+    input cannot be loaded, so that the remaining models are not tried. """
+
+
+@dataclass
+class Task(Generic[T]):
+    name: str
+    run: Callable[[ChatModel], T]
+    date: datetime
+    publisher: str = ""
+    # the models to try in order, instead of those of the scheduler; their
+    # backends must be among the scheduler's
+    models: Optional[List[ChatModel]] = None
+    # ranks the models to try when the task is about to run, e.g. with a
+    # `Router`, taking precedence over `models`; models whose backend is not
+    # scheduled are skipped
+    route: Optional[Callable[[], List[ChatModel]]] = None
+
+
+class Status(Enum):
+    DONE = "done"
+    FAILED = "failed"
+    EXPIRED = "expired"
+
+
+@dataclass
+class Outcome(Generic[T]):
+    task: Task[T]
+    status: Status
+    result: Optional[T] = None
+    model: Optional[ChatModel] = None
+
+
+# (priority, sequence number, task, the models in order, index of the model
+# to try), the models of a task waiting to be routed being left empty
+Entry = Tuple[float, int, Task, List[ChatModel], int]
+
+
+@dataclass
+class Scheduler:
+    models: List[ChatModel]
+    # seconds from the start of `run` after which no task is started anymore
+    deadline: Optional[float] = None
+    weights: Dict[str, float] = field(default_factory=dict)
+
+    def __post_init__(self) -> None:
+        for publisher, weight in self.weights.items():
+            if not weight > 0:
+                raise ValueError(f"the weight of {publisher} must be positive, got {weight}")
+
+    def priority(self, task: Task, now: datetime) -> float:
+        """ Tasks with lower values run first. """
+        age = (now - task.date).total_seconds()
+        return age / self.weights.get(task.publisher, 1.0)
+
+    def chain(self, task: Task) -> List[ChatModel]:
+        if task.route is not None:
+            return [model for model in task.route() if type(model) in self.__backends()]
+        return task.models or self.models
+
+    def __backends(self) -> Dict[Type[ChatModel], int]:
+        backends: Dict[Type[ChatModel], int] = {}
+        for model in self.models:
+            backends.setdefault(type(model), model.max_concurrency)
+        return backends
+
+    def run(self, tasks: Iterable[Task[T]]) -> Iterator[Outcome[T]]:
+        """ Runs the tasks and yields their outcomes as they complete.
+
+        Tasks not started when the deadline is reached are yielded as expired,
+        while the requests in flight are allowed to finish. The outcomes are
+        yielded on the calling thread, so they can be stored without locking. """
+        backends = self.__backends()
+        queues: Dict[Type[ChatModel], List[Entry]] = {backend: [] for backend in backends}
+        # the routed tasks that have not been tried yet
+        unrouted: List[Entry] = []
+        # the workers of each backend waiting for a task
+        idle: Dict[Type[ChatModel], int] = {backend: 0 for backend in backends}
+        cond = Condition()
+        outcomes: 'Queue[Outcome[T]]' = Queue()
+        sequence = count()
+        deadline = None if self.deadline is None else monotonic() + self.deadline
+        closed = False
+
+        def push(task: Task[T], chain: List[ChatModel], index: int, priority: float) -> None:
+            with cond:
+                heappush(queues[type(chain[index])], (priority, next(sequence), task, chain, index))
+                cond.notify_all()
+
+        def route(backend: Type[ChatModel], entry: Entry) -> Optional[Entry]:
+            """ Ranks the models of a task taken from `unrouted`, and returns
+            its entry if this worker is to run it, or queues it for the first
+            model whose backend has an idle worker. Called with `cond` held. """
+            priority, _, task, _, _ = entry
+            chain = self.chain(task)
+            if not chain:
+                logger.warning(f"task {task.name} has no model of the scheduled backends")
+                outcomes.put(Outcome(task, Status.FAILED))
+                return None
+
+            # the first model that can start right away is tried first and the
+            # others follow in order, the task waiting for the first model of
+            # the chain when every backend is busy
+            for index, model in enumerate(chain):
+                if type(model) is backend or idle[type(model)] > len(queues[type(model)]):
+                    chain = [model] + chain[:index] + chain[index + 1:]
+                    break
+
+            if type(chain[0]) is backend:
+                return (priority, next(sequence), task, chain, 0)
+
+            heappush(queues[type(chain[0])], (priority, next(sequence), task, chain, 0))
+            cond.notify_all()
+            return None
+
+        def take(backend: Type[ChatModel]) -> Optional[Entry]:
+            queue = queues[backend]
+            with cond:
+                idle[backend] += 1
+                try:
+                    while True:
+                        while not queue and not unrouted and not closed:
+                            cond.wait()
+                        if not queue and not unrouted:
+                            return None
+
+                        # the entries are ordered by their priority and sequence number
+                        if queue and (not unrouted or queue[0][:2] <= unrouted[0][:2]):
+                            return heappop(queue)
+
+                        entry = route(backend, heappop(unrouted))
+                        if entry is not None:
+                            return entry
+                finally:
+                    idle[backend] -= 1
+
+        def work(backend: Type[ChatModel]) -> None:
+            while True:
+                entry = take(backend)
+                if entry is None:
+                    return
+                priority, _, task, chain, index = entry
+
+                if deadline is not None and monotonic() >= deadline:
+                    outcomes.put(Outcome(task, Status.EXPIRED))
+                    continue
+
+                model = chain[index]
+                try:
+                    outcomes.put(Outcome(task, Status.DONE, task.run(model), model))
+                except TaskAbandoned as ex:
+                    logger.warning(f"task {task.name} abandoned: {ex}")
+                    outcomes.put(Outcome(task, Status.FAILED))
+                except Exception as ex:
+                    logger.warning(f"model {model.pretty_name()} reports failure on {task.name}: {ex}")
+                    if task.route is not None:
+                        # the models not tried yet are ranked again
+                        tried = chain[:index + 1]
+                        chain = tried + [m for m in self.chain(task) if m not in tried]
+
+                    if index + 1 < len(chain):
+                        push(task, chain, index + 1, priority)
+                    else:
+                        outcomes.put(Outcome(task, Status.FAILED))
+
+        def expire() -> List[Outcome[T]]:
+            expired: List[Outcome[T]] = []
+            with cond:
+                for queue in [unrouted, *queues.values()]:
+                    expired.extend(Outcome(entry[2], Status.EXPIRED) for entry in queue)
+                    queue.clear()
+
+            return expired
+
+        now = datetime.now()
+        pending = 0
+        for task in tasks:
+            if task.route is not None:
+                with cond:
+                    heappush(unrouted, (self.priority(task, now), next(sequence), task, [], 0))
+                    cond.notify_all()
+                pending += 1
+                continue
+
+            chain = self.chain(task)
+            for model in chain:
+                if type(model) not in queues:
+                    raise ValueError(f"task {task.name} uses {model.pretty_name()}, whose backend is not scheduled")
+            push(task, chain, 0, self.priority(task, now))
+            pending += 1
+
+        workers = [
+            Thread(target=work, args=(backend,), daemon=True)
+            for backend, concurrency in backends.items()
+            for _ in range(max(concurrency, 1))
+        ]
+        for worker in workers:
+            worker.start()
+
+        wait_until = deadline
+        try:
+            while pending > 0:
+                timeout = None if wait_until is None else max(wait_until - monotonic(), 0)
+                try:
+                    outcome = outcomes.get(timeout=timeout)
+                except Empty:
+                    logger.warning("deadline reached, tasks that have not started are dropped")
+                    for outcome in expire():
+                        pending -= 1
+                        yield outcome
+
+                    # the workers expire the tasks that are queued from now on
+                    wait_until = None
+                    continue
+
+                pending -= 1
+                yield outcome
+        finally:
+            expire()
+            with cond:
+                closed = True
+                cond.notify_all()
@@ -0,0 +1,139 @@
+""" Summarization of texts that do not fit in the context window of a model.
+
+A text that fits is summarized with a single request as usual. A longer one is
+split into chunks sized to the window, at markdown headings where possible,
+the chunks are summarized in parallel (map), and the final summary is written
+from the partial ones (reduce). If the partial summaries are still too long,
+they are summarized again the same way first. """
+from pinhole.models.base import ChatContext, ChatModel
+from pinhole.models.tokens import estimate_tokens
+
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import Callable, List, Tuple
+
+import re
+
+
+# sends a message in a context and returns the context that answered, along
+# with the answer, like `Hedging.chat`
+Chat = Callable[[ChatContext, str], Tuple[ChatContext, str]]
+
+# the levels of markdown headings, then paragraphs, then lines
+NLEVELS = 8
+
+
+def plain_chat(context: ChatContext, message: str) -> Tuple[ChatContext, str]:
+    return context, context.chat(message)
+
+
+def split_at(text: str, level: int) -> List[str]:
+    """ Splits the text before each heading of the given level (1 to 6), or at
+    blank lines (7) or line ends (8), keeping the separators. """
+    if level <= 6:
+        pattern = re.compile(rf"^#{{{level}}}\s", re.MULTILINE)
+        positions = [m.start() for m in pattern.finditer(text) if m.start() > 0]
+    elif level == 7:
+        positions = [m.end() for m in re.finditer(r"\n\s*\n", text) if m.end() < len(text)]
+    else:
+        positions = [m.end() for m in re.finditer(r"\n", text) if m.end() < len(text)]
+
+    bounds = [0] + positions + [len(text)]
+    return [text[begin:end] for begin, end in zip(bounds, bounds[1:])]
+
+
+def split_pieces(text: str, max_tokens: int, level: int = 1) -> List[str]:
+    if estimate_tokens(text) <= max_tokens:
+        return [text]
+
+    if level > NLEVELS:
+        # a single line too long, cut at the proportional length
+        size = max(int(len(text) * max_tokens / estimate_tokens(text) * 0.9), 1)
+        return [text[i:i + size] for i in range(0, len(text), size)]
+
+    parts = split_at(text, level)
+    if len(parts) == 1:
+        return split_pieces(text, max_tokens, level + 1)
+
+    return [piece for part in parts for piece in split_pieces(part, max_tokens, level + 1)]
+
+
+def split_markdown(text: str, max_tokens: int) -> List[str]:
+    """ Splits a markdown text into chunks of at most `max_tokens` estimated
+    tokens. Sections are cut at their largest headings first, and consecutive
+    pieces are packed together as long as they fit. """
+    chunks: List[str] = []
+    current: List[str] = []
+    ntokens = 0
+    for piece in split_pieces(text, max_tokens):
+        npiece = estimate_tokens(piece)
+        if current and ntokens + npiece > max_tokens:
+            chunks.append("".join(current))
+            current, ntokens = [], 0
+
+        current.append(piece)
+        ntokens += npiece
+
+    if current:
+        chunks.append("".join(current))
+
+    return chunks
+
+
+@dataclass
+class ChunkedSummarizer:
+    system_prompt: str
+    # asks for the summary of a whole text, with {title} and {content}
+    prompt_template: str
+    # asks for the notes on a part of a text, with {title}, {index}, {total}
+    # and {content}
+    map_template: str
+    # asks for the summary of a text from the notes on its parts, with {title}
+    # and {content}
+    reduce_template: str
+    chat: Chat = field(default=plain_chat)
+    # tokens of the window kept free for the answer
+    answer_tokens: int = 4096
+    max_workers: int = 4
+
+    def budget(self, model: ChatModel, template: str, title: str) -> int:
+        """ The tokens left for the content in a request with `template`. """
+        overhead = estimate_tokens(self.system_prompt + template + title)
+        return model.context_window() - self.answer_tokens - overhead
+
+    def __map(self, model: ChatModel, title: str, chunks: List[str]) -> List[str]:
+        def summarize_chunk(index: int) -> str:
+            context = ChatContext(model, system_prompt=self.system_prompt)
+            message = self.map_template.format(
+                title=title, index=index + 1, total=len(chunks), content=chunks[index]
+            )
+            _, notes = self.chat(context, message)
+            return f"[{index + 1}/{len(chunks)}]\n{notes}"
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            return list(executor.map(summarize_chunk, range(len(chunks))))
+
+    def summarize(self, model: ChatModel, title: str, content: str) -> Tuple[ChatContext, str]:
+        """ Summarizes `content` with `model` and returns the context that
+        wrote the final summary, along with the summary. """
+        context = ChatContext(model, system_prompt=self.system_prompt)
+        if estimate_tokens(content) <= self.budget(model, self.prompt_template, title):
+            return self.chat(context, self.prompt_template.format(title=title, content=content))
+
+        map_budget = self.budget(model, self.map_template, title)
+        reduce_budget = self.budget(model, self.reduce_template, title)
+        if min(map_budget, reduce_budget) <= 0:
+            raise Exception(f"the window of {model.pretty_name()} is too small to summarize {title}")
+
+        notes = content
+        ntokens = estimate_tokens(notes)
+        while ntokens > reduce_budget:
+            chunks = split_markdown(notes, map_budget)
+            notes = "\n\n".join(self.__map(model, title, chunks))
+
+            # notes as long as their text would never fit
+            previous, ntokens = ntokens, estimate_tokens(notes)
+            if ntokens >= previous:
+                raise Exception(f"the notes on {title} do not get shorter than the text")
+
+        return self.chat(context, self.reduce_template.format(title=title, content=notes))
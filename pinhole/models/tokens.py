@@ -0,0 +1,40 @@
+""" A fast local estimate of the number of tokens of a text.
+
+Tokenizers differ between providers and none of them is available offline, so
+the estimate counts the kinds of characters instead and errs on the high side
+for the tokenizers of the supported models: an english word is 1.3 tokens on
+average, or four letters for long words, a CJK character at most one token,
+numbers are split into groups of two or three digits, and most punctuation and
+markup symbols are tokens on their own. """
+import re
+
+
+WORDS = re.compile(r"[A-Za-z]+")
+CJK = re.compile(r"[\u3000-\u303f\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af\uff00-\uffef]")
+DIGITS = re.compile(r"[0-9]")
+SPACES = re.compile(r"\s")
+
+
+def estimate_tokens(text: str) -> int:
+    words = WORDS.findall(text)
+    nwords = len(words)
+    nletters = sum(map(len, words))
+    ncjk = len(CJK.findall(text))
+    ndigits = len(DIGITS.findall(text))
+    nspaces = len(SPACES.findall(text))
+
+    nothers = len(text) - nletters - ncjk - ndigits - nspaces
+    # long runs of letters such as identifiers are split every few letters
+    nword_tokens = max(nwords * 1.3, nletters / 4)
+    return int(nword_tokens + ncjk + ndigits / 2 + nothers * 0.8) + 1
+
+
+# the utf-8 bytes per token of texts sized up without being read: a CJK
+# character takes three bytes and is a token, while english text takes about
+# four bytes per token, so the estimate errs on the high side like the other
+BYTES_PER_TOKEN = 3
+
+
+def estimate_tokens_of_size(nbytes: int) -> int:
+    """ A rougher estimate from the size of a text in utf-8 bytes alone. """
+    return nbytes // BYTES_PER_TOKEN + 1
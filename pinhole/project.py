@@ -1,20 +1,120 @@
 from pinhole.datasource.document import Document, DocumentRef
 from pinhole.datasource.summary import Summary
-from pinhole.datasource.publication import Publication, PublicationRef
+from pinhole.datasource.publication import Publication, PublicationRef, PublicationType
+from pinhole.datasource.search import SearchHit, SearchKind
 from pinhole.user import User, UserRef, AuthRequest
+from pinhole.storage.sqlite import ConnectionManager
+from pinhole.storage.bloom import BloomFilter
+from pinhole.storage.schema import migrate
 
 from pydantic.dataclasses import dataclass, Field
 from pydantic.root_model import RootModel
 
-from os.path import realpath, join, isdir
-from os import makedirs
-from typing import Optional, List, Any, Dict
+from collections import OrderedDict
+from os.path import realpath, join, isdir, exists
+from os import getpid, makedirs, remove
+from threading import Lock
+from typing import Optional, List, Any, AsyncIterator, Callable, Dict, Iterator, Set, Tuple, TypeVar, Union
+from urllib.parse import urlencode
 from datetime import datetime
+from time import time
+from weakref import WeakKeyDictionary
 
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+import asyncio
+import httpx
+import json
 import requests
 import sqlite3
 
 
+# the number of host parameters bound in a single statement is kept below the
+# SQLITE_MAX_VARIABLE_NUMBER of older sqlite releases (999)
+MAX_SQL_VARIABLES = 900
+
+
+# position of a ref in the (date, id) ordering used by all list queries,
+# refs are listed from the newest to the oldest
+RefCursor = Tuple[datetime, int]
+
+
+# the number of changes made to a table so far, and the time of the last one
+TableVersion = Tuple[int, float]
+
+
+T = TypeVar("T")
+
+
+# bm25 weights of the title, authors, body and summary columns of the search indexes
+SEARCH_COLUMN_WEIGHTS = (10.0, 2.0, 1.0, 4.0)
+
+# the recency boost subtracted from bm25 scores, halved for entries SEARCH_RECENCY_HALF_LIFE seconds old
+SEARCH_RECENCY_WEIGHT = 2.0
+SEARCH_RECENCY_HALF_LIFE = 30 * 86400.0
+
+
+def fts_query(query: str) -> str:
+    """ Turns free text into an fts5 query matching entries that contain all of
+    its words, each word also matching as a prefix. """
+    terms = []
+    for word in query.split():
+        terms.append('"' + word.replace('"', '""') + '"*')
+
+    return " ".join(terms)
+
+
+def ref_list_params(limit: Optional[int],
+                    before: Optional[RefCursor],
+                    after: Optional[RefCursor],
+                    since: Optional[datetime],
+                    **filters: Optional[str]) -> Dict[str, Any]:
+    """ Encodes the arguments of `get_*_refs` as the query parameters of a list endpoint. """
+    params: Dict[str, Any] = {"limit": limit}
+    if before is not None:
+        params["before_date"] = before[0].isoformat()
+        params["before_id"] = before[1]
+    if after is not None:
+        params["after_date"] = after[0].isoformat()
+        params["after_id"] = after[1]
+    if since is not None:
+        params["since"] = since.isoformat()
+
+    params.update(filters)
+    return params
+
+
+def api_path(path: str, **params: Any) -> str:
+    """ Appends the query of `params` to the path of an apiserver endpoint,
+    leaving out the parameters that are None. List values are repeated. """
+    query = urlencode({k: v for k, v in params.items() if v is not None}, doseq=True)
+    return f"{path}?{query}" if query else path
+
+
+def decode_response(req: Union[requests.Response, httpx.Response], url: str) -> Dict[str, Any]:
+    """ Returns the json body of an apiserver response, raising if the request failed. """
+    if req.status_code != 200:
+        raise Exception(f"request failed with status code {req.status_code}: {req.text} in {url}")
+
+    resp = req.json()
+    if resp is None:
+        raise Exception(f"request failed because response is not a valid json: {req.text}")
+
+    if resp['succeeded'] is False:
+        raise Exception(f"request failed: {resp['message']} in {url}")
+
+    return resp
+
+
+def optional(decode: Callable[[Any], T], value: Any) -> Optional[T]:
+    return None if value is None else decode(value)
+
+
+def chunked(items: List[T], size: int) -> List[List[T]]:
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+
 class AbstractProject:
     """ The abstract base class for `RemoteProject` and `Project`. The design aims
     to guarantee that the API interface of the two types of projects remain exactly
@@ -29,10 +129,51 @@ class AbstractProject:
     def create_document(self, document: Document) -> None:
         raise NotImplementedError
 
+    def create_documents(self, documents: List[Document]) -> List[int]:
+        """ Stores documents in one go, skipping those whose url is already known.
+        Returns the id of each given document, or -1 if it could not be stored. """
+        raise NotImplementedError
+
     def get_document(self, document_id: int) -> Optional[Document]:
         raise NotImplementedError
 
-    def get_document_refs(self) -> List[DocumentRef]:
+    def get_document_by_url(self, url: str) -> Optional[Document]:
+        raise NotImplementedError
+
+    def get_documents(self, document_ids: List[int]) -> List[Optional[Document]]:
+        """ Fetches several documents at once, the result is aligned with
+        `document_ids` and holds None for unknown ids. """
+        raise NotImplementedError
+
+    def get_document_sizes(self, document_ids: List[int]) -> List[Optional[int]]:
+        """ Returns the size in bytes of the utf-8 content of several documents,
+        aligned with `document_ids` like `get_documents`, so that they can be
+        sized up without being downloaded. """
+        raise NotImplementedError
+
+    def get_unsummarized_document_refs(self, limit: Optional[int] = None) -> List[DocumentRef]:
+        """ Lists the documents that have no summary yet, newest first. """
+        raise NotImplementedError
+
+    def get_document_refs(self,
+                          limit: Optional[int] = None,
+                          before: Optional[RefCursor] = None,
+                          after: Optional[RefCursor] = None,
+                          since: Optional[datetime] = None,
+                          publisher: Optional[str] = None) -> List[DocumentRef]:
+        """ Lists documents from the newest to the oldest. `before` and `after`
+        are the (date, id) of refs returned by an earlier call, and only refs
+        strictly older or newer than them are listed respectively. When only
+        `after` is given, the `limit` refs right after the cursor are returned
+        so that pages can be walked in both directions. """
+        raise NotImplementedError
+
+    def iter_document_refs(self,
+                           since: Optional[datetime] = None,
+                           publisher: Optional[str] = None,
+                           batch_size: int = 1000) -> Iterator[DocumentRef]:
+        """ Iterates over all documents from the newest to the oldest. Refs are
+        fetched `batch_size` at a time, so memory use does not grow with the table. """
         raise NotImplementedError
 
     def create_summary(self, summary: Summary) -> None:
@@ -44,129 +185,622 @@ class AbstractProject:
     def get_summary_of_publication(self, publication_id: int) -> Optional[Summary]:
         raise NotImplementedError
 
+    def get_summaries_of_documents(self, document_ids: List[int]) -> List[Optional[Summary]]:
+        """ Fetches the summaries of several documents at once, the result is
+        aligned with `document_ids` and holds None for unsummarized ones. """
+        raise NotImplementedError
+
+    def get_summaries_of_publications(self, publication_ids: List[int]) -> List[Optional[Summary]]:
+        """ Fetches the summaries of several publications like `get_summaries_of_documents`. """
+        raise NotImplementedError
+
     def create_publication(self, publication: Publication) -> None:
         raise NotImplementedError
 
+    def create_publications(self, publications: List[Publication]) -> List[int]:
+        """ Stores publications in one go, skipping those already known.
+        Returns the id of each given publication, or -1 if it could not be stored. """
+        raise NotImplementedError
+
     def get_publication(self, publication_id: int) -> Optional[Publication]:
         raise NotImplementedError
 
-    def get_publication_refs(self) -> List[PublicationRef]:
+    def get_publications(self, publication_ids: List[int]) -> List[Optional[Publication]]:
+        """ Fetches several publications at once like `get_documents`. """
+        raise NotImplementedError
+
+    def get_unsummarized_publication_refs(self, limit: Optional[int] = None) -> List[PublicationRef]:
+        """ Lists the publications that have no summary yet, newest first. """
+        raise NotImplementedError
+
+    def get_publication_refs(self,
+                             limit: Optional[int] = None,
+                             before: Optional[RefCursor] = None,
+                             after: Optional[RefCursor] = None,
+                             since: Optional[datetime] = None,
+                             publisher: Optional[str] = None,
+                             type: Optional[PublicationType] = None) -> List[PublicationRef]:
+        """ Lists publications the same way as `get_document_refs`. """
+        raise NotImplementedError
+
+    def iter_publication_refs(self,
+                              since: Optional[datetime] = None,
+                              publisher: Optional[str] = None,
+                              type: Optional[PublicationType] = None,
+                              batch_size: int = 1000) -> Iterator[PublicationRef]:
+        """ Iterates over all publications the same way as `iter_document_refs`. """
+        raise NotImplementedError
+
+    def exists(self, urls: List[str]) -> List[bool]:
+        """ Tells for each url whether a document or publication is stored at it. """
+        raise NotImplementedError
+
+    def get_known_url_filter(self, error_rate: float = 0.01) -> BloomFilter:
+        """ Returns a bloom filter holding the urls of all stored documents and
+        publications, so that crawlers can skip known articles without asking
+        for each of them. Urls it reports as known should be confirmed with
+        `exists` since a few of them are false positives. """
+        raise NotImplementedError
+
+    def search(self, query: str, limit: int = 20, offset: int = 0,
+               kind: Optional[SearchKind] = None) -> List[SearchHit]:
+        """ Finds the documents and publications whose title, content, authors,
+        abstract or summary contain all words in `query`, best matches first. """
+        raise NotImplementedError
+
+
+class AbstractAsyncProject:
+    """ The asyncio counterpart of `AbstractProject`, whose methods are the
+    coroutine versions of those of `AbstractProject` with the same arguments
+    and results. """
+
+    async def get_user_ref(self, email: str, password: str) -> Optional[UserRef]:
+        raise NotImplementedError
+
+    async def get_admin_password(self) -> str:
+        raise NotImplementedError
+
+    async def create_document(self, document: Document) -> None:
+        raise NotImplementedError
+
+    async def create_documents(self, documents: List[Document]) -> List[int]:
+        raise NotImplementedError
+
+    async def get_document(self, document_id: int) -> Optional[Document]:
+        raise NotImplementedError
+
+    async def get_document_by_url(self, url: str) -> Optional[Document]:
+        raise NotImplementedError
+
+    async def get_documents(self, document_ids: List[int]) -> List[Optional[Document]]:
+        raise NotImplementedError
+
+    async def get_document_sizes(self, document_ids: List[int]) -> List[Optional[int]]:
+        raise NotImplementedError
+
+    async def get_unsummarized_document_refs(self, limit: Optional[int] = None) -> List[DocumentRef]:
+        raise NotImplementedError
+
+    async def get_document_refs(self,
+                                limit: Optional[int] = None,
+                                before: Optional[RefCursor] = None,
+                                after: Optional[RefCursor] = None,
+                                since: Optional[datetime] = None,
+                                publisher: Optional[str] = None) -> List[DocumentRef]:
+        raise NotImplementedError
+
+    def iter_document_refs(self,
+                           since: Optional[datetime] = None,
+                           publisher: Optional[str] = None,
+                           batch_size: int = 1000) -> AsyncIterator[DocumentRef]:
+        raise NotImplementedError
+
+    async def create_summary(self, summary: Summary) -> None:
+        raise NotImplementedError
+
+    async def get_summary_of_document(self, document_id: int) -> Optional[Summary]:
+        raise NotImplementedError
+
+    async def get_summary_of_publication(self, publication_id: int) -> Optional[Summary]:
+        raise NotImplementedError
+
+    async def get_summaries_of_documents(self, document_ids: List[int]) -> List[Optional[Summary]]:
+        raise NotImplementedError
+
+    async def get_summaries_of_publications(self, publication_ids: List[int]) -> List[Optional[Summary]]:
+        raise NotImplementedError
+
+    async def create_publication(self, publication: Publication) -> None:
+        raise NotImplementedError
+
+    async def create_publications(self, publications: List[Publication]) -> List[int]:
+        raise NotImplementedError
+
+    async def get_publication(self, publication_id: int) -> Optional[Publication]:
+        raise NotImplementedError
+
+    async def get_publications(self, publication_ids: List[int]) -> List[Optional[Publication]]:
+        raise NotImplementedError
+
+    async def get_unsummarized_publication_refs(self, limit: Optional[int] = None) -> List[PublicationRef]:
+        raise NotImplementedError
+
+    async def get_publication_refs(self,
+                                   limit: Optional[int] = None,
+                                   before: Optional[RefCursor] = None,
+                                   after: Optional[RefCursor] = None,
+                                   since: Optional[datetime] = None,
+                                   publisher: Optional[str] = None,
+                                   type: Optional[PublicationType] = None) -> List[PublicationRef]:
+        raise NotImplementedError
+
+    def iter_publication_refs(self,
+                              since: Optional[datetime] = None,
+                              publisher: Optional[str] = None,
+                              type: Optional[PublicationType] = None,
+                              batch_size: int = 1000) -> AsyncIterator[PublicationRef]:
+        raise NotImplementedError
+
+    async def exists(self, urls: List[str]) -> List[bool]:
+        raise NotImplementedError
+
+    async def get_known_url_filter(self, error_rate: float = 0.01) -> BloomFilter:
+        raise NotImplementedError
+
+    async def search(self, query: str, limit: int = 20, offset: int = 0,
+                     kind: Optional[SearchKind] = None) -> List[SearchHit]:
         raise NotImplementedError
 
 
 @dataclass
 class RemoteProject(AbstractProject):
     base_addr: str = ""
+    batch_size: int = 200
+    # documents and publications carry their full content, so fewer of them
+    # are fetched per request than refs or urls are sent
+    fetch_size: int = 20
+
+    # connections kept alive to the apiserver, which should be at least the
+    # number of threads sharing this project
+    pool_size: int = 10
+    connect_timeout: float = 5.0
+    read_timeout: float = 120.0
+    # GET requests are retried on connection errors and 502/503/504 responses,
+    # waiting about backoff * 2^n seconds plus up to `backoff` seconds of jitter
+    retries: int = 3
+    backoff: float = 0.5
+    # the number of GET responses kept to be revalidated with the apiserver
+    # instead of downloaded again while the data behind them is unchanged
+    cache_size: int = 256
+
+    @property
+    def __cache(self) -> 'OrderedDict[str, Tuple[str, Dict[str, Any]]]':
+        if not hasattr(self, "__cache__"):
+            setattr(self, "__cache__", OrderedDict())
+            setattr(self, "__cache_lock__", Lock())
+        return getattr(self, "__cache__")
 
-    def __get(self, url: str) -> Dict[str, Any]:
-        req = requests.get(url)
-        if req.status_code != 200:
-            raise Exception(f"request failed with status code {req.status_code}: {req.text} in {url}")
+    @property
+    def __session(self) -> requests.Session:
+        # a session inherited through fork shares its keep-alive connections
+        # with the parent, so the child drops it without closing it
+        if getattr(self, "__session_pid__", None) == getpid():
+            return getattr(self, "__session__")
+
+        retry = Retry(
+            total=self.retries,
+            backoff_factor=self.backoff,
+            backoff_jitter=self.backoff,
+            status_forcelist=(502, 503, 504),
+            allowed_methods=frozenset({"GET"}),
+            raise_on_status=False
+        )
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size, max_retries=retry)
 
-        resp = req.json()
-        if resp is None:
-            raise Exception(f"request failed because response is not a valid json: {req.text}")
+        session = requests.Session()
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        session.headers.update({"Accept-Encoding": "gzip"})
+        setattr(self, "__session__", session)
+        setattr(self, "__session_pid__", getpid())
+        return session
 
-        if resp['succeeded'] is False:
-            raise Exception(f"request failed: {resp['message']} in {url}")
+    @property
+    def __timeout(self) -> Tuple[float, float]:
+        return (self.connect_timeout, self.read_timeout)
+
+    def __get(self, path: str) -> Dict[str, Any]:
+        url = f"{self.base_addr}{path}"
+        cache = self.__cache
+        lock = getattr(self, "__cache_lock__")
+        with lock:
+            cached = cache.get(url)
+
+        headers = {} if cached is None else {"If-None-Match": cached[0]}
+        req = self.__session.get(url, timeout=self.__timeout, headers=headers)
+        if req.status_code == 304 and cached is not None:
+            with lock:
+                if url in cache:
+                    cache.move_to_end(url)
+            return cached[1]
+
+        resp = decode_response(req, url)
+
+        etag = req.headers.get("ETag")
+        if etag is not None and self.cache_size > 0:
+            with lock:
+                cache[url] = (etag, resp)
+                cache.move_to_end(url)
+                while len(cache) > self.cache_size:
+                    cache.popitem(last=False)
 
         return resp
 
-    def __post(self, url: str, data: Any = None) -> Dict[str, Any]:
-        req = requests.post(url, data=data)
-        if req.status_code != 200:
-            raise Exception(f"request failed with status code {req.status_code}: {req.text} in {url}")
+    def __post(self, path: str, data: Any = None) -> Dict[str, Any]:
+        url = f"{self.base_addr}{path}"
+        req = self.__session.post(
+            url, data=data, timeout=self.__timeout,
+            headers={"Content-Type": "application/json"}
+        )
+        return decode_response(req, url)
 
-        resp = req.json()
-        if resp is None:
-            raise Exception(f"request failed because response is not a valid json: {req.text}")
+    def __get_many(self, path: str, key: str, field: str, ids: List[int],
+                   batch_size: Optional[int] = None) -> List[Any]:
+        items: List[Any] = []
+        for batch in chunked(ids, batch_size or self.fetch_size):
+            items.extend(self.__get(api_path(path, **{key: batch}))[field])
 
-        if resp['succeeded'] is False:
-            raise Exception(f"request failed: {resp['message']} in {url}")
+        return items
 
-        return resp
+    def __post_many(self, path: str, field: str, items: List[Any], model: Any) -> List[Any]:
+        results: List[Any] = []
+        for batch in chunked(items, self.batch_size):
+            resp = self.__post(path, data=RootModel[List[model]](batch).model_dump_json())  # type: ignore
+            results.extend(resp[field])
+
+        return results
+
+    def __stream(self, path: str) -> Iterator[Any]:
+        url = f"{self.base_addr}{path}"
+        with self.__session.get(url, timeout=self.__timeout, stream=True) as req:
+            if req.status_code != 200:
+                decode_response(req, url)
+
+            for line in req.iter_lines(chunk_size=1 << 16):
+                if line:
+                    yield json.loads(line)
 
     def get_user_ref(self, email: str, password: str) -> Optional[UserRef]:
-        remote_addr = f"{self.base_addr}/user/get"
         req = AuthRequest(email, password)
-        resp = self.__post(remote_addr, data=RootModel[AuthRequest](req).model_dump_json())
-
-        if resp["user"] is None:
-            return None
-        else:
-            return UserRef.from_json(resp["user"])
+        resp = self.__post("/user/get", data=RootModel[AuthRequest](req).model_dump_json())
+        return optional(UserRef.from_json, resp["user"])
 
     def create_document(self, document: Document) -> None:
-        remote_addr = f"{self.base_addr}/document/create"
-        document_json = RootModel[Document](document).model_dump_json()
+        self.__post("/document/create", data=RootModel[Document](document).model_dump_json())
 
-        self.__post(remote_addr, data=document_json)
+    def create_documents(self, documents: List[Document]) -> List[int]:
+        return self.__post_many("/document/batch_create", "ids", documents, Document)
 
     def get_document(self, document_id: int) -> Optional[Document]:
-        remote_addr = f"{self.base_addr}/document/get?id={document_id}"
-        resp = self.__get(remote_addr)
-        if resp["document"] is None:
-            return None
-        else:
-            return Document.from_json(resp["document"])
+        resp = self.__get(api_path("/document/get", id=document_id))
+        return optional(Document.from_json, resp["document"])
 
-    def get_document_refs(self) -> List[DocumentRef]:
-        remote_addr = f"{self.base_addr}/document/list"
-        resp = self.__get(remote_addr)
+    def get_documents(self, document_ids: List[int]) -> List[Optional[Document]]:
+        documents = self.__get_many("/document/get_many", "ids", "documents", document_ids)
+        return [optional(Document.from_json, d) for d in documents]
 
-        drefs = []
-        for document in resp['documents']:
-            dref = DocumentRef.from_json(document)
-            drefs.append(dref)
+    def get_document_sizes(self, document_ids: List[int]) -> List[Optional[int]]:
+        return self.__get_many("/document/sizes", "ids", "sizes", document_ids, self.batch_size)
 
-        return drefs
+    def get_unsummarized_document_refs(self, limit: Optional[int] = None) -> List[DocumentRef]:
+        resp = self.__get(api_path("/document/unsummarized", limit=limit))
+        return [DocumentRef.from_json(dref) for dref in resp["documents"]]
+
+    def get_document_by_url(self, url: str) -> Optional[Document]:
+        resp = self.__get(api_path("/document/get_by_url", url=url))
+        return optional(Document.from_json, resp["document"])
+
+    def get_document_refs(self,
+                          limit: Optional[int] = None,
+                          before: Optional[RefCursor] = None,
+                          after: Optional[RefCursor] = None,
+                          since: Optional[datetime] = None,
+                          publisher: Optional[str] = None) -> List[DocumentRef]:
+        params = ref_list_params(limit, before, after, since, publisher=publisher)
+        resp = self.__get(api_path("/document/list", **params))
+        return [DocumentRef.from_json(dref) for dref in resp["documents"]]
+
+    def iter_document_refs(self,
+                           since: Optional[datetime] = None,
+                           publisher: Optional[str] = None,
+                           batch_size: int = 1000) -> Iterator[DocumentRef]:
+        # the apiserver streams the refs as one json object per line, so they
+        # are parsed as they arrive and `batch_size` is left to the server
+        params = ref_list_params(None, None, None, since, publisher=publisher)
+        for dref in self.__stream(api_path("/document/stream", **params)):
+            yield DocumentRef.from_json(dref)
 
     def create_summary(self, summary: Summary) -> None:
-        remote_addr = f"{self.base_addr}/summary/create"
-        summary_json = RootModel[Summary](summary).model_dump_json()
-        self.__post(remote_addr, data=summary_json)
+        self.__post("/summary/create", data=RootModel[Summary](summary).model_dump_json())
 
     def get_summary_of_document(self, document_id: int) -> Optional[Summary]:
-        remote_addr = f"{self.base_addr}/summary/get?document_id={document_id}"
-        resp = self.__get(remote_addr)
-
-        if resp["summary"] is None:
-            return None
-        else:
-            return Summary.from_json(resp["summary"])
+        resp = self.__get(api_path("/summary/get", document_id=document_id))
+        return optional(Summary.from_json, resp["summary"])
 
     def get_summary_of_publication(self, publication_id: int) -> Optional[Summary]:
-        remote_addr = f"{self.base_addr}/summary/get?publication_id={publication_id}"
-        resp = self.__get(remote_addr)
+        resp = self.__get(api_path("/summary/get", publication_id=publication_id))
+        return optional(Summary.from_json, resp["summary"])
 
-        if resp["summary"] is None:
-            return None
-        else:
-            return Summary.from_json(resp["summary"])
+    def get_summaries_of_documents(self, document_ids: List[int]) -> List[Optional[Summary]]:
+        summaries = self.__get_many("/summary/get_many", "document_ids", "summaries", document_ids)
+        return [optional(Summary.from_json, s) for s in summaries]
+
+    def get_summaries_of_publications(self, publication_ids: List[int]) -> List[Optional[Summary]]:
+        summaries = self.__get_many("/summary/get_many", "publication_ids", "summaries", publication_ids)
+        return [optional(Summary.from_json, s) for s in summaries]
 
     def create_publication(self, publication: Publication) -> None:
-        remote_addr = f"{self.base_addr}/publication/create"
-        publication_json = RootModel[Publication](publication).model_dump_json()
-        self.__post(remote_addr, data=publication_json)
+        self.__post("/publication/create", data=RootModel[Publication](publication).model_dump_json())
+
+    def create_publications(self, publications: List[Publication]) -> List[int]:
+        return self.__post_many("/publication/batch_create", "ids", publications, Publication)
+
+    def get_publication_refs(self,
+                             limit: Optional[int] = None,
+                             before: Optional[RefCursor] = None,
+                             after: Optional[RefCursor] = None,
+                             since: Optional[datetime] = None,
+                             publisher: Optional[str] = None,
+                             type: Optional[PublicationType] = None) -> List[PublicationRef]:
+        params = ref_list_params(limit, before, after, since, publisher=publisher, type=type)
+        resp = self.__get(api_path("/publication/list", **params))
+        return [PublicationRef.from_json(pref) for pref in resp["publications"]]
+
+    def iter_publication_refs(self,
+                              since: Optional[datetime] = None,
+                              publisher: Optional[str] = None,
+                              type: Optional[PublicationType] = None,
+                              batch_size: int = 1000) -> Iterator[PublicationRef]:
+        params = ref_list_params(None, None, None, since, publisher=publisher, type=type)
+        for pref in self.__stream(api_path("/publication/stream", **params)):
+            yield PublicationRef.from_json(pref)
 
-    def get_publication_refs(self) -> List[PublicationRef]:
-        remote_addr = f"{self.base_addr}/publication/list"
-        resp = self.__get(remote_addr)
+    def get_publication(self, publication_id: int) -> Optional[Publication]:
+        resp = self.__get(api_path("/publication/get", id=publication_id))
+        return optional(Publication.from_json, resp["publication"])
 
-        prefs = []
-        for publication in resp['publications']:
-            pref = PublicationRef.from_json(publication)
-            prefs.append(pref)
+    def get_publications(self, publication_ids: List[int]) -> List[Optional[Publication]]:
+        publications = self.__get_many("/publication/get_many", "ids", "publications", publication_ids)
+        return [optional(Publication.from_json, p) for p in publications]
 
-        return prefs
+    def get_unsummarized_publication_refs(self, limit: Optional[int] = None) -> List[PublicationRef]:
+        resp = self.__get(api_path("/publication/unsummarized", limit=limit))
+        return [PublicationRef.from_json(pref) for pref in resp["publications"]]
+
+    def exists(self, urls: List[str]) -> List[bool]:
+        return self.__post_many("/url/exists", "exists", urls, str)
+
+    def get_known_url_filter(self, error_rate: float = 0.01) -> BloomFilter:
+        resp = self.__get(api_path("/url/filter", error_rate=error_rate))
+        return BloomFilter.from_json(resp["filter"])
+
+    def search(self, query: str, limit: int = 20, offset: int = 0,
+               kind: Optional[SearchKind] = None) -> List[SearchHit]:
+        resp = self.__get(api_path("/search", query=query, limit=limit, offset=offset, kind=kind))
+        return [SearchHit.from_json(hit) for hit in resp["hits"]]
 
-    def get_publication(self, publication_id: int) -> Optional[Publication]:
-        remote_addr = f"{self.base_addr}/publication/get?id={publication_id}"
-        resp = self.__get(remote_addr)
-        if resp["publication"] is None:
-            return None
-        else:
-            return Publication.from_json(resp["publication"])
+
+@dataclass
+class AsyncRemoteProject(AbstractAsyncProject):
+    """ The asyncio counterpart of `RemoteProject`. Batched lookups are split
+    into requests of `fetch_size` ids which are sent concurrently, at most
+    `max_concurrency` of them being in flight at a time. Call `aclose` or use
+    the project as an async context manager to release its connections. """
+    base_addr: str = ""
+    batch_size: int = 200
+    fetch_size: int = 20
+
+    max_concurrency: int = 10
+    connect_timeout: float = 5.0
+    read_timeout: float = 120.0
+    # connection attempts are retried, requests themselves are not
+    retries: int = 3
+
+    @property
+    def __loop_state(self) -> Tuple[httpx.AsyncClient, asyncio.Semaphore]:
+        # the client and the semaphore are bound to the event loop they are
+        # first used in, so each running loop gets its own
+        if not hasattr(self, "__loop_states__"):
+            setattr(self, "__loop_states__", WeakKeyDictionary())
+        states = getattr(self, "__loop_states__")
+
+        loop = asyncio.get_running_loop()
+        if loop not in states:
+            limits = httpx.Limits(max_connections=self.max_concurrency,
+                                  max_keepalive_connections=self.max_concurrency)
+            client = httpx.AsyncClient(
+                base_url=self.base_addr,
+                limits=limits,
+                timeout=httpx.Timeout(self.read_timeout, connect=self.connect_timeout),
+                transport=httpx.AsyncHTTPTransport(limits=limits, retries=self.retries),
+                headers={"Accept-Encoding": "gzip"}
+            )
+            states[loop] = (client, asyncio.Semaphore(self.max_concurrency))
+
+        return states[loop]
+
+    async def aclose(self) -> None:
+        """ Closes the connections opened in the running event loop. """
+        states = getattr(self, "__loop_states__", None)
+        if states is not None:
+            state = states.pop(asyncio.get_running_loop(), None)
+            if state is not None:
+                await state[0].aclose()
+
+    async def __aenter__(self) -> 'AsyncRemoteProject':
+        return self
+
+    async def __aexit__(self, *args: Any) -> None:
+        await self.aclose()
+
+    async def __get(self, path: str) -> Dict[str, Any]:
+        client, semaphore = self.__loop_state
+        async with semaphore:
+            req = await client.get(path)
+        return decode_response(req, f"{self.base_addr}{path}")
+
+    async def __post(self, path: str, data: Any = None) -> Dict[str, Any]:
+        client, semaphore = self.__loop_state
+        async with semaphore:
+            req = await client.post(path, content=data, headers={"Content-Type": "application/json"})
+        return decode_response(req, f"{self.base_addr}{path}")
+
+    async def __get_many(self, path: str, key: str, field: str, ids: List[int],
+                         batch_size: Optional[int] = None) -> List[Any]:
+        async def fetch(batch: List[int]) -> List[Any]:
+            resp = await self.__get(api_path(path, **{key: batch}))
+            return resp[field]
+
+        batches = chunked(ids, batch_size or self.fetch_size)
+        results = await asyncio.gather(*(fetch(batch) for batch in batches))
+        return [item for result in results for item in result]
+
+    async def __post_many(self, path: str, field: str, items: List[Any], model: Any) -> List[Any]:
+        async def send(batch: List[Any]) -> List[Any]:
+            resp = await self.__post(path, data=RootModel[List[model]](batch).model_dump_json())  # type: ignore
+            return resp[field]
+
+        results = await asyncio.gather(*(send(batch) for batch in chunked(items, self.batch_size)))
+        return [item for result in results for item in result]
+
+    async def __stream(self, path: str) -> AsyncIterator[Any]:
+        client, semaphore = self.__loop_state
+        async with semaphore:
+            async with client.stream("GET", path) as req:
+                if req.status_code != 200:
+                    await req.aread()
+                    decode_response(req, f"{self.base_addr}{path}")
+
+                async for line in req.aiter_lines():
+                    if line:
+                        yield json.loads(line)
+
+    async def get_user_ref(self, email: str, password: str) -> Optional[UserRef]:
+        req = AuthRequest(email, password)
+        resp = await self.__post("/user/get", data=RootModel[AuthRequest](req).model_dump_json())
+        return optional(UserRef.from_json, resp["user"])
+
+    async def create_document(self, document: Document) -> None:
+        await self.__post("/document/create", data=RootModel[Document](document).model_dump_json())
+
+    async def create_documents(self, documents: List[Document]) -> List[int]:
+        return await self.__post_many("/document/batch_create", "ids", documents, Document)
+
+    async def get_document(self, document_id: int) -> Optional[Document]:
+        resp = await self.__get(api_path("/document/get", id=document_id))
+        return optional(Document.from_json, resp["document"])
+
+    async def get_document_by_url(self, url: str) -> Optional[Document]:
+        resp = await self.__get(api_path("/document/get_by_url", url=url))
+        return optional(Document.from_json, resp["document"])
+
+    async def get_documents(self, document_ids: List[int]) -> List[Optional[Document]]:
+        documents = await self.__get_many("/document/get_many", "ids", "documents", document_ids)
+        return [optional(Document.from_json, d) for d in documents]
+
+    async def get_document_sizes(self, document_ids: List[int]) -> List[Optional[int]]:
+        return await self.__get_many("/document/sizes", "ids", "sizes", document_ids, self.batch_size)
+
+    async def get_unsummarized_document_refs(self, limit: Optional[int] = None) -> List[DocumentRef]:
+        resp = await self.__get(api_path("/document/unsummarized", limit=limit))
+        return [DocumentRef.from_json(dref) for dref in resp["documents"]]
+
+    async def get_document_refs(self,
+                                limit: Optional[int] = None,
+                                before: Optional[RefCursor] = None,
+                                after: Optional[RefCursor] = None,
+                                since: Optional[datetime] = None,
+                                publisher: Optional[str] = None) -> List[DocumentRef]:
+        params = ref_list_params(limit, before, after, since, publisher=publisher)
+        resp = await self.__get(api_path("/document/list", **params))
+        return [DocumentRef.from_json(dref) for dref in resp["documents"]]
+
+    async def iter_document_refs(self,
+                                 since: Optional[datetime] = None,
+                                 publisher: Optional[str] = None,
+                                 batch_size: int = 1000) -> AsyncIterator[DocumentRef]:
+        params = ref_list_params(None, None, None, since, publisher=publisher)
+        async for dref in self.__stream(api_path("/document/stream", **params)):
+            yield DocumentRef.from_json(dref)
+
+    async def create_summary(self, summary: Summary) -> None:
+        await self.__post("/summary/create", data=RootModel[Summary](summary).model_dump_json())
+
+    async def get_summary_of_document(self, document_id: int) -> Optional[Summary]:
+        resp = await self.__get(api_path("/summary/get", document_id=document_id))
+        return optional(Summary.from_json, resp["summary"])
+
+    async def get_summary_of_publication(self, publication_id: int) -> Optional[Summary]:
+        resp = await self.__get(api_path("/summary/get", publication_id=publication_id))
+        return optional(Summary.from_json, resp["summary"])
+
+    async def get_summaries_of_documents(self, document_ids: List[int]) -> List[Optional[Summary]]:
+        summaries = await self.__get_many("/summary/get_many", "document_ids", "summaries", document_ids)
+        return [optional(Summary.from_json, s) for s in summaries]
+
+    async def get_summaries_of_publications(self, publication_ids: List[int]) -> List[Optional[Summary]]:
+        summaries = await self.__get_many("/summary/get_many", "publication_ids", "summaries", publication_ids)
+        return [optional(Summary.from_json, s) for s in summaries]
+
+    async def create_publication(self, publication: Publication) -> None:
+        await self.__post("/publication/create", data=RootModel[Publication](publication).model_dump_json())
+
+    async def create_publications(self, publications: List[Publication]) -> List[int]:
+        return await self.__post_many("/publication/batch_create", "ids", publications, Publication)
+
+    async def get_publication(self, publication_id: int) -> Optional[Publication]:
+        resp = await self.__get(api_path("/publication/get", id=publication_id))
+        return optional(Publication.from_json, resp["publication"])
+
+    async def get_publications(self, publication_ids: List[int]) -> List[Optional[Publication]]:
+        publications = await self.__get_many("/publication/get_many", "ids", "publications", publication_ids)
+        return [optional(Publication.from_json, p) for p in publications]
+
+    async def get_unsummarized_publication_refs(self, limit: Optional[int] = None) -> List[PublicationRef]:
+        resp = await self.__get(api_path("/publication/unsummarized", limit=limit))
+        return [PublicationRef.from_json(pref) for pref in resp["publications"]]
+
+    async def get_publication_refs(self,
+                                   limit: Optional[int] = None,
+                                   before: Optional[RefCursor] = None,
+                                   after: Optional[RefCursor] = None,
+                                   since: Optional[datetime] = None,
+                                   publisher: Optional[str] = None,
+                                   type: Optional[PublicationType] = None) -> List[PublicationRef]:
+        params = ref_list_params(limit, before, after, since, publisher=publisher, type=type)
+        resp = await self.__get(api_path("/publication/list", **params))
+        return [PublicationRef.from_json(pref) for pref in resp["publications"]]
+
+    async def iter_publication_refs(self,
+                                    since: Optional[datetime] = None,
+                                    publisher: Optional[str] = None,
+                                    type: Optional[PublicationType] = None,
+                                    batch_size: int = 1000) -> AsyncIterator[PublicationRef]:
+        params = ref_list_params(None, None, None, since, publisher=publisher, type=type)
+        async for pref in self.__stream(api_path("/publication/stream", **params)):
+            yield PublicationRef.from_json(pref)
+
+    async def exists(self, urls: List[str]) -> List[bool]:
+        return await self.__post_many("/url/exists", "exists", urls, str)
+
+    async def get_known_url_filter(self, error_rate: float = 0.01) -> BloomFilter:
+        resp = await self.__get(api_path("/url/filter", error_rate=error_rate))
+        return BloomFilter.from_json(resp["filter"])
+
+    async def search(self, query: str, limit: int = 20, offset: int = 0,
+                     kind: Optional[SearchKind] = None) -> List[SearchHit]:
+        resp = await self.__get(api_path("/search", query=query, limit=limit, offset=offset, kind=kind))
+        return [SearchHit.from_json(hit) for hit in resp["hits"]]
 
 
 @dataclass
@@ -193,6 +827,7 @@ class Project:
         project = Project("db.sqlite", "")
         project.set_project_path(project_path)
         project.save()
+        project.initialize_database()
         return project
 
     @classmethod
@@ -201,6 +836,7 @@ class Project:
         with open(join(project_path, "project.json"), "r") as f:
             project = RootModel[Project].model_validate_json(f.read()).root
             project.set_project_path(project_path)
+            project.initialize_database()
             return project
 
     def save(self) -> None:
@@ -212,13 +848,108 @@ class Project:
         return join(self.project_path, self.database_path)
 
     @property
-    def __dbconn(self) -> sqlite3.Connection:
-        if hasattr(self, "__dbconn__"):
-            return getattr(self, "__dbconn__")
+    def __connections(self) -> ConnectionManager:
+        if hasattr(self, "__connections__"):
+            return getattr(self, "__connections__")
+
+        connections = ConnectionManager(self.database_realpath, lock_path=join(self.project_path, "write.lock"))
+        setattr(self, "__connections__", connections)
+        return connections
+
+    def initialize_database(self) -> None:
+        """ Creates or upgrades the database schema. This is done once when the
+        project is created or loaded instead of before every query. """
+        migrate(self.__connections.connection)
+
+    def close(self) -> None:
+        self.__connections.close()
+
+    def get_table_versions(self) -> Dict[str, TableVersion]:
+        """ Returns the data version of every table, which is bumped for each
+        row inserted, updated or deleted, along with the time of the last change. """
+        cur = self.__connections.cursor()
+        cur.execute("SELECT name, version, modified FROM table_versions")
+        return {name: (version, modified) for (name, version, modified) in cur.fetchall()}
+
+    def backup(self, target_path: str) -> None:
+        """ Copies a consistent snapshot of the database to `target_path` with
+        `VACUUM INTO`, which reads the whole database in a single read
+        transaction. Unlike an incremental online backup, it is not restarted
+        by the commits of other connections, so it completes under steady
+        writes, which are not blocked in WAL mode. """
+        if exists(target_path):
+            remove(target_path)
+
+        self.__connections.connection.execute("VACUUM INTO ?", (target_path,))
+
+    @staticmethod
+    def __lookup_ids(cur: sqlite3.Cursor, table: str, urls: List[str]) -> List[int]:
+        """ Maps each url to the id of the row holding it in `table`, or -1. """
+        url_ids: Dict[str, int] = {}
+        for i in range(0, len(urls), MAX_SQL_VARIABLES):
+            batch = urls[i:i + MAX_SQL_VARIABLES]
+            placeholders = ", ".join("?" * len(batch))
+            cur.execute(f"SELECT id, url FROM {table} WHERE url IN ({placeholders})", batch)
+            url_ids.update((url, id) for (id, url) in cur.fetchall())
+
+        return [url_ids.get(url, -1) for url in urls]
+
+    @staticmethod
+    def __new_ids(urls: List[str], known: List[int], ids: List[int]) -> List[int]:
+        """ Keeps the ids of the rows an insertion created, given the ids of
+        the urls before (`known`) and after it, and -1 for the skipped rows:
+        those whose url was known, or repeated in the insertion. """
+        seen: Set[str] = set()
+        new_ids: List[int] = []
+        for url, known_id, id in zip(urls, known, ids):
+            new_ids.append(-1 if known_id >= 0 or url in seen else id)
+            seen.add(url)
+
+        return new_ids
+
+    @staticmethod
+    def __list_sql(select: str,
+                   limit: Optional[int],
+                   before: Optional[RefCursor],
+                   after: Optional[RefCursor],
+                   since: Optional[datetime],
+                   **filters: Optional[str]) -> Tuple[str, List[Any]]:
+        """ Completes `select` with the filtering, ordering and limit shared by
+        all list queries. Rows are ordered by (date, id), which is served by
+        the date indexes since the id is the rowid. """
+        conditions: List[str] = []
+        params: List[Any] = []
+        if before is not None:
+            conditions.append("(date, id) < (?, ?)")
+            params.extend((before[0].timestamp(), before[1]))
+        if after is not None:
+            conditions.append("(date, id) > (?, ?)")
+            params.extend((after[0].timestamp(), after[1]))
+        if since is not None:
+            conditions.append("date >= ?")
+            params.append(since.timestamp())
+
+        for column, value in filters.items():
+            if value is not None:
+                conditions.append(f"{column} = ?")
+                params.append(value)
+
+        sql = select
+        if conditions:
+            sql += " WHERE " + " AND ".join(conditions)
+
+        # when paging forward from `after`, the rows next to the cursor are the
+        # oldest ones of the range, they are reversed back by the caller
+        if before is None and after is not None:
+            sql += " ORDER BY date ASC, id ASC"
+        else:
+            sql += " ORDER BY date DESC, id DESC"
+
+        if limit is not None:
+            sql += " LIMIT ?"
+            params.append(limit)
 
-        dbconn = sqlite3.connect(self.database_realpath)
-        setattr(self, "__dbconn__", dbconn)
-        return dbconn
+        return sql, params
 
     def get_user_ref(self, email: str, password: str) -> Optional[UserRef]:
         if email == self.admin_email and password == self.admin_password:
@@ -230,38 +961,38 @@ class Project:
     # Assistant functions for managing documents
     ###########################################################################
 
-    def __create_document_table(self) -> None:
-        cur = self.__dbconn.cursor()
-        sql = """
-        CREATE TABLE IF NOT EXISTS documents (
-            id integer PRIMARY KEY,
-            title text NOT NULL,
-            date integer NOT NULL,
-            url text NOT NULL UNIQUE,
-            publisher text,
-            content text
-        )
-        """
-        cur.execute(sql)
-
     def create_document(self, document: Document) -> None:
-        self.__create_document_table()
-        cur = self.__dbconn.cursor()
         sql = f"""
         INSERT INTO documents
             (title, date, url, publisher, content) VALUES
             (?, ?, ?, ?, ?)
         """
-        cur.execute(
-            sql,
-            (document.title, document.date.timestamp(), document.url,
-             document.publisher, document.content)
-        )
-        self.__dbconn.commit()
+        with self.__connections.transaction() as cur:
+            cur.execute(
+                sql,
+                (document.title, document.date.timestamp(), document.url,
+                 document.publisher, document.content)
+            )
+
+    def create_documents(self, documents: List[Document]) -> List[int]:
+        sql = """
+        INSERT INTO documents
+            (title, date, url, publisher, content) VALUES
+            (?, ?, ?, ?, ?)
+            ON CONFLICT(url) DO NOTHING
+        """
+        urls = [document.url for document in documents]
+        with self.__connections.transaction() as cur:
+            known = self.__lookup_ids(cur, "documents", urls)
+            cur.executemany(sql, [
+                (document.title, document.date.timestamp(), document.url,
+                 document.publisher, document.content)
+                for document in documents
+            ])
+            return self.__new_ids(urls, known, self.__lookup_ids(cur, "documents", urls))
 
     def get_document(self, document_id: int) -> Optional[Document]:
-        self.__create_document_table()
-        cur = self.__dbconn.cursor()
+        cur = self.__connections.cursor()
         sql = "SELECT title, date, url, publisher, content FROM documents WHERE id = ?"
         cur.execute(sql, (document_id,))
 
@@ -270,66 +1001,124 @@ class Project:
             return None
 
         assert len(rows) == 1
-        (title, date, url, publisher, content) = rows[0]
-        return Document.build(title, datetime.fromtimestamp(date), url, publisher, content)
+        return Document.from_row(rows[0])
+
+    def get_documents(self, document_ids: List[int]) -> List[Optional[Document]]:
+        cur = self.__connections.cursor()
+
+        documents: Dict[int, Document] = {}
+        for i in range(0, len(document_ids), MAX_SQL_VARIABLES):
+            batch = document_ids[i:i + MAX_SQL_VARIABLES]
+            placeholders = ", ".join("?" * len(batch))
+            sql = f"SELECT id, title, date, url, publisher, content FROM documents WHERE id IN ({placeholders})"
+            cur.execute(sql, batch)
+            for (id, *row) in cur.fetchall():
+                documents[id] = Document.from_row(row)
+
+        return [documents.get(id) for id in document_ids]
+
+    def get_document_sizes(self, document_ids: List[int]) -> List[Optional[int]]:
+        cur = self.__connections.cursor()
+
+        sizes: Dict[int, int] = {}
+        for i in range(0, len(document_ids), MAX_SQL_VARIABLES):
+            batch = document_ids[i:i + MAX_SQL_VARIABLES]
+            placeholders = ", ".join("?" * len(batch))
+            # the length of a blob is its size in bytes rather than in characters
+            sql = f"SELECT id, length(CAST(content AS BLOB)) FROM documents WHERE id IN ({placeholders})"
+            cur.execute(sql, batch)
+            sizes.update((id, size or 0) for (id, size) in cur.fetchall())
+
+        return [sizes.get(id) for id in document_ids]
+
+    def get_unsummarized_document_refs(self, limit: Optional[int] = None) -> List[DocumentRef]:
+        cur = self.__connections.cursor()
+        sql = """
+        SELECT d.id, d.title, d.date, d.url, d.publisher
+        FROM documents d LEFT JOIN summaries s ON s.document_id = d.id
+        WHERE s.id IS NULL
+        ORDER BY d.date DESC, d.id DESC
+        LIMIT ?
+        """
+        cur.execute(sql, (-1 if limit is None else limit,))
+        return [DocumentRef.from_row(row) for row in cur.fetchall()]
 
     def get_document_by_url(self, url: str) -> Optional[Document]:
-        pass
-
-    def get_document_refs(self) -> List[DocumentRef]:
-        self.__create_document_table()
-        cur = self.__dbconn.cursor()
-        sql = "SELECT id, title, date, url, publisher FROM documents"
-        cur.execute(sql)
-
-        result = []
-        for (id, title, date, url, publisher) in cur.fetchall():
-            result.append(DocumentRef.build(
-                id, title, datetime.fromtimestamp(date),
-                url, publisher
-            ))
+        cur = self.__connections.cursor()
+        sql = "SELECT title, date, url, publisher, content FROM documents WHERE url = ?"
+        cur.execute(sql, (url,))
 
-        return result
+        row = cur.fetchone()
+        if row is None:
+            return None
+
+        return Document.from_row(row)
+
+    def get_document_refs(self,
+                          limit: Optional[int] = None,
+                          before: Optional[RefCursor] = None,
+                          after: Optional[RefCursor] = None,
+                          since: Optional[datetime] = None,
+                          publisher: Optional[str] = None) -> List[DocumentRef]:
+        rows = self.get_document_ref_rows(limit, before, after, since, publisher)
+        return [DocumentRef.from_row(row) for row in rows]
+
+    def get_document_ref_rows(self,
+                              limit: Optional[int] = None,
+                              before: Optional[RefCursor] = None,
+                              after: Optional[RefCursor] = None,
+                              since: Optional[datetime] = None,
+                              publisher: Optional[str] = None) -> List[Tuple[Any, ...]]:
+        """ Lists documents like `get_document_refs`, but returns the raw
+        (id, title, date, url, publisher) rows for callers encoding them directly. """
+        cur = self.__connections.cursor()
+        sql, params = self.__list_sql(
+            "SELECT id, title, date, url, publisher FROM documents",
+            limit, before, after, since, publisher=publisher
+        )
+        cur.execute(sql, params)
+        rows = cur.fetchall()
+        if before is None and after is not None:
+            rows.reverse()
+
+        return rows
+
+    def iter_document_refs(self,
+                           since: Optional[datetime] = None,
+                           publisher: Optional[str] = None,
+                           batch_size: int = 1000) -> Iterator[DocumentRef]:
+        # every batch is a separate query resuming after the last ref of the
+        # previous one, which may run on another thread than the previous one
+        before: Optional[RefCursor] = None
+        while True:
+            drefs = self.get_document_refs(batch_size, before, None, since, publisher)
+            yield from drefs
+            if len(drefs) < batch_size:
+                return
+
+            before = (drefs[-1].date, drefs[-1].id)
 
     ###########################################################################
     # Assistant functions for managing summaries
     ###########################################################################
 
-    def __create_summaries_table(self) -> None:
-        cur = self.__dbconn.cursor()
-        sql = """
-        CREATE TABLE IF NOT EXISTS summaries (
-            id integer PRIMARY KEY,
-            document_id integer UNIQUE,
-            publication_id integer UNIQUE,
-            model text,
-            content text
-        )
-        """
-        cur.execute(sql)
-
     def create_summary(self, summary: Summary) -> None:
-        self.__create_document_table()
-        cur = self.__dbconn.cursor()
-
-        if summary.document_id >= 0:
-            sql = "INSERT INTO summaries (document_id, model, content) VALUES (?, ?, ?)"
-            cur.execute(
-                sql,
-                (summary.document_id, summary.model, summary.content)
-            )
-        elif summary.publication_id >= 0:
-            sql = "INSERT INTO summaries (publication_id, model, content) VALUES (?, ?, ?)"
-            cur.execute(
-                sql,
-                (summary.publication_id, summary.model, summary.content)
-            )
-
-        self.__dbconn.commit()
+        with self.__connections.transaction() as cur:
+            if summary.document_id >= 0:
+                sql = "INSERT INTO summaries (document_id, model, content) VALUES (?, ?, ?)"
+                cur.execute(
+                    sql,
+                    (summary.document_id, summary.model, summary.content)
+                )
+            elif summary.publication_id >= 0:
+                sql = "INSERT INTO summaries (publication_id, model, content) VALUES (?, ?, ?)"
+                cur.execute(
+                    sql,
+                    (summary.publication_id, summary.model, summary.content)
+                )
 
     def get_summary_of_document(self, document_id: int) -> Optional[Summary]:
-        self.__create_summaries_table()
-        cur = self.__dbconn.cursor()
+        cur = self.__connections.cursor()
         sql = "SELECT id, document_id, model, content FROM summaries WHERE document_id == ?"
         cur.execute(sql, (document_id,))
         rows = cur.fetchall()
@@ -342,8 +1131,7 @@ class Project:
         return Summary.build(document_id, -1, model, summary)
 
     def get_summary_of_publication(self, publication_id: int) -> Optional[Summary]:
-        self.__create_summaries_table()
-        cur = self.__dbconn.cursor()
+        cur = self.__connections.cursor()
         sql = "SELECT id, publication_id, model, content FROM summaries WHERE publication_id == ?"
         cur.execute(sql, (publication_id,))
         rows = cur.fetchall()
@@ -355,30 +1143,38 @@ class Project:
         (id, publication_id, model, summary) = rows[0]
         return Summary.build(-1, publication_id, model, summary)
 
+    def __get_summaries(self, column: str, ids: List[int]) -> List[Optional[Summary]]:
+        cur = self.__connections.cursor()
+
+        summaries: Dict[int, Summary] = {}
+        for i in range(0, len(ids), MAX_SQL_VARIABLES):
+            batch = ids[i:i + MAX_SQL_VARIABLES]
+            placeholders = ", ".join("?" * len(batch))
+            cur.execute(
+                f"SELECT document_id, publication_id, model, content FROM summaries WHERE {column} IN ({placeholders})",
+                batch
+            )
+            for (document_id, publication_id, model, content) in cur.fetchall():
+                summary = Summary.build(
+                    -1 if document_id is None else document_id,
+                    -1 if publication_id is None else publication_id,
+                    model, content
+                )
+                summaries[document_id if column == "document_id" else publication_id] = summary
+
+        return [summaries.get(id) for id in ids]
+
+    def get_summaries_of_documents(self, document_ids: List[int]) -> List[Optional[Summary]]:
+        return self.__get_summaries("document_id", document_ids)
+
+    def get_summaries_of_publications(self, publication_ids: List[int]) -> List[Optional[Summary]]:
+        return self.__get_summaries("publication_id", publication_ids)
+
     ###########################################################################
     # Assistant functions for managing publications
     ###########################################################################
-    def __create_publications_table(self) -> None:
-        cur = self.__dbconn.cursor()
-        sql = """
-        CREATE TABLE IF NOT EXISTS publications (
-            id integer PRIMARY KEY,
-            title text,
-            authors text,
-            date integer,
-            booktitle text,
-            url text UNIQUE,
-            publisher text,
-            domain_identifier text UNIQUE,
-            type text,
-            abstract text
-        )
-        """
-        cur.execute(sql)
 
     def create_publication(self, publication: Publication) -> None:
-        self.__create_publications_table()
-        cur = self.__dbconn.cursor()
         sql = f"""
         INSERT INTO publications
             (title, authors, date, booktitle,
@@ -386,40 +1182,126 @@ class Project:
             VALUES
             (?, ?, ?, ?, ?, ?, ?, ?, ?)
         """
-        cur.execute(
-            sql,
-            (
-                publication.title,
-                "|".join(publication.authors),
-                publication.date.timestamp(),
-                publication.booktitle,
-                publication.url,
-                publication.publisher,
-                publication.domain_identifier,
-                publication.type,
-                publication.abstract
+        with self.__connections.transaction() as cur:
+            cur.execute(
+                sql,
+                (
+                    publication.title,
+                    "|".join(publication.authors),
+                    publication.date.timestamp(),
+                    publication.booktitle,
+                    publication.url,
+                    publication.publisher,
+                    publication.domain_identifier,
+                    publication.type,
+                    publication.abstract
+                )
             )
-        )
-        self.__dbconn.commit()
-
-    def get_publication_refs(self) -> List[PublicationRef]:
-        self.__create_publications_table()
-        cur = self.__dbconn.cursor()
-        sql = "SELECT id, title, date, booktitle, url, domain_identifier, type FROM publications"
-        cur.execute(sql)
-
-        result = []
-        for (id, title, date, booktitle, url, domain_identifier, type) in cur.fetchall():
-            result.append(PublicationRef.build(
-                id, title, datetime.fromtimestamp(date), booktitle,
-                url, domain_identifier, type
-            ))
 
-        return result
+    def create_publications(self, publications: List[Publication]) -> List[int]:
+        # publications are unique in both url and domain identifier, so any
+        # conflict is ignored rather than only those on the url
+        sql = f"""
+        INSERT INTO publications
+            (title, authors, date, booktitle,
+             url, publisher, domain_identifier, type, abstract)
+            VALUES
+            (?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT DO NOTHING
+        """
+        urls = [publication.url for publication in publications]
+        with self.__connections.transaction() as cur:
+            known = self.__lookup_ids(cur, "publications", urls)
+            cur.executemany(sql, [
+                (
+                    publication.title,
+                    "|".join(publication.authors),
+                    publication.date.timestamp(),
+                    publication.booktitle,
+                    publication.url,
+                    publication.publisher,
+                    publication.domain_identifier,
+                    publication.type,
+                    publication.abstract
+                )
+                for publication in publications
+            ])
+            return self.__new_ids(urls, known, self.__lookup_ids(cur, "publications", urls))
+
+    def get_publication_refs(self,
+                             limit: Optional[int] = None,
+                             before: Optional[RefCursor] = None,
+                             after: Optional[RefCursor] = None,
+                             since: Optional[datetime] = None,
+                             publisher: Optional[str] = None,
+                             type: Optional[PublicationType] = None) -> List[PublicationRef]:
+        rows = self.get_publication_ref_rows(limit, before, after, since, publisher, type)
+        return [PublicationRef.from_row(row) for row in rows]
+
+    def get_publication_ref_rows(self,
+                                 limit: Optional[int] = None,
+                                 before: Optional[RefCursor] = None,
+                                 after: Optional[RefCursor] = None,
+                                 since: Optional[datetime] = None,
+                                 publisher: Optional[str] = None,
+                                 type: Optional[PublicationType] = None) -> List[Tuple[Any, ...]]:
+        """ Lists publications like `get_publication_refs`, but returns the raw (id,
+        title, date, booktitle, url, domain_identifier, type) rows. """
+        cur = self.__connections.cursor()
+        sql, params = self.__list_sql(
+            "SELECT id, title, date, booktitle, url, domain_identifier, type FROM publications",
+            limit, before, after, since, publisher=publisher, type=type
+        )
+        cur.execute(sql, params)
+        rows = cur.fetchall()
+        if before is None and after is not None:
+            rows.reverse()
+
+        return rows
+
+    def iter_publication_refs(self,
+                              since: Optional[datetime] = None,
+                              publisher: Optional[str] = None,
+                              type: Optional[PublicationType] = None,
+                              batch_size: int = 1000) -> Iterator[PublicationRef]:
+        before: Optional[RefCursor] = None
+        while True:
+            prefs = self.get_publication_refs(batch_size, before, None, since, publisher, type)
+            yield from prefs
+            if len(prefs) < batch_size:
+                return
+
+            before = (prefs[-1].date, prefs[-1].id)
+
+    def get_publications(self, publication_ids: List[int]) -> List[Optional[Publication]]:
+        cur = self.__connections.cursor()
+
+        publications: Dict[int, Publication] = {}
+        for i in range(0, len(publication_ids), MAX_SQL_VARIABLES):
+            batch = publication_ids[i:i + MAX_SQL_VARIABLES]
+            placeholders = ", ".join("?" * len(batch))
+            sql = "SELECT id, title, authors, date, booktitle, url, publisher, domain_identifier, type, abstract " + \
+                  f"FROM publications WHERE id IN ({placeholders})"
+            cur.execute(sql, batch)
+            for (id, *row) in cur.fetchall():
+                publications[id] = Publication.from_row(row)
+
+        return [publications.get(id) for id in publication_ids]
+
+    def get_unsummarized_publication_refs(self, limit: Optional[int] = None) -> List[PublicationRef]:
+        cur = self.__connections.cursor()
+        sql = """
+        SELECT p.id, p.title, p.date, p.booktitle, p.url, p.domain_identifier, p.type
+        FROM publications p LEFT JOIN summaries s ON s.publication_id = p.id
+        WHERE s.id IS NULL
+        ORDER BY p.date DESC, p.id DESC
+        LIMIT ?
+        """
+        cur.execute(sql, (-1 if limit is None else limit,))
+        return [PublicationRef.from_row(row) for row in cur.fetchall()]
 
     def get_publication(self, publication_id: int) -> Optional[Publication]:
-        self.__create_publications_table()
-        cur = self.__dbconn.cursor()
+        cur = self.__connections.cursor()
         sql = "SELECT title, authors, date, booktitle, url, publisher, domain_identifier, type, abstract " + \
               "FROM publications where id = ?"
 
@@ -430,8 +1312,76 @@ class Project:
             return None
 
         assert len(rows) == 1
-        title, str_authors, date, booktitle, url, publisher, domain_identifier, type, abstract = rows[0]
-        return Publication.build(
-            title, str_authors.split("|"), datetime.fromtimestamp(date),
-            booktitle, url, publisher, domain_identifier, type, abstract
-        )
+        return Publication.from_row(rows[0])
+
+    ###########################################################################
+    # Assistant functions for looking up known urls
+    ###########################################################################
+
+    def exists(self, urls: List[str]) -> List[bool]:
+        cur = self.__connections.cursor()
+
+        known_urls: Set[str] = set()
+        step = MAX_SQL_VARIABLES // 2
+        for i in range(0, len(urls), step):
+            batch = urls[i:i + step]
+            placeholders = ", ".join("?" * len(batch))
+            sql = f"SELECT url FROM documents WHERE url IN ({placeholders}) " + \
+                  f"UNION ALL SELECT url FROM publications WHERE url IN ({placeholders})"
+            cur.execute(sql, batch + batch)
+            known_urls.update(url for (url,) in cur.fetchall())
+
+        return [url in known_urls for url in urls]
+
+    def get_known_url_filter(self, error_rate: float = 0.01) -> BloomFilter:
+        cur = self.__connections.cursor()
+        cur.execute("SELECT (SELECT count(*) FROM documents) + (SELECT count(*) FROM publications)")
+        (count,) = cur.fetchone()
+
+        # leave room for the urls added while the filter is in use
+        bloom = BloomFilter(count * 2 + 1024, error_rate)
+        cur.execute("SELECT url FROM documents UNION ALL SELECT url FROM publications WHERE url IS NOT NULL")
+        bloom.update(url for (url,) in cur)
+        return bloom
+
+    ###########################################################################
+    # Assistant functions for full-text search
+    ###########################################################################
+
+    def search(self, query: str, limit: int = 20, offset: int = 0,
+               kind: Optional[SearchKind] = None) -> List[SearchHit]:
+        match = fts_query(query)
+        if match == "":
+            return []
+
+        # documents and publications have an index each, whose matches are
+        # ranked together with the recency boost computed from the table
+        scored = "bm25({index}, ?, ?, ?, ?) - ? / (1.0 + max(? - t.date, 0) / ?)"
+        kinds: List[SearchKind] = ['document', 'publication'] if kind is None else [kind]
+        selects = [
+            f"""
+            SELECT '{k}', t.id, {scored.format(index=f"{k}s_search")} AS score, t.title, t.date, t.url, t.publisher
+            FROM {k}s_search JOIN {k}s t ON t.id = {k}s_search.rowid
+            WHERE {k}s_search MATCH ?
+            """
+            for k in kinds
+        ]
+        sql = " UNION ALL ".join(selects) + " ORDER BY score LIMIT ? OFFSET ?"
+
+        now = time()
+        params: List[Any] = []
+        for _ in kinds:
+            params.extend((*SEARCH_COLUMN_WEIGHTS, SEARCH_RECENCY_WEIGHT, now, SEARCH_RECENCY_HALF_LIFE, match))
+        params.extend((limit, offset))
+
+        cur = self.__connections.cursor()
+        cur.execute(sql, params)
+
+        result: List[SearchHit] = []
+        for (hit_kind, id, score, title, date, url, publisher) in cur.fetchall():
+            result.append(SearchHit(
+                hit_kind, id, title, datetime.fromtimestamp(date),
+                url, publisher or "", score
+            ))
+
+        return result
@@ -0,0 +1,130 @@
+from fastapi import Response
+
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple
+
+import asyncio
+
+
+# the bookkeeping memory of an entry besides its key and body, roughly
+ENTRY_OVERHEAD = 256
+
+
+@dataclass
+class CachedResponse:
+    tag: str
+    body: bytes
+    media_type: Optional[str]
+    headers: Dict[str, str]
+
+    @property
+    def size(self) -> int:
+        return len(self.body) + ENTRY_OVERHEAD
+
+    def response(self) -> Response:
+        return Response(self.body, media_type=self.media_type, headers=self.headers)
+
+    @classmethod
+    def of(cls, tag: str, response: Response) -> Optional['CachedResponse']:
+        """ Captures a complete successful response, or returns None for
+        responses that should not be kept, such as errors and streams. """
+        body = getattr(response, "body", None)
+        if response.status_code != 200 or not isinstance(body, bytes):
+            return None
+
+        headers = {k: v for k, v in response.headers.items() if k not in ("content-length", "content-type")}
+        return CachedResponse(tag, body, response.media_type, headers)
+
+
+class ResponseCache:
+    """ A least-recently-used cache of encoded responses bounded by the total
+    size of their bodies.
+
+    Entries are tagged, typically with the data versions of the tables the
+    response was built from, and an entry only answers lookups with the same
+    tag, so a new version of the data replaces it on the next lookup. Identical
+    lookups missing at the same time wait for the first one to build the
+    response instead of each running the same queries. The cache is meant to be
+    used from the event loop only and takes no locks. """
+
+    def __init__(self, capacity: int) -> None:
+        self.capacity = capacity
+        # a single response may take at most a quarter of the cache, so that a
+        # large listing does not evict every other entry
+        self.max_entry_size = capacity // 4
+
+        self.__entries: OrderedDict[str, CachedResponse] = OrderedDict()
+        self.__size = 0
+        self.__inflight: Dict[Tuple[str, str], asyncio.Future] = {}
+
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.evictions = 0
+
+    def __store(self, key: str, entry: CachedResponse) -> None:
+        if entry.size > self.max_entry_size:
+            return
+
+        previous = self.__entries.pop(key, None)
+        if previous is not None:
+            self.__size -= previous.size
+
+        while self.__entries and self.__size + entry.size > self.capacity:
+            _, evicted = self.__entries.popitem(last=False)
+            self.__size -= evicted.size
+            self.evictions += 1
+
+        self.__entries[key] = entry
+        self.__size += entry.size
+
+    async def get(self, key: str, tag: str, build: Callable[[], Awaitable[Response]]) -> Response:
+        """ Returns the cached response for `key` if it was stored with `tag`,
+        otherwise calls `build` and keeps what it returns. """
+        entry = self.__entries.get(key)
+        if entry is not None and entry.tag == tag:
+            self.__entries.move_to_end(key)
+            self.hits += 1
+            return entry.response()
+
+        flight = self.__inflight.get((key, tag))
+        if flight is not None:
+            self.coalesced += 1
+            entry = await asyncio.shield(flight)
+            # the response could not be kept, so it is built again
+            return entry.response() if entry is not None else await build()
+
+        self.misses += 1
+        flight = asyncio.get_running_loop().create_future()
+        self.__inflight[(key, tag)] = flight
+        try:
+            response = await build()
+        except BaseException as ex:
+            flight.set_exception(ex)
+            # waiters get the exception as well, and it is not reported as
+            # never retrieved when there are none
+            flight.exception()
+            raise
+        finally:
+            del self.__inflight[(key, tag)]
+
+        entry = CachedResponse.of(tag, response)
+        flight.set_result(entry)
+        if entry is not None:
+            self.__store(key, entry)
+
+        return response
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses + self.coalesced
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+            "evictions": self.evictions,
+            "hit_rate": (self.hits + self.coalesced) / lookups if lookups else 0.0,
+            "entries": len(self.__entries),
+            "size": self.__size,
+            "capacity": self.capacity,
+        }
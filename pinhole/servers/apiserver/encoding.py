@@ -0,0 +1,65 @@
+from pinhole.datasource.document import DocumentRef
+from pinhole.datasource.publication import PublicationRef
+from pinhole.datasource.search import SearchHit
+from pinhole.datasource.summary import Summary
+
+from fastapi import Response
+from pydantic import TypeAdapter
+
+from datetime import datetime
+from typing import Any, List, Optional, Sequence, Tuple
+
+try:
+    import orjson
+except ImportError:
+    orjson = None  # type: ignore
+
+
+# The fast path encodes responses with the serializers below, built once,
+# instead of letting FastAPI walk every model with `jsonable_encoder`. The
+# result is identical to the regular responses.
+DOCUMENT_REFS = TypeAdapter(List[DocumentRef])
+PUBLICATION_REFS = TypeAdapter(List[PublicationRef])
+SEARCH_HITS = TypeAdapter(List[SearchHit])
+SUMMARY = TypeAdapter(Optional[Summary])
+SUMMARIES = TypeAdapter(List[Optional[Summary]])
+
+# fields of the refs in the order of the columns selected for them
+DOCUMENT_REF_FIELDS = ("id", "title", "date", "url", "publisher")
+PUBLICATION_REF_FIELDS = ("id", "title", "date", "booktitle", "url", "domain_identifier", "type")
+
+
+def is_orjson_supported() -> bool:
+    return orjson is not None
+
+
+def encode_ref_rows(rows: List[Tuple[Any, ...]], fields: Sequence[str]) -> bytes:
+    """ Encodes (id, title, date, ...) database rows as a json list of refs
+    with the given `fields`, without instantiating the ref models when orjson
+    is available. """
+    if orjson is None:
+        if fields == DOCUMENT_REF_FIELDS:
+            return DOCUMENT_REFS.dump_json([DocumentRef.from_row(row) for row in rows])
+        else:
+            return PUBLICATION_REFS.dump_json([PublicationRef.from_row(row) for row in rows])
+
+    fromtimestamp = datetime.fromtimestamp
+    items = []
+    for row in rows:
+        item = dict(zip(fields, row))
+        item["date"] = fromtimestamp(item["date"])
+        items.append(item)
+
+    return orjson.dumps(items)
+
+
+def json_response(response: Response, **fields: bytes) -> Response:
+    """ Assembles the usual {"succeeded": true, ...} body from encoded fields.
+    Headers set on `response` by dependencies are carried over, since FastAPI
+    drops them when a handler returns its own response. """
+    parts = [b'{"succeeded":true']
+    for key, value in fields.items():
+        parts.extend((b',"', key.encode('utf8'), b'":', value))
+    parts.append(b"}")
+
+    return Response(b"".join(parts), media_type="application/json", headers=dict(response.headers))
@@ -0,0 +1,51 @@
+from pinhole.metrics import REGISTRY
+
+from fastapi import HTTPException, Request, Response
+from fastapi.exceptions import RequestValidationError
+from fastapi.routing import APIRoute
+
+from time import perf_counter
+from typing import Any, Callable, Coroutine
+
+
+HTTP_REQUESTS = REGISTRY.counter(
+    "pinhole_http_requests_total", "Requests handled, by route and status.", ("route", "method", "status")
+)
+HTTP_DURATION = REGISTRY.histogram(
+    "pinhole_http_request_duration_seconds", "Time to build the response of a request.", ("route", "method")
+)
+HTTP_IN_FLIGHT = REGISTRY.gauge(
+    "pinhole_http_requests_in_flight", "Requests being handled.", ("route", "method")
+)
+
+
+class InstrumentedRoute(APIRoute):
+    """ Records the count, latency and concurrency of the requests of a route.
+    Requests are labelled by the path template of the route rather than the
+    requested path, which keeps the number of label sets bounded. The time of
+    streamed responses only covers building the response, not sending it. """
+
+    def get_route_handler(self) -> Callable[[Request], Coroutine[Any, Any, Response]]:
+        handler = super().get_route_handler()
+        method = ",".join(sorted(self.methods or ()))
+
+        async def instrumented_handler(request: Request) -> Response:
+            HTTP_IN_FLIGHT.inc(self.path, method)
+            begin = perf_counter()
+            status = "error"
+            try:
+                response = await handler(request)
+                status = str(response.status_code)
+                return response
+            except HTTPException as ex:
+                status = str(ex.status_code)
+                raise
+            except RequestValidationError:
+                status = "422"
+                raise
+            finally:
+                HTTP_DURATION.observe(perf_counter() - begin, self.path, method)
+                HTTP_REQUESTS.inc(self.path, method, status)
+                HTTP_IN_FLIGHT.dec(self.path, method)
+
+        return instrumented_handler
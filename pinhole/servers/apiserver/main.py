@@ -1,27 +1,72 @@
 
-from pinhole.datasource.document import Document
+from pinhole.datasource.document import Document, DocumentRef
 from pinhole.datasource.summary import Summary
-from pinhole.datasource.publication import Publication
-from pinhole.project import Project
+from pinhole.datasource.publication import Publication, PublicationRef, PublicationType
+from pinhole.datasource.search import SearchKind
+from pinhole.project import Project, RefCursor, TableVersion
+from pinhole.servers.apiserver import encoding
+from pinhole.metrics import REGISTRY
+from pinhole.servers.apiserver.cache import ResponseCache
+from pinhole.servers.apiserver.instrumentation import InstrumentedRoute
+from pinhole.servers.apiserver.middleware import JsonGZipMiddleware
+from pinhole.storage.async_project import AsyncProject
+from pinhole.storage.snapshot import SnapshotManager, Compression, COMPRESSION_SUFFIXES
 from pinhole.user import AuthRequest
 
-from fastapi import FastAPI, Request, Response, status
-from fastapi.responses import JSONResponse
+from fastapi import Depends, FastAPI, HTTPException, Query, Request, Response, status
+from fastapi.responses import FileResponse, JSONResponse, PlainTextResponse, StreamingResponse
 from fastapi.exceptions import RequestValidationError
-
-from tempfile import mktemp
-from shutil import copy
-from typing import Optional
-from os import environ, remove
+from fastapi.routing import APIRoute
+
+from pydantic import TypeAdapter
+from loguru import logger
+
+from contextlib import asynccontextmanager
+from datetime import datetime
+from email.utils import formatdate, parsedate_to_datetime
+from itertools import islice
+from typing import Any, AsyncIterator, Callable, Coroutine, Dict, Iterator, List, Optional
+from urllib.parse import urlencode
+from os import environ
 from os.path import isdir
 
 import base64
 
 
-app = FastAPI()
 project_path = environ['PINHOLE_PROJECT']
 project = Project.loadf(project_path) if isdir(project_path) else Project.create(project_path)
 
+# handlers must not call the blocking methods of `project` directly, but go
+# through `storage.read` or `storage.write` to keep the event loop responsive
+storage = AsyncProject(project)
+snapshots = SnapshotManager(project)
+
+# list, summary and search responses are encoded with pre-built serializers
+# (and list rows with orjson when it is installed) instead of FastAPI's generic
+# encoder when PINHOLE_FAST_JSON is set, see `encoding`
+fast_json = environ.get('PINHOLE_FAST_JSON', '') not in ('', '0')
+if fast_json and not encoding.is_orjson_supported():
+    logger.warning("orjson is not installed, list rows are encoded through the ref models")
+
+# encoded responses of the read endpoints kept by each process, in bytes
+responses = ResponseCache(int(environ.get('PINHOLE_RESPONSE_CACHE_SIZE', 64 << 20)))
+
+# metrics are kept per process, so with several workers each scrape of
+# /metrics reports the worker answering it
+CACHE_LOOKUPS = REGISTRY.counter("pinhole_response_cache_lookups_total", "Response cache lookups.", ("result",))
+CACHE_EVICTIONS = REGISTRY.counter("pinhole_response_cache_evictions_total", "Responses evicted from the cache.")
+CACHE_SIZE = REGISTRY.gauge("pinhole_response_cache_size_bytes", "Size of the cached responses.")
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    yield
+    storage.shutdown()
+
+
+app = FastAPI(lifespan=lifespan)
+app.add_middleware(JsonGZipMiddleware, minimum_size=1024)
+
 
 @app.middleware('http')
 async def authentication_middleware(request: Request, call_next):
@@ -51,6 +96,125 @@ async def authentication_middleware(request: Request, call_next):
         )
 
 
+# the number of refs fetched and encoded at a time by the streaming endpoints
+STREAM_BATCH_SIZE = 1000
+
+
+def encode_lines(items: Iterator[Any], adapter: TypeAdapter, count: int) -> bytes:
+    return b"".join(adapter.dump_json(item) + b"\n" for item in islice(items, count))
+
+
+async def stream_lines(items: Iterator[Any], adapter: TypeAdapter) -> AsyncIterator[bytes]:
+    """ Encodes `items` as newline-delimited json. The iterator is advanced a
+    batch at a time on the reader threads, so the queries behind it never
+    block the event loop and each batch is sent as soon as it is fetched. """
+    while True:
+        chunk = await storage.read(encode_lines, items, adapter, STREAM_BATCH_SIZE)
+        if not chunk:
+            return
+
+        yield chunk
+
+
+def stream_response(response: Response, lines: AsyncIterator[bytes]) -> StreamingResponse:
+    """ Streams `lines` with the validators set on `response` by `revalidate`,
+    which FastAPI drops when a handler returns its own response. """
+    return StreamingResponse(lines, media_type="application/x-ndjson", headers=dict(response.headers))
+
+
+class Revalidate:
+    """ A dependency making a read endpoint answer conditional requests. The
+    response is tagged with the data versions of the tables it is built from,
+    and requests carrying a matching `If-None-Match` (or a recent enough
+    `If-Modified-Since`) get an empty 304 response instead. """
+
+    def __init__(self, *tables: str) -> None:
+        self.tables = tables
+
+    def validators(self, versions: Dict[str, TableVersion]) -> Dict[str, str]:
+        etag = 'W/"' + "-".join(f"{versions[t][0]}.{int(versions[t][1] * 1000)}" for t in self.tables) + '"'
+        modified = max(versions[t][1] for t in self.tables)
+        return {
+            "ETag": etag,
+            "Last-Modified": formatdate(modified, usegmt=True),
+            "Cache-Control": "no-cache"
+        }
+
+    @staticmethod
+    def is_not_modified(request: Request, validators: Dict[str, str]) -> bool:
+        if_none_match = request.headers.get("If-None-Match")
+        if_modified_since = request.headers.get("If-Modified-Since")
+        if if_none_match is not None:
+            tags = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+            return "*" in tags or validators["ETag"].removeprefix("W/") in tags
+        elif if_modified_since is not None:
+            try:
+                modified = parsedate_to_datetime(validators["Last-Modified"]).timestamp()
+                return modified <= parsedate_to_datetime(if_modified_since).timestamp()
+            except (TypeError, ValueError):
+                return False
+        else:
+            return False
+
+    async def __call__(self, request: Request, response: Response) -> None:
+        # the versions are read before the data, so a concurrent write can at
+        # worst tag fresh data with an older version, which only costs clients
+        # a download on their next revalidation
+        versions: Optional[Dict[str, TableVersion]] = getattr(request.state, "table_versions", None)
+        if versions is None:
+            versions = await storage.read(project.get_table_versions)
+
+        validators = self.validators(versions)
+        if self.is_not_modified(request, validators):
+            raise HTTPException(status.HTTP_304_NOT_MODIFIED, headers=validators)
+
+        response.headers.update(validators)
+
+
+def revalidate(*tables: str) -> Any:
+    return Depends(Revalidate(*tables))
+
+
+class CachedRoute(APIRoute):
+    """ Serves the endpoints depending on `revalidate` from `responses`. The
+    cached responses are tagged with the ETag of the request, so they are
+    dropped as soon as any process changes the tables they are built from. """
+
+    def get_route_handler(self) -> Callable[[Request], Coroutine[Any, Any, Response]]:
+        handler = super().get_route_handler()
+        revalidation = next(
+            (d.dependency for d in self.dependencies if isinstance(d.dependency, Revalidate)), None
+        )
+        if revalidation is None or self.methods != {"GET"}:
+            return handler
+
+        async def cached_handler(request: Request) -> Response:
+            if responses.capacity <= 0:
+                return await handler(request)
+
+            versions = await storage.read(project.get_table_versions)
+            request.state.table_versions = versions
+            validators = revalidation.validators(versions)
+            if revalidation.is_not_modified(request, validators):
+                return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=validators)
+
+            # parameters are ordered by name only: the values of a repeated
+            # parameter, such as the ids of get_many, keep their order
+            params = sorted(request.query_params.multi_items(), key=lambda item: item[0])
+            key = request.url.path + "?" + urlencode(params)
+            return await responses.get(key, validators["ETag"], lambda: handler(request))
+
+        return cached_handler
+
+
+# requests are timed around the response cache, so that hits are counted too
+class ApiRoute(InstrumentedRoute, CachedRoute):
+    pass
+
+
+app.router.route_class = ApiRoute
+
+
 @app.get("/")
 async def root():
     return {
@@ -59,6 +223,22 @@ async def root():
     }
 
 
+@app.get("/cache/stats")
+async def cache_stats():
+    return {"succeeded": True, "stats": responses.stats()}
+
+
+@app.get("/metrics")
+async def metrics():
+    stats = responses.stats()
+    for result in ("hits", "misses", "coalesced"):
+        CACHE_LOOKUPS.set(result, value=stats[result])
+    CACHE_EVICTIONS.set(value=stats["evictions"])
+    CACHE_SIZE.set(value=stats["size"])
+
+    return PlainTextResponse(REGISTRY.render(), media_type="text/plain; version=0.0.4")
+
+
 @app.post("/user/get")
 async def get_user_ref(request: AuthRequest):
     return {
@@ -69,62 +249,259 @@ async def get_user_ref(request: AuthRequest):
 
 @app.post("/document/create")
 async def create_document(document: Document):
-    project.create_document(document)
+    await storage.write(project.create_document, document)
     return {"succeeded": True}
 
 
-@app.get("/document/get")
+@app.post("/document/batch_create")
+async def create_documents(documents: List[Document]):
+    return {
+        "succeeded": True,
+        "ids": await storage.write(project.create_documents, documents)
+    }
+
+
+@app.get("/document/get", dependencies=[revalidate("documents")])
 async def get_document(id: int):
     return {
         "succeeded": True,
-        "document": project.get_document(id)
+        "document": await storage.read(project.get_document, id)
+    }
+
+
+def ref_cursor(date: Optional[datetime], id: Optional[int], default_id: int) -> Optional[RefCursor]:
+    if date is None:
+        return None
+
+    return (date, id if id is not None else default_id)
+
+
+# without an id, refs sharing the cursor date are excluded in either direction
+def before_cursor(date: Optional[datetime], id: Optional[int]) -> Optional[RefCursor]:
+    return ref_cursor(date, id, -1)
+
+
+def after_cursor(date: Optional[datetime], id: Optional[int]) -> Optional[RefCursor]:
+    return ref_cursor(date, id, 2 ** 63 - 1)
+
+
+@app.get("/document/get_many", dependencies=[revalidate("documents")])
+async def get_documents(ids: List[int] = Query()):
+    return {
+        "succeeded": True,
+        "documents": await storage.read(project.get_documents, ids)
+    }
+
+
+@app.get("/document/sizes", dependencies=[revalidate("documents")])
+async def get_document_sizes(ids: List[int] = Query()):
+    return {
+        "succeeded": True,
+        "sizes": await storage.read(project.get_document_sizes, ids)
     }
 
 
-@app.get("/document/list")
-async def list_document():
+@app.get("/document/unsummarized", dependencies=[revalidate("documents", "summaries")])
+async def list_unsummarized_documents(response: Response, limit: Optional[int] = None):
+    if fast_json:
+        drefs = await storage.read(project.get_unsummarized_document_refs, limit)
+        return encoding.json_response(response, documents=encoding.DOCUMENT_REFS.dump_json(drefs))
+
     return {
         "succeeded": True,
-        "documents": project.get_document_refs()
+        "documents": await storage.read(project.get_unsummarized_document_refs, limit)
     }
 
 
+@app.get("/document/get_by_url", dependencies=[revalidate("documents")])
+async def get_document_by_url(url: str):
+    return {
+        "succeeded": True,
+        "document": await storage.read(project.get_document_by_url, url)
+    }
+
+
+@app.get("/document/list", dependencies=[revalidate("documents")])
+async def list_document(response: Response,
+                        limit: Optional[int] = None,
+                        before_date: Optional[datetime] = None,
+                        before_id: Optional[int] = None,
+                        after_date: Optional[datetime] = None,
+                        after_id: Optional[int] = None,
+                        since: Optional[datetime] = None,
+                        publisher: Optional[str] = None):
+    if fast_json:
+        rows = await storage.read(
+            project.get_document_ref_rows,
+            limit, before_cursor(before_date, before_id), after_cursor(after_date, after_id),
+            since, publisher
+        )
+        return encoding.json_response(
+            response, documents=encoding.encode_ref_rows(rows, encoding.DOCUMENT_REF_FIELDS)
+        )
+
+    return {
+        "succeeded": True,
+        "documents": await storage.read(
+            project.get_document_refs,
+            limit, before_cursor(before_date, before_id), after_cursor(after_date, after_id),
+            since, publisher
+        )
+    }
+
+
+@app.get("/document/stream", dependencies=[revalidate("documents")])
+async def stream_documents(response: Response, since: Optional[datetime] = None, publisher: Optional[str] = None):
+    drefs = project.iter_document_refs(since, publisher, batch_size=STREAM_BATCH_SIZE)
+    return stream_response(response, stream_lines(drefs, TypeAdapter(DocumentRef)))
+
+
 @app.post("/summary/create")
 async def create_summary(summary: Summary):
-    project.create_summary(summary)
+    await storage.write(project.create_summary, summary)
     return {"succeeded": True}
 
 
-@app.get("/summary/get")
-async def get_summary(document_id: int = -1, publication_id: int = -1):
+@app.get("/summary/get", dependencies=[revalidate("summaries")])
+async def get_summary(response: Response, document_id: int = -1, publication_id: int = -1):
     summary: Optional[Summary] = None
     if document_id >= 0:
-        summary = project.get_summary_of_document(document_id)
+        summary = await storage.read(project.get_summary_of_document, document_id)
     elif publication_id >= 0:
-        summary = project.get_summary_of_publication(publication_id)
+        summary = await storage.read(project.get_summary_of_publication, publication_id)
+
+    if fast_json:
+        return encoding.json_response(response, summary=encoding.SUMMARY.dump_json(summary))
 
     return {"succeeded": True, "summary": summary}
 
 
+@app.get("/summary/get_many", dependencies=[revalidate("summaries")])
+async def get_summaries(response: Response,
+                        document_ids: List[int] = Query([]),
+                        publication_ids: List[int] = Query([])):
+    if document_ids and publication_ids:
+        raise ValueError("only one of document_ids and publication_ids should be given")
+
+    summaries: List[Optional[Summary]] = []
+    if document_ids:
+        summaries = await storage.read(project.get_summaries_of_documents, document_ids)
+    elif publication_ids:
+        summaries = await storage.read(project.get_summaries_of_publications, publication_ids)
+
+    if fast_json:
+        return encoding.json_response(response, summaries=encoding.SUMMARIES.dump_json(summaries))
+
+    return {"succeeded": True, "summaries": summaries}
+
+
 @app.post("/publication/create")
 async def create_publication(publication: Publication):
-    project.create_publication(publication)
+    await storage.write(project.create_publication, publication)
     return {"succeeded": True}
 
 
-@app.get("/publication/list")
-async def list_publication():
+@app.post("/publication/batch_create")
+async def create_publications(publications: List[Publication]):
     return {
         "succeeded": True,
-        "publications": project.get_publication_refs()
+        "ids": await storage.write(project.create_publications, publications)
     }
 
 
-@app.get("/publication/get")
+@app.get("/publication/list", dependencies=[revalidate("publications")])
+async def list_publication(response: Response,
+                           limit: Optional[int] = None,
+                           before_date: Optional[datetime] = None,
+                           before_id: Optional[int] = None,
+                           after_date: Optional[datetime] = None,
+                           after_id: Optional[int] = None,
+                           since: Optional[datetime] = None,
+                           publisher: Optional[str] = None,
+                           type: Optional[PublicationType] = None):
+    if fast_json:
+        rows = await storage.read(
+            project.get_publication_ref_rows,
+            limit, before_cursor(before_date, before_id), after_cursor(after_date, after_id),
+            since, publisher, type
+        )
+        return encoding.json_response(
+            response, publications=encoding.encode_ref_rows(rows, encoding.PUBLICATION_REF_FIELDS)
+        )
+
+    return {
+        "succeeded": True,
+        "publications": await storage.read(
+            project.get_publication_refs,
+            limit, before_cursor(before_date, before_id), after_cursor(after_date, after_id),
+            since, publisher, type
+        )
+    }
+
+
+@app.get("/publication/stream", dependencies=[revalidate("publications")])
+async def stream_publications(response: Response,
+                              since: Optional[datetime] = None,
+                              publisher: Optional[str] = None,
+                              type: Optional[PublicationType] = None):
+    prefs = project.iter_publication_refs(since, publisher, type, batch_size=STREAM_BATCH_SIZE)
+    return stream_response(response, stream_lines(prefs, TypeAdapter(PublicationRef)))
+
+
+@app.get("/publication/get", dependencies=[revalidate("publications")])
 async def get_publication(id: int):
     return {
         "succeeded": True,
-        "publication": project.get_publication(id)
+        "publication": await storage.read(project.get_publication, id)
+    }
+
+
+@app.get("/publication/get_many", dependencies=[revalidate("publications")])
+async def get_publications(ids: List[int] = Query()):
+    return {
+        "succeeded": True,
+        "publications": await storage.read(project.get_publications, ids)
+    }
+
+
+@app.get("/publication/unsummarized", dependencies=[revalidate("publications", "summaries")])
+async def list_unsummarized_publications(response: Response, limit: Optional[int] = None):
+    if fast_json:
+        prefs = await storage.read(project.get_unsummarized_publication_refs, limit)
+        return encoding.json_response(response, publications=encoding.PUBLICATION_REFS.dump_json(prefs))
+
+    return {
+        "succeeded": True,
+        "publications": await storage.read(project.get_unsummarized_publication_refs, limit)
+    }
+
+
+@app.post("/url/exists")
+async def url_exists(urls: List[str]):
+    return {
+        "succeeded": True,
+        "exists": await storage.read(project.exists, urls)
+    }
+
+
+@app.get("/url/filter", dependencies=[revalidate("documents", "publications")])
+async def url_filter(error_rate: float = 0.01):
+    return {
+        "succeeded": True,
+        "filter": (await storage.read(project.get_known_url_filter, error_rate)).to_json()
+    }
+
+
+@app.get("/search", dependencies=[revalidate("documents", "summaries", "publications")])
+async def search(response: Response,
+                 query: str, limit: int = 20, offset: int = 0, kind: Optional[SearchKind] = None):
+    if fast_json:
+        hits = await storage.read(project.search, query, limit, offset, kind)
+        return encoding.json_response(response, hits=encoding.SEARCH_HITS.dump_json(hits))
+
+    return {
+        "succeeded": True,
+        "hits": await storage.read(project.search, query, limit, offset, kind)
     }
 
 
@@ -139,14 +516,21 @@ async def exception_handler(request: Request, exc: RequestValidationError) -> JS
 
 
 @app.get("/download/database")
-async def download_database():
-    tempfile = mktemp()
-    copy(project.database_realpath, tempfile)
-
-    with open(tempfile, 'rb') as ftemp:
-        content = ftemp.read()
+async def download_database(compression: Optional[Compression] = None):
+    if not snapshots.is_supported(compression):
+        return JSONResponse(
+            {
+                "succeeded": False,
+                "message": f"compression {compression} is not supported by the server"
+            },
+            status_code=status.HTTP_400_BAD_REQUEST
+        )
 
-    remove(tempfile)
-    return Response(content, headers={
-        'Content-Disposition': f'attachment; filename="database.db"'
-    })
+    # the snapshot is served as a file, which supports range requests for
+    # resuming downloads as long as the database is unchanged
+    snapshot_path = await storage.read(snapshots.get, compression)
+    return FileResponse(
+        snapshot_path,
+        media_type="application/octet-stream",
+        filename="database.db" + COMPRESSION_SUFFIXES[compression]
+    )
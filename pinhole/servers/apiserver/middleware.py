@@ -0,0 +1,14 @@
+from starlette.middleware.gzip import GZipMiddleware
+from starlette.types import Receive, Scope, Send
+
+
+class JsonGZipMiddleware(GZipMiddleware):
+    """ Compresses API responses for clients accepting gzip. Downloads are left
+    untouched since they are served with range support, which a transparently
+    compressed body would break. """
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] == "http" and scope["path"].startswith("/download/"):
+            await self.app(scope, receive, send)
+        else:
+            await super().__call__(scope, receive, send)
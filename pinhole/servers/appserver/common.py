@@ -1,8 +1,10 @@
-from pinhole.project import RemoteProject
+from pinhole.project import RemoteProject, RefCursor
+from pinhole.datasource.document import DocumentRef
+from pinhole.datasource.publication import PublicationRef
 from pydantic.dataclasses import dataclass
 from os import environ
+from typing import Callable, Optional, Sequence, TypeVar, Union
 
-import math
 import streamlit as st
 
 
@@ -74,11 +76,57 @@ def auth() -> AuthState:
     return auth_state
 
 
-def paginator(item_per_page: int, item_total: int) -> int:
-    total_pages = math.ceil(item_total / item_per_page)
-    current_page = st.number_input(
-        f"Page ({total_pages} in total)",
-        min_value=1, max_value=max(1, total_pages),
-        step=1
-    )
-    return int(current_page) - 1
+Ref = TypeVar("Ref", bound=Union[DocumentRef, PublicationRef])
+
+
+def ref_pager(key: str, item_per_page: int,
+              fetch: Callable[[int, Optional[RefCursor], Optional[RefCursor]], Sequence[Ref]]) -> Sequence[Ref]:
+    """ Pages through refs from the newest to the oldest. The (date, id) of
+    the page edges are kept in the session as the cursors of the next pages,
+    so each page only fetches its own rows with `fetch(limit, before, after)`
+    instead of the whole table. """
+    before, after = st.session_state.get(key, (None, None))
+
+    # one more ref tells whether there is a page further in that direction
+    refs = fetch(item_per_page + 1, before, after)
+    if after is not None and before is None:
+        has_newer, has_older = len(refs) > item_per_page, True
+        refs = refs[-item_per_page:]
+    else:
+        has_newer, has_older = before is not None, len(refs) > item_per_page
+        refs = refs[:item_per_page]
+
+    cols = st.columns(2)
+    if cols[0].button("Newer | 较新", disabled=not has_newer or not refs, use_container_width=True):
+        st.session_state[key] = (None, (refs[0].date, refs[0].id))
+        st.rerun()
+    if cols[1].button("Older | 较旧", disabled=not has_older or not refs, use_container_width=True):
+        st.session_state[key] = ((refs[-1].date, refs[-1].id), None)
+        st.rerun()
+
+    return refs
+
+
+Item = TypeVar("Item")
+
+
+def offset_pager(key: str, item_per_page: int, fetch: Callable[[int, int], Sequence[Item]]) -> Sequence[Item]:
+    """ Pages through ranked results such as search hits, each page fetching
+    its own rows with `fetch(limit, offset)`. The page number is kept in the
+    session under `key`, which should change along with the query. """
+    page = st.session_state.get(key, 0)
+
+    # one more item tells whether there is a next page
+    items = fetch(item_per_page + 1, page * item_per_page)
+    has_next = len(items) > item_per_page
+    items = items[:item_per_page]
+
+    cols = st.columns(2)
+    if cols[0].button("Previous | 上一页", disabled=page == 0, use_container_width=True):
+        st.session_state[key] = page - 1
+        st.rerun()
+    if cols[1].button("Next | 下一页", disabled=not has_next, use_container_width=True):
+        st.session_state[key] = page + 1
+        st.rerun()
+
+    return items
@@ -1,8 +1,9 @@
-from pinhole.servers.appserver.common import navi, auth, project, base_path, paginator
+from pinhole.servers.appserver.common import navi, auth, project, base_path, offset_pager, ref_pager
 from pinhole.datasource.publication import Publication, PublicationRef
 from pinhole.datasource.summary import Summary
+from pinhole.datasource.search import SearchHit
 
-from typing import List, Callable
+from typing import List, Callable, Sequence, Union
 from datetime import datetime
 
 import streamlit as st
@@ -18,7 +19,7 @@ navi()
 auth_state = auth()
 
 
-def display_publications(prefs: List[PublicationRef]) -> None:
+def display_publications(prefs: Sequence[Union[PublicationRef, SearchHit]]) -> None:
     for pref in prefs:
         date = pref.date.strftime("%Y-%m-%d")
         cols = st.columns([4, 1, 1])
@@ -27,23 +28,20 @@ def display_publications(prefs: List[PublicationRef]) -> None:
         cols[2].link_button("Summary | 综述", url=f"{base_path}/publication?id={pref.id}", use_container_width=True)
 
 
-prefs = project.get_publication_refs()
-prefs.sort(key=lambda ref: ref.date, reverse=True)
 item_per_page = 15
 
 cols = st.columns([3, 1])
-keywords = [kw.lower() for kw in cols[0].text_input(label="Search by keyword").split()]
+query = cols[0].text_input(label="Search by keyword").strip()
 
-if len(keywords) > 0:
-    matched_prefs: List[PublicationRef] = []
-    for pref in prefs:
-        title = pref.title.lower()
-        if all(kw in title for kw in keywords):
-            matched_prefs.append(pref)
-
-    prefs = matched_prefs
+if query != "":
+    with cols[1]:
+        hits = offset_pager(f"publication_search:{query}", item_per_page, lambda limit, offset:
+                            project.search(query, limit=limit, offset=offset, kind='publication'))
 
-with cols[1]:
-    page = paginator(item_per_page, len(prefs))
+    display_publications(hits)
+else:
+    with cols[1]:
+        prefs = ref_pager("publication_page", item_per_page, lambda limit, before, after:
+                          project.get_publication_refs(limit, before=before, after=after))
 
-display_publications(prefs[page * item_per_page:(page + 1) * item_per_page])
+    display_publications(prefs)
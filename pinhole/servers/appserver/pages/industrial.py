@@ -1,8 +1,9 @@
-from pinhole.servers.appserver.common import project, navi, auth, paginator
+from pinhole.servers.appserver.common import project, navi, auth, offset_pager, ref_pager
 from pinhole.datasource.document import DocumentRef
+from pinhole.datasource.search import SearchHit
 from datetime import datetime
 
-from typing import List, Callable
+from typing import List, Callable, Sequence, Union
 
 import streamlit as st
 
@@ -17,7 +18,7 @@ navi()
 auth_state = auth()
 
 
-def display_documents(drefs: List[DocumentRef]) -> None:
+def display_documents(drefs: Sequence[Union[DocumentRef, SearchHit]]) -> None:
     for dref in drefs:
         date = dref.date.strftime("%Y-%m-%d")
         cols = st.columns([4, 1, 1])
@@ -26,23 +27,20 @@ def display_documents(drefs: List[DocumentRef]) -> None:
         cols[2].link_button("Summary | 综述", url=f"/document?id={dref.id}", use_container_width=True)
 
 
-docrefs = project.get_document_refs()
-docrefs.sort(key=lambda ref: ref.date, reverse=True)
 item_per_page = 15
 
 cols = st.columns([3, 1])
-keywords = [kw.lower() for kw in cols[0].text_input(label="Search by keyword").split()]
+query = cols[0].text_input(label="Search by keyword").strip()
 
-if len(keywords) > 0:
-    matched_docrefs: List[DocumentRef] = []
-    for dref in docrefs:
-        title = dref.title.lower()
-        if all(kw in title for kw in keywords):
-            matched_docrefs.append(dref)
+if query != "":
+    with cols[1]:
+        hits = offset_pager(f"document_search:{query}", item_per_page, lambda limit, offset:
+                            project.search(query, limit=limit, offset=offset, kind='document'))
 
-    docrefs = matched_docrefs
+    display_documents(hits)
+else:
+    with cols[1]:
+        drefs = ref_pager("document_page", item_per_page, lambda limit, before, after:
+                          project.get_document_refs(limit, before=before, after=after))
 
-with cols[1]:
-    page = paginator(item_per_page, len(docrefs))
-
-display_documents(docrefs[page * item_per_page:(page + 1) * item_per_page])
+    display_documents(drefs)
@@ -0,0 +1,45 @@
+from pinhole.project import Project
+
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from os import cpu_count
+from typing import Callable, ParamSpec, TypeVar
+
+import asyncio
+
+
+P = ParamSpec("P")
+T = TypeVar("T")
+
+
+class AsyncProject:
+    """ Runs the blocking methods of a `Project` off the event loop.
+
+    Reads are spread over a bounded pool of reader threads, each holding its
+    own sqlite connection, while all writes go through a single writer thread,
+    so that writers never contend with each other for the database lock and a
+    slow query only delays the requests queued behind it. """
+
+    def __init__(self, project: Project, nreaders: int = 0) -> None:
+        self.project = project
+
+        if nreaders <= 0:
+            nreaders = min(8, (cpu_count() or 1) * 2)
+
+        self.readers = ThreadPoolExecutor(nreaders, thread_name_prefix="pinhole-reader")
+        self.writer = ThreadPoolExecutor(1, thread_name_prefix="pinhole-writer")
+
+    async def read(self, fn: Callable[P, T], *args: P.args, **kwargs: P.kwargs) -> T:
+        """ Calls `fn`, a read-only method of the project, on a reader thread. """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.readers, partial(fn, *args, **kwargs))
+
+    async def write(self, fn: Callable[P, T], *args: P.args, **kwargs: P.kwargs) -> T:
+        """ Calls `fn`, a method of the project modifying it, on the writer thread. """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.writer, partial(fn, *args, **kwargs))
+
+    def shutdown(self) -> None:
+        self.readers.shutdown(wait=True)
+        self.writer.shutdown(wait=True)
+        self.project.close()
@@ -0,0 +1,56 @@
+from typing import Any, Dict, Iterable, Iterator
+
+import base64
+import hashlib
+import math
+
+
+class BloomFilter:
+    """ A compact set of strings answering membership queries with no false
+    negatives and a false positive rate close to `error_rate` while holding at
+    most `capacity` items. """
+
+    def __init__(self, capacity: int, error_rate: float = 0.01) -> None:
+        capacity = max(capacity, 1)
+        nbits = math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2)
+
+        self.nbits = max(nbits, 8)
+        self.nhashes = max(round(self.nbits / capacity * math.log(2)), 1)
+        self.bits = bytearray((self.nbits + 7) // 8)
+
+    def __positions(self, item: str) -> Iterator[int]:
+        # double hashing: the k positions are h1 + i * h2 for i in [0, k)
+        digest = hashlib.blake2b(item.encode('utf8'), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        for i in range(self.nhashes):
+            yield (h1 + i * h2) % self.nbits
+
+    def add(self, item: str) -> None:
+        for pos in self.__positions(item):
+            self.bits[pos >> 3] |= 1 << (pos & 7)
+
+    def update(self, items: Iterable[str]) -> None:
+        for item in items:
+            self.add(item)
+
+    def __contains__(self, item: str) -> bool:
+        return all(self.bits[pos >> 3] & (1 << (pos & 7)) for pos in self.__positions(item))
+
+    def to_json(self) -> Dict[str, Any]:
+        return {
+            "nbits": self.nbits,
+            "nhashes": self.nhashes,
+            "bits": base64.b64encode(self.bits).decode('ascii')
+        }
+
+    @classmethod
+    def from_json(cls, data: Dict[str, Any]) -> 'BloomFilter':
+        bloom = cls.__new__(cls)
+        bloom.nbits = int(data["nbits"])
+        bloom.nhashes = int(data["nhashes"])
+        bloom.bits = bytearray(base64.b64decode(data["bits"]))
+        if len(bloom.bits) != (bloom.nbits + 7) // 8:
+            raise ValueError(f"bloom filter of {bloom.nbits} bits cannot hold {len(bloom.bits)} bytes")
+
+        return bloom
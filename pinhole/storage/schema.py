@@ -0,0 +1,192 @@
+from loguru import logger
+
+from typing import List, Sequence
+
+import sqlite3
+
+
+# tables whose changes are counted in `table_versions`
+VERSIONED_TABLES = ("documents", "summaries", "publications")
+
+# the current time in seconds since the epoch, with sub-second precision
+UNIX_TIME_NOW = "((julianday('now') - 2440587.5) * 86400.0)"
+
+# the tables indexed for full-text search, the column of `summaries` referring
+# to their rows, and the expressions of their title, authors and body columns
+SEARCH_SOURCES = (
+    ("documents", "document_id", ("{row}.title", "''", "{row}.content")),
+    ("publications", "publication_id", ("{row}.title", "{row}.authors", "{row}.abstract")),
+)
+
+# the columns of every search index
+SEARCH_COLUMNS = "rowid, title, authors, body, summary"
+
+
+def search_values(columns: Sequence[str], row: str, summary: str) -> str:
+    """ The values of the search index columns for `row`, a row of one of the
+    SEARCH_SOURCES tables whose columns are given by `columns`. """
+    return ", ".join([f"{row}.id", *(column.format(row=row) for column in columns), summary])
+
+
+def search_triggers(table: str, key: str, columns: Sequence[str]) -> List[str]:
+    """ The triggers keeping the external-content index `{table}_search` in
+    sync. Entries of such an index are removed by passing the values they were
+    indexed with to the 'delete' command, so every change of a row or of its
+    summary removes the former entry before adding the new one. """
+    index = f"{table}_search"
+    summary_of = "COALESCE((SELECT content FROM summaries WHERE {key} = {row}.id), '')"
+    add = f"INSERT INTO {index} ({SEARCH_COLUMNS}) VALUES ({{values}});"
+    remove = f"INSERT INTO {index} ({index}, {SEARCH_COLUMNS}) VALUES ('delete', {{values}});"
+    add_row = f"INSERT INTO {index} ({SEARCH_COLUMNS}) SELECT {{values}} FROM {table} t WHERE t.id = {{id}};"
+    remove_row = (f"INSERT INTO {index} ({index}, {SEARCH_COLUMNS}) "
+                  f"SELECT 'delete', {{values}} FROM {table} t WHERE t.id = {{id}};")
+
+    def values(row: str) -> str:
+        return search_values(columns, row, summary_of.format(key=key, row=row))
+
+    def summary_removed(id: str, summary: str) -> str:
+        return (remove_row.format(values=search_values(columns, "t", summary), id=id) + "\n" +
+                add_row.format(values=search_values(columns, "t", "''"), id=id))
+
+    def summary_added(id: str, summary: str) -> str:
+        return (remove_row.format(values=search_values(columns, "t", "''"), id=id) + "\n" +
+                add_row.format(values=search_values(columns, "t", summary), id=id))
+
+    bodies = {
+        f"{table}_search_insert AFTER INSERT ON {table}": add.format(values=values("new")),
+        f"{table}_search_update AFTER UPDATE ON {table}":
+            remove.format(values=values("old")) + "\n" + add.format(values=values("new")),
+        f"{table}_search_delete AFTER DELETE ON {table}": remove.format(values=values("old")),
+        f"{table}_summary_search_insert AFTER INSERT ON summaries":
+            summary_added(f"new.{key}", "COALESCE(new.content, '')"),
+        f"{table}_summary_search_update AFTER UPDATE ON summaries":
+            summary_removed(f"old.{key}", "COALESCE(old.content, '')") + "\n" +
+            summary_added(f"new.{key}", "COALESCE(new.content, '')"),
+        f"{table}_summary_search_delete AFTER DELETE ON summaries":
+            summary_removed(f"old.{key}", "COALESCE(old.content, '')"),
+    }
+    return [f"CREATE TRIGGER IF NOT EXISTS {head} BEGIN\n{body}\nEND" for head, body in bodies.items()]
+
+
+# Every entry upgrades the database by one version. The current version is kept
+# in `PRAGMA user_version`, so entries must never be edited once released; new
+# tables, indexes or triggers are added by appending another migration.
+MIGRATIONS: List[List[str]] = [
+    # version 1: the initial tables
+    [
+        """
+        CREATE TABLE IF NOT EXISTS documents (
+            id integer PRIMARY KEY,
+            title text NOT NULL,
+            date integer NOT NULL,
+            url text NOT NULL UNIQUE,
+            publisher text,
+            content text
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS summaries (
+            id integer PRIMARY KEY,
+            document_id integer UNIQUE,
+            publication_id integer UNIQUE,
+            model text,
+            content text
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS publications (
+            id integer PRIMARY KEY,
+            title text,
+            authors text,
+            date integer,
+            booktitle text,
+            url text UNIQUE,
+            publisher text,
+            domain_identifier text UNIQUE,
+            type text,
+            abstract text
+        )
+        """,
+    ],
+    # version 2: indexes backing the ordered and filtered list queries
+    [
+        "CREATE INDEX IF NOT EXISTS documents_date ON documents (date)",
+        "CREATE INDEX IF NOT EXISTS documents_publisher_date ON documents (publisher, date)",
+        "CREATE INDEX IF NOT EXISTS publications_date ON publications (date)",
+        "CREATE INDEX IF NOT EXISTS publications_publisher_date ON publications (publisher, date)",
+        "CREATE INDEX IF NOT EXISTS publications_type_date ON publications (type, date)",
+    ],
+    # version 3: full-text indexes over documents and publications along with
+    # their summaries. They are external-content indexes reading the indexed
+    # text back from a view over each table and its summaries, so that only
+    # the index itself is stored
+    [
+        *(
+            sql
+            for (table, key, columns) in SEARCH_SOURCES
+            for sql in [
+                f"""
+                CREATE VIEW IF NOT EXISTS {table}_search_source AS
+                    SELECT {search_values([f"{c} AS {n}" for c, n in zip(columns, ("title", "authors", "body"))],
+                                          "t", "COALESCE(s.content, '') AS summary")}
+                    FROM {table} t LEFT JOIN summaries s ON s.{key} = t.id
+                """,
+                f"""
+                CREATE VIRTUAL TABLE IF NOT EXISTS {table}_search USING fts5 (
+                    title, authors, body, summary,
+                    content = '{table}_search_source', content_rowid = 'id',
+                    tokenize = 'unicode61 remove_diacritics 2'
+                )
+                """,
+                *search_triggers(table, key, columns),
+                f"INSERT INTO {table}_search ({table}_search) VALUES ('rebuild')",
+            ]
+        ),
+    ],
+    # version 4: data versions of the tables, used to validate cached responses
+    [
+        """
+        CREATE TABLE IF NOT EXISTS table_versions (
+            name text PRIMARY KEY,
+            version integer NOT NULL,
+            modified real NOT NULL
+        )
+        """,
+        *(
+            f"""
+            INSERT OR IGNORE INTO table_versions (name, version, modified)
+                VALUES ('{table}', 0, {UNIX_TIME_NOW})
+            """
+            for table in VERSIONED_TABLES
+        ),
+        *(
+            f"""
+            CREATE TRIGGER IF NOT EXISTS {table}_version_{event.lower()} AFTER {event} ON {table} BEGIN
+                UPDATE table_versions SET version = version + 1, modified = {UNIX_TIME_NOW}
+                    WHERE name = '{table}';
+            END
+            """
+            for table in VERSIONED_TABLES for event in ("INSERT", "UPDATE", "DELETE")
+        ),
+    ],
+]
+
+
+def migrate(dbconn: sqlite3.Connection) -> None:
+    """ Brings the database up to the latest schema version. """
+    while True:
+        with dbconn:
+            # DDL does not open a transaction implicitly, so start one here to
+            # apply each migration atomically and keep concurrent processes out
+            dbconn.execute("BEGIN IMMEDIATE")
+            (version,) = dbconn.execute("PRAGMA user_version").fetchone()
+            if version > len(MIGRATIONS):
+                raise Exception(f"database schema version {version} is newer than supported ({len(MIGRATIONS)})")
+            elif version == len(MIGRATIONS):
+                return
+
+            logger.info(f"migrating database schema to version {version + 1}")
+            for sql in MIGRATIONS[version]:
+                dbconn.execute(sql)
+
+            dbconn.execute(f"PRAGMA user_version = {version + 1}")
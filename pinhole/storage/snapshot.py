@@ -0,0 +1,105 @@
+from pinhole.project import Project
+
+from loguru import logger
+
+from os import getpid, listdir, makedirs, remove, replace
+from os.path import exists, getmtime, join
+from threading import Lock
+from typing import Dict, Literal, Optional
+
+import gzip
+import shutil
+
+try:
+    import zstandard  # type: ignore
+except ImportError:
+    zstandard = None
+
+
+Compression = Literal['gzip', 'zstd']
+
+COMPRESSION_SUFFIXES: Dict[Optional[Compression], str] = {
+    None: "",
+    'gzip': ".gz",
+    'zstd': ".zst",
+}
+
+CHUNK_SIZE = 1 << 20
+
+
+class SnapshotManager:
+    """ Maintains downloadable snapshots of the project database.
+
+    Snapshots are taken with `VACUUM INTO`, which copies the database within
+    a single read transaction, so writers are never locked out while one is
+    being made and their commits do not restart it. Snapshots are named after
+    the modification time of the database and reused as long as it is
+    unchanged, which gives clients a stable file to resume an interrupted
+    download from, even across apiserver processes. """
+
+    def __init__(self, project: Project, directory: str = "snapshots") -> None:
+        self.project = project
+        self.directory = join(project.project_path, directory)
+        self.__lock = Lock()
+
+        makedirs(self.directory, exist_ok=True)
+
+    @staticmethod
+    def is_supported(compression: Optional[Compression]) -> bool:
+        return compression != 'zstd' or zstandard is not None
+
+    def __database_mtime(self) -> float:
+        # committed changes touch the write-ahead log first, then the database
+        # file when the log is checkpointed
+        database_path = self.project.database_realpath
+        mtimes = [getmtime(path) for path in (database_path, database_path + "-wal") if exists(path)]
+        return max(mtimes, default=0.0)
+
+    def __compress(self, source: str, target: str, compression: Compression) -> None:
+        with open(source, "rb") as fsrc:
+            if compression == 'gzip':
+                with gzip.open(target, "wb", compresslevel=6) as fgz:
+                    shutil.copyfileobj(fsrc, fgz, CHUNK_SIZE)
+            elif compression == 'zstd':
+                with open(target, "wb") as fdst:
+                    with zstandard.ZstdCompressor(level=3, threads=-1).stream_writer(fdst) as fzst:
+                        shutil.copyfileobj(fsrc, fzst, CHUNK_SIZE)
+
+    def __remove_outdated(self, current: str, suffix: str) -> None:
+        # files being downloaded remain readable after they are unlinked
+        for name in listdir(self.directory):
+            if name.startswith("database-") and name.endswith(".db" + suffix) and name != current:
+                try:
+                    remove(join(self.directory, name))
+                except FileNotFoundError:
+                    pass
+
+    def get(self, compression: Optional[Compression] = None) -> str:
+        """ Returns the path of an up-to-date snapshot, taking a new one if the
+        database has changed since the last one. This call blocks, and should
+        be run on a worker thread. """
+        if not self.is_supported(compression):
+            raise ValueError(f"compression {compression} is not supported, please install zstandard")
+
+        suffix = COMPRESSION_SUFFIXES[compression]
+        with self.__lock:
+            stamp = f"{self.__database_mtime():.6f}".replace(".", "")
+            name = f"database-{stamp}.db{suffix}"
+            snapshot_path = join(self.directory, name)
+            if exists(snapshot_path):
+                return snapshot_path
+
+            # other processes may be taking the same snapshot, so work on
+            # private files and only move the complete one into place
+            backup_path = f"{snapshot_path}.{getpid()}.backup"
+            self.project.backup(backup_path)
+            if compression is None:
+                replace(backup_path, snapshot_path)
+            else:
+                self.__compress(backup_path, f"{snapshot_path}.{getpid()}.tmp", compression)
+                remove(backup_path)
+                replace(f"{snapshot_path}.{getpid()}.tmp", snapshot_path)
+
+            logger.info(f"database snapshot created at {snapshot_path}")
+            self.__remove_outdated(name, suffix)
+            return snapshot_path
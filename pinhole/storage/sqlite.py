@@ -0,0 +1,241 @@
+from pinhole.metrics import REGISTRY
+
+from loguru import logger
+
+from contextlib import contextmanager
+from functools import lru_cache
+from os import environ, getpid
+from threading import local, Lock
+from time import perf_counter
+from typing import IO, Any, Iterable, Iterator, List, Optional, Tuple
+
+import re
+import sqlite3
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None  # type: ignore
+
+
+# pragmas applied to every new connection. WAL lets readers proceed while the
+# collector is writing, and `synchronous=NORMAL` is durable enough under WAL
+# while avoiding an fsync for every committed transaction.
+DEFAULT_PRAGMAS: List[Tuple[str, str]] = [
+    ("journal_mode", "WAL"),
+    ("synchronous", "NORMAL"),
+    ("cache_size", "-65536"),       # 64 MiB of page cache per connection
+    ("mmap_size", "268435456"),     # map up to 256 MiB of the database file
+    ("temp_store", "MEMORY"),
+]
+
+DEFAULT_BUSY_TIMEOUT: float = 10.0
+
+# statements taking longer than this many seconds, fetching included, are logged
+SLOW_QUERY_THRESHOLD = float(environ.get('PINHOLE_SLOW_QUERY_SECONDS', 0.25))
+
+SQL_DURATION = REGISTRY.histogram(
+    "pinhole_sql_statement_duration_seconds",
+    "Time from the execution of a statement to the last fetch of its rows.",
+    ("statement",),
+    (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+)
+SQL_ROWS = REGISTRY.counter("pinhole_sql_rows_total", "Rows fetched from statements.", ("statement",))
+
+
+@lru_cache(maxsize=1024)
+def statement_label(sql: str) -> str:
+    """ Shortens a statement into a metric label, statements differing only
+    by the number of their placeholders sharing the same label. """
+    label = re.sub(r"\?(\s*,\s*\?)+", "?, ...", " ".join(sql.split()))
+    return label if len(label) <= 160 else label[:157] + "..."
+
+
+class InstrumentedCursor(sqlite3.Cursor):
+    """ A cursor timing each statement from its execution to the last fetch
+    of its rows, and counting the rows fetched. Statements are reported once
+    their rows are exhausted, or when the cursor moves on or is released. """
+
+    def __init__(self, connection: sqlite3.Connection) -> None:
+        super().__init__(connection)
+        self.__statement: Optional[str] = None
+        self.__begin = 0.0
+        self.__rows = 0
+
+    def __finish(self) -> None:
+        if self.__statement is None:
+            return
+
+        elapsed = perf_counter() - self.__begin
+        label = statement_label(self.__statement)
+        self.__statement = None
+
+        SQL_DURATION.observe(elapsed, label)
+        if self.__rows:
+            SQL_ROWS.inc(label, amount=self.__rows)
+        if elapsed >= SLOW_QUERY_THRESHOLD:
+            logger.warning(f"slow query took {elapsed * 1000:.1f}ms for {self.__rows} rows: {label}")
+
+    def __start(self, sql: str) -> None:
+        self.__finish()
+        self.__statement = sql
+        self.__rows = 0
+        self.__begin = perf_counter()
+
+    def execute(self, sql: str, parameters: Any = (), /) -> 'InstrumentedCursor':
+        self.__start(sql)
+        super().execute(sql, parameters)
+        if self.description is None:
+            self.__finish()
+        return self
+
+    def executemany(self, sql: str, parameters: Iterable[Any], /) -> 'InstrumentedCursor':
+        self.__start(sql)
+        super().executemany(sql, parameters)
+        self.__finish()
+        return self
+
+    def fetchone(self) -> Any:
+        row = super().fetchone()
+        if row is None:
+            self.__finish()
+        else:
+            self.__rows += 1
+        return row
+
+    def fetchmany(self, size: Optional[int] = None) -> List[Any]:
+        size = self.arraysize if size is None else size
+        rows = super().fetchmany(size)
+        self.__rows += len(rows)
+        if len(rows) < size:
+            self.__finish()
+        return rows
+
+    def fetchall(self) -> List[Any]:
+        rows = super().fetchall()
+        self.__rows += len(rows)
+        self.__finish()
+        return rows
+
+    def close(self) -> None:
+        self.__finish()
+        super().close()
+
+    def __del__(self) -> None:
+        try:
+            self.__finish()
+        except Exception:
+            # module globals may already be gone at interpreter shutdown
+            pass
+
+
+class ConnectionManager:
+    """ Hands out one `sqlite3.Connection` per thread for a single database file.
+
+    Connections are created lazily on first use in each thread, configured with
+    `DEFAULT_PRAGMAS`, and kept open until `close` is called. Connections are
+    never shared between processes: a forked child opens its own.
+
+    Several processes may write to the same database, e.g. the workers of the
+    apiserver next to the collector. Transactions therefore take the write
+    lock when they begin, and when `lock_path` is given, writers also queue on
+    an exclusive lock of that file, which is fairer than the polling busy
+    handler of sqlite under contention. """
+
+    def __init__(self, path: str,
+                 pragmas: List[Tuple[str, str]] = DEFAULT_PRAGMAS,
+                 busy_timeout: float = DEFAULT_BUSY_TIMEOUT,
+                 lock_path: Optional[str] = None) -> None:
+        self.path = path
+        self.pragmas = pragmas
+        self.busy_timeout = busy_timeout
+        self.lock_path = lock_path
+
+        self.__pid = getpid()
+        self.__local = local()
+        self.__lock = Lock()
+        self.__connections: List[sqlite3.Connection] = []
+
+        self.__write_lock = Lock()
+        self.__lock_file: Optional[IO[bytes]] = None
+
+    def __connect(self) -> sqlite3.Connection:
+        dbconn = sqlite3.connect(self.path, timeout=self.busy_timeout)
+        for name, value in self.pragmas:
+            dbconn.execute(f"PRAGMA {name} = {value}")
+
+        with self.__lock:
+            self.__connections.append(dbconn)
+
+        logger.debug(f"new sqlite connection to {self.path} ({len(self.__connections)} in total)")
+        return dbconn
+
+    def __check_process(self) -> None:
+        # connections inherited through fork must not be used by the child,
+        # nor closed since that would disturb the parent, so they are dropped
+        if self.__pid != getpid():
+            self.__pid = getpid()
+            self.__local = local()
+            self.__connections = []
+            self.__write_lock = Lock()
+            self.__lock_file = None
+
+    @property
+    def connection(self) -> sqlite3.Connection:
+        self.__check_process()
+        dbconn = getattr(self.__local, "dbconn", None)
+        if dbconn is None:
+            dbconn = self.__connect()
+            self.__local.dbconn = dbconn
+
+        return dbconn
+
+    def cursor(self) -> sqlite3.Cursor:
+        return self.connection.cursor(InstrumentedCursor)
+
+    @contextmanager
+    def __process_lock(self) -> Iterator[None]:
+        if self.lock_path is None or fcntl is None:
+            yield
+            return
+
+        if self.__lock_file is None:
+            self.__lock_file = open(self.lock_path, "ab")
+
+        fcntl.flock(self.__lock_file.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(self.__lock_file.fileno(), fcntl.LOCK_UN)
+
+    @contextmanager
+    def transaction(self) -> Iterator[sqlite3.Cursor]:
+        """ Yields a cursor whose statements are committed together when the
+        block exits, or rolled back if it raises. """
+        dbconn = self.connection
+        with self.__write_lock, self.__process_lock(), dbconn:
+            # a deferred transaction reading before it writes fails at once
+            # when another process commits in between, while an immediate one
+            # waits for the write lock up to the busy timeout
+            dbconn.execute("BEGIN IMMEDIATE")
+            yield dbconn.cursor(InstrumentedCursor)
+
+    def close(self) -> None:
+        self.__check_process()
+        if self.__lock_file is not None:
+            self.__lock_file.close()
+            self.__lock_file = None
+
+        with self.__lock:
+            connections = list(self.__connections)
+            self.__connections.clear()
+
+        # connections may only be closed from the thread owning them, so the
+        # others are left to be released by the garbage collector
+        for dbconn in connections:
+            try:
+                dbconn.close()
+            except sqlite3.ProgrammingError:
+                pass
+
+        self.__local = local()
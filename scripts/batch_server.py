@@ -0,0 +1,184 @@
+""" A local stand-in for the batch endpoints of an OpenAI-compatible api, to
+run the batch summarization of the collector without a provider. Files are
+kept in memory, and a batch completes `--delay` seconds after its creation
+with a canned answer to every chat completion request of its input file.
+
+    python3 scripts/batch_server.py [--port 8820] [--delay 5]
+    OPENAI_BASE_URL=http://127.0.0.1:8820/v1 OPENAI_API_KEY=test \\
+        python3 -m pinhole collector --summarizing --batch --batch-wait 1
+"""
+from argparse import ArgumentParser
+from email.parser import BytesParser
+from email.policy import HTTP
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from itertools import count
+from threading import Lock
+from time import time
+from typing import Any, Dict, List, Optional
+
+import json
+
+
+class State:
+
+    def __init__(self, delay: float) -> None:
+        self.delay = delay
+        self.files: Dict[str, bytes] = {}
+        self.batches: Dict[str, Dict[str, Any]] = {}
+        self.lock = Lock()
+        self.ids = count(1)
+
+    def add_file(self, content: bytes) -> str:
+        with self.lock:
+            file_id = f"file-{next(self.ids)}"
+            self.files[file_id] = content
+            return file_id
+
+    def add_batch(self, input_file_id: str) -> Dict[str, Any]:
+        with self.lock:
+            batch: Dict[str, Any] = {
+                "id": f"batch-{next(self.ids)}",
+                "object": "batch",
+                "endpoint": "/v1/chat/completions",
+                "input_file_id": input_file_id,
+                "completion_window": "24h",
+                "status": "validating",
+                "created_at": int(time()),
+                "output_file_id": None,
+                "error_file_id": None,
+            }
+            self.batches[batch["id"]] = batch
+            return batch
+
+    def get_batch(self, batch_id: str) -> Optional[Dict[str, Any]]:
+        with self.lock:
+            batch = self.batches.get(batch_id)
+            if batch is None:
+                return None
+
+            if batch["status"] == "validating":
+                batch["status"] = "in_progress"
+            elif batch["status"] == "in_progress" and time() >= batch["created_at"] + self.delay:
+                self.__complete(batch)
+
+            return dict(batch)
+
+    def __complete(self, batch: Dict[str, Any]) -> None:
+        outputs: List[str] = []
+        errors: List[str] = []
+        for line in self.files[batch["input_file_id"]].decode('utf8').splitlines():
+            if not line.strip():
+                continue
+
+            request = json.loads(line)
+            if request.get("url") != "/v1/chat/completions":
+                errors.append(json.dumps({
+                    "custom_id": request.get("custom_id"),
+                    "response": None,
+                    "error": {"code": "invalid_url", "message": f"unsupported url {request.get('url')}"}
+                }))
+                continue
+
+            outputs.append(json.dumps({
+                "id": f"response-{next(self.ids)}",
+                "custom_id": request["custom_id"],
+                "response": {"status_code": 200, "body": answer(request["body"])},
+                "error": None,
+            }, ensure_ascii=False))
+
+        batch["output_file_id"] = f"file-{next(self.ids)}"
+        self.files[batch["output_file_id"]] = "\n".join(outputs).encode('utf8')
+        if errors:
+            batch["error_file_id"] = f"file-{next(self.ids)}"
+            self.files[batch["error_file_id"]] = "\n".join(errors).encode('utf8')
+
+        batch["status"] = "completed"
+        batch["request_counts"] = {"total": len(outputs) + len(errors), "completed": len(outputs),
+                                   "failed": len(errors)}
+
+
+def answer(body: Dict[str, Any]) -> Dict[str, Any]:
+    prompt = body["messages"][-1]["content"]
+    lines = [line.strip() for line in prompt.splitlines() if line.strip()]
+    content = "stand-in summary of " + (lines[-1][:200] if lines else "an empty prompt")
+    ninput = sum(len(message["content"]) for message in body["messages"]) // 4
+    return {
+        "id": "chatcmpl-batch",
+        "object": "chat.completion",
+        "model": body["model"],
+        "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}],
+        "usage": {"prompt_tokens": ninput, "completion_tokens": len(content) // 4,
+                  "total_tokens": ninput + len(content) // 4},
+    }
+
+
+def make_handler(state: State) -> type:
+
+    class Handler(BaseHTTPRequestHandler):
+
+        def reply(self, status: int, obj: Any = None, raw: Optional[bytes] = None) -> None:
+            data = raw if raw is not None else json.dumps(obj).encode('utf8')
+            self.send_response(status)
+            self.send_header("Content-Type", "application/octet-stream" if raw is not None else "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def not_found(self) -> None:
+            self.reply(404, {"error": {"message": f"{self.path} not found"}})
+
+        def do_POST(self) -> None:
+            body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            if self.path == "/v1/files":
+                # a multipart form with the purpose and the file
+                header = f"Content-Type: {self.headers['Content-Type']}\r\n\r\n".encode('utf8')
+                message = BytesParser(policy=HTTP).parsebytes(header + body)
+                for part in message.iter_parts():
+                    if part.get_param("name", header="content-disposition") == "file":
+                        file_id = state.add_file(bytes(part.get_payload(decode=True)))
+                        self.reply(200, {"id": file_id, "object": "file", "purpose": "batch"})
+                        return
+                self.reply(400, {"error": {"message": "no file uploaded"}})
+            elif self.path == "/v1/batches":
+                input_file_id = json.loads(body)["input_file_id"]
+                if input_file_id not in state.files:
+                    self.reply(400, {"error": {"message": f"unknown file {input_file_id}"}})
+                    return
+                self.reply(200, state.add_batch(input_file_id))
+            else:
+                self.not_found()
+
+        def do_GET(self) -> None:
+            parts = self.path.strip("/").split("/")
+            if parts[:2] == ["v1", "batches"] and len(parts) == 3:
+                batch = state.get_batch(parts[2])
+                if batch is None:
+                    self.not_found()
+                else:
+                    self.reply(200, batch)
+            elif parts[:2] == ["v1", "files"] and len(parts) == 4 and parts[3] == "content":
+                content = state.files.get(parts[2])
+                if content is None:
+                    self.not_found()
+                else:
+                    self.reply(200, raw=content)
+            else:
+                self.not_found()
+
+    return Handler
+
+
+def main() -> None:
+    parser = ArgumentParser()
+    parser.add_argument("--port", type=int, default=8820)
+    parser.add_argument("--delay", type=float, default=5,
+                        help="the seconds after which a batch completes")
+    args = parser.parse_args()
+
+    server = ThreadingHTTPServer(("127.0.0.1", args.port), make_handler(State(args.delay)))
+    print(f"batch stand-in listening on http://127.0.0.1:{args.port}/v1")
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
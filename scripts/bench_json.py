@@ -0,0 +1,100 @@
+""" Compares the time to serve a full `/publication/list` through FastAPI's
+generic encoder and through the fast JSON path (PINHOLE_FAST_JSON=1). For each
+table size a temporary project is filled with publications, then an apiserver
+is started in each mode and the endpoint is requested a few times.
+
+    python3 scripts/bench_json.py [--counts 10000,100000,1000000] [--repeat 3] [--port 8812]
+"""
+from pinhole.datasource.publication import Publication
+from pinhole.project import Project
+
+from argparse import ArgumentParser
+from datetime import datetime, timedelta
+from statistics import median
+from tempfile import TemporaryDirectory
+from time import perf_counter, sleep
+from typing import List
+
+import os
+import requests
+import subprocess
+import sys
+
+
+def populate(project: Project, count: int, batch_size: int = 10000) -> None:
+    base = datetime(2024, 1, 1)
+    for i in range(0, count, batch_size):
+        project.create_publications([
+            Publication.build(
+                f"A study of topic number {j} in large scale distributed systems",
+                ["Alice Example", "Bob Example"],
+                base + timedelta(minutes=j),
+                "Proceedings of the Benchmark Conference",
+                f"https://arxiv.org/abs/{j}",
+                "arxiv",
+                f"arxiv:{j}",
+                'preprint'
+            )
+            for j in range(i, min(i + batch_size, count))
+        ])
+
+
+def wait_until_ready(base_addr: str, timeout: float = 60.0) -> None:
+    deadline = perf_counter() + timeout
+    while perf_counter() < deadline:
+        try:
+            requests.get(f"{base_addr}/", timeout=1.0)
+            return
+        except requests.ConnectionError:
+            sleep(0.2)
+
+    raise Exception(f"apiserver at {base_addr} did not start in {timeout} seconds")
+
+
+def measure(project_path: str, port: int, fast_json: bool, repeat: int) -> List[float]:
+    env = dict(os.environ, PINHOLE_PROJECT=project_path, PINHOLE_FAST_JSON="1" if fast_json else "0")
+    server = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "pinhole.servers.apiserver.main:app",
+         "--port", str(port), "--log-level", "warning"],
+        env=env
+    )
+
+    base_addr = f"http://127.0.0.1:{port}"
+    try:
+        wait_until_ready(base_addr)
+        timings: List[float] = []
+        for _ in range(repeat):
+            begin = perf_counter()
+            # compression is left out to measure the serialization alone
+            req = requests.get(f"{base_addr}/publication/list", headers={"Accept-Encoding": "identity"})
+            req.raise_for_status()
+            timings.append(perf_counter() - begin)
+
+        return timings
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def main() -> None:
+    parser = ArgumentParser("bench_json")
+    parser.add_argument("--counts", type=str, default="10000,100000,1000000")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--port", type=int, default=8812)
+    args = parser.parse_args()
+
+    for count in [int(c) for c in args.counts.split(",")]:
+        with TemporaryDirectory() as temp_path:
+            project_path = os.path.join(temp_path, "project")
+            project = Project.create(project_path)
+            populate(project, count)
+            project.close()
+
+            before = measure(project_path, args.port, False, args.repeat)
+            after = measure(project_path, args.port, True, args.repeat)
+            print(f"{count:>8} publications: generic {median(before):7.3f}s, "
+                  f"fast {median(after):7.3f}s ({median(before) / median(after):5.1f}x)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,99 @@
+""" Compares listing refs with the former hex-encoded models against the current
+plain-text, slots-based ones: memory held by 100k refs, time to build them from
+database rows, time to read their fields and the size of their JSON encoding.
+
+    python3 scripts/bench_models.py [--count 100000]
+"""
+from pinhole.datasource.document import DocumentRef
+
+from pydantic.dataclasses import dataclass
+from pydantic import TypeAdapter
+
+from argparse import ArgumentParser
+from datetime import datetime
+from time import perf_counter
+from typing import Any, Callable, List, Tuple
+
+import gc
+import tracemalloc
+
+
+@dataclass
+class HexDocumentRef:
+    """ The representation used before the hex encoding was removed. """
+    id: int
+    _title: str
+    date: datetime
+    _url: str
+    _publisher: str
+
+    @property
+    def title(self) -> str:
+        return bytes.fromhex(self._title).decode('utf8')
+
+    @property
+    def url(self) -> str:
+        return bytes.fromhex(self._url).decode('utf8')
+
+    @property
+    def publisher(self) -> str:
+        return bytes.fromhex(self._publisher).decode('utf8')
+
+    @classmethod
+    def build(cls, id: int, title: str, date: datetime, url: str, publisher: str) -> 'HexDocumentRef':
+        _title = title.encode('utf8').hex()
+        _url = url.encode('utf8').hex()
+        _publisher = publisher.encode('utf8').hex()
+        return HexDocumentRef(id, _title, date, _url, _publisher)
+
+
+def make_rows(count: int) -> List[Tuple[Any, ...]]:
+    return [
+        (i, f"An article about topic number {i} in the kernel community", 1.7E9 + i,
+         f"https://lwn.net/Articles/{i}/", "LWN Kernel")
+        for i in range(count)
+    ]
+
+
+def measure(name: str, build: Callable[[], List[Any]], adapter: TypeAdapter) -> None:
+    gc.collect()
+    tracemalloc.start()
+    begin = perf_counter()
+    refs = build()
+    build_time = perf_counter() - begin
+    memory, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    begin = perf_counter()
+    for ref in refs:
+        (ref.title, ref.url, ref.publisher)
+    access_time = perf_counter() - begin
+
+    json_size = len(adapter.dump_json(refs))
+    print(f"{name:>8}: build {build_time:6.3f}s, memory {memory / 2 ** 20:7.1f}MiB, "
+          f"field access {access_time:6.3f}s, json {json_size / 2 ** 20:6.1f}MiB")
+
+
+def main() -> None:
+    parser = ArgumentParser("bench_models")
+    parser.add_argument("--count", type=int, default=100000)
+    args = parser.parse_args()
+
+    rows = make_rows(args.count)
+    print(f"listing {args.count} document refs")
+
+    measure("hex", lambda: [
+        HexDocumentRef.build(id, title, datetime.fromtimestamp(date), url, publisher)
+        for (id, title, date, url, publisher) in rows
+    ], TypeAdapter(List[HexDocumentRef]))
+
+    measure("plain", lambda: [
+        DocumentRef.build(id, title, datetime.fromtimestamp(date), url, publisher)
+        for (id, title, date, url, publisher) in rows
+    ], TypeAdapter(List[DocumentRef]))
+
+    measure("from_row", lambda: [DocumentRef.from_row(row) for row in rows], TypeAdapter(List[DocumentRef]))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,82 @@
+""" Compares the per-call latency of RemoteProject against the former client,
+which issued every request through the module-level `requests` functions and
+therefore opened a new connection each time. An apiserver is started on a
+temporary project for the duration of the benchmark.
+
+    python3 scripts/bench_remote_project.py [--calls 500] [--port 8811]
+"""
+from pinhole.datasource.document import Document
+from pinhole.project import RemoteProject
+
+from argparse import ArgumentParser
+from datetime import datetime
+from statistics import median, quantiles
+from tempfile import TemporaryDirectory
+from time import perf_counter, sleep
+from typing import Callable, List
+
+import os
+import requests
+import subprocess
+import sys
+
+
+def wait_until_ready(base_addr: str, timeout: float = 30.0) -> None:
+    deadline = perf_counter() + timeout
+    while perf_counter() < deadline:
+        try:
+            requests.get(f"{base_addr}/", timeout=1.0)
+            return
+        except requests.ConnectionError:
+            sleep(0.2)
+
+    raise Exception(f"apiserver at {base_addr} did not start in {timeout} seconds")
+
+
+def measure(name: str, calls: int, call: Callable[[], object]) -> None:
+    latencies: List[float] = []
+    for _ in range(calls):
+        begin = perf_counter()
+        call()
+        latencies.append((perf_counter() - begin) * 1000)
+
+    p99 = quantiles(latencies, n=100)[98]
+    print(f"{name:>24}: median {median(latencies):6.2f}ms, p99 {p99:6.2f}ms")
+
+
+def main() -> None:
+    parser = ArgumentParser("bench_remote_project")
+    parser.add_argument("--calls", type=int, default=500)
+    parser.add_argument("--port", type=int, default=8811)
+    args = parser.parse_args()
+
+    base_addr = f"http://127.0.0.1:{args.port}"
+    with TemporaryDirectory() as temp_path:
+        env = dict(os.environ, PINHOLE_PROJECT=os.path.join(temp_path, "project"))
+        server = subprocess.Popen(
+            [sys.executable, "-m", "uvicorn", "pinhole.servers.apiserver.main:app",
+             "--port", str(args.port), "--log-level", "warning"],
+            env=env
+        )
+
+        try:
+            wait_until_ready(base_addr)
+            project = RemoteProject(base_addr)
+            project.create_documents([
+                Document.build(f"document {i}", datetime.now(), f"https://example.com/{i}", "bench", "x" * 4096)
+                for i in range(100)
+            ])
+
+            measure("legacy get_document", args.calls,
+                    lambda: requests.get(f"{base_addr}/document/get?id=1").json())
+            measure("pooled get_document", args.calls, lambda: project.get_document(1))
+            measure("legacy list (limit 15)", args.calls,
+                    lambda: requests.get(f"{base_addr}/document/list?limit=15").json())
+            measure("pooled list (limit 15)", args.calls, lambda: project.get_document_refs(limit=15))
+        finally:
+            server.terminate()
+            server.wait()
+
+
+if __name__ == "__main__":
+    main()
@@ -9,13 +9,21 @@ install_requires = [
     "markdownify",
     "streamlit",
     "dateparser",
-    "fastapi", "fastapi-cli"
+    "fastapi", "uvicorn[standard]",
+    "requests", "urllib3>=2",
+    "httpx"
 ]
 
 extras_require = {
     "dev": [
         "mypy",
         "pycodestyle"
+    ],
+    "zstd": [
+        "zstandard"
+    ],
+    "orjson": [
+        "orjson"
     ]
 }
 
@@ -0,0 +1,87 @@
+from pinhole.models.base import ChatContext, Role
+from pinhole.models.batch import BatchClient
+from pinhole.models.openai import OpenaiChatModel
+
+from pathlib import Path
+from typing import Dict, Iterator
+
+import json
+import pytest
+import requests
+import socket
+import subprocess
+import sys
+import time
+
+
+SERVER = Path(__file__).resolve().parent.parent / "scripts" / "batch_server.py"
+
+
+@pytest.fixture(scope="module")
+def base_url() -> Iterator[str]:
+    """ The address of the batch stand-in, whose batches complete right away. """
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+
+    server = subprocess.Popen([sys.executable, str(SERVER), "--port", str(port), "--delay", "0"],
+                              stdout=subprocess.DEVNULL)
+    url = f"http://127.0.0.1:{port}/v1"
+    try:
+        for _ in range(100):
+            try:
+                requests.get(f"{url}/batches/none", timeout=1)
+                break
+            except requests.ConnectionError:
+                time.sleep(0.05)
+
+        yield url
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def contexts(model: OpenaiChatModel, n: int) -> Dict[str, ChatContext]:
+    return {
+        f"document-{i}": ChatContext(model, history=[(Role.USER, f"summarize\n\ndocument {i} 内容")])
+        for i in range(n)
+    }
+
+
+def test_round_trip(base_url: str, tmp_path: Path) -> None:
+    model = OpenaiChatModel(api_key="test", base_url=base_url)
+    state_path = str(tmp_path / "batches" / "documents.json")
+    client = BatchClient(model, state_path)
+
+    batch_ids = client.submit(contexts(model, 7), max_requests=3)
+    assert len(batch_ids) == 3
+    assert client.pending() == set(contexts(model, 7))
+
+    # a later run picks up the batches from the state file
+    answers: Dict[str, str] = {}
+    client = BatchClient(model, state_path)
+    assert client.wait(lambda custom_id, answer: answers.__setitem__(custom_id, answer), 5, interval=0.05) == 0
+
+    assert answers == {f"document-{i}": f"stand-in summary of document {i} 内容" for i in range(7)}
+    assert client.pending() == set()
+    with open(state_path) as f:
+        assert json.load(f) == {"batches": []}
+
+
+def test_batches_are_split_by_size(base_url: str, tmp_path: Path) -> None:
+    model = OpenaiChatModel(api_key="test", base_url=base_url)
+    client = BatchClient(model, str(tmp_path / "documents.json"))
+
+    batch = contexts(model, 6)
+    line_sizes = [len(json.dumps(model.batch_request(custom_id, context), ensure_ascii=False).encode('utf8')) + 1
+                  for custom_id, context in batch.items()]
+    batch_ids = client.submit(batch, max_bytes=max(line_sizes) * 2)
+    assert len(batch_ids) == 3
+
+    inputs = sorted(tmp_path.glob("*.jsonl"))
+    assert [len(path.read_bytes().splitlines()) for path in inputs] == [2, 2, 2]
+    assert all(path.stat().st_size <= max(line_sizes) * 2 for path in inputs)
+
+    answers: Dict[str, str] = {}
+    assert client.wait(lambda custom_id, answer: answers.__setitem__(custom_id, answer), 5, interval=0.05) == 0
+    assert set(answers) == set(batch)
@@ -0,0 +1,203 @@
+from pinhole.models.base import ChatContext, ChatModel, Role
+from pinhole.models.cache import CachedCompletion, SqliteResponseCache
+from pinhole.servers.apiserver.cache import ENTRY_OVERHEAD, ResponseCache
+
+from fastapi import Response
+
+from dataclasses import dataclass
+from pathlib import Path
+from time import sleep
+from typing import Awaitable, Callable, Generator, List
+
+import asyncio
+import pytest
+
+
+def builder(body: bytes, calls: List[bytes], status_code: int = 200) -> Callable[[], Awaitable[Response]]:
+    async def build() -> Response:
+        calls.append(body)
+        return Response(body, status_code=status_code, media_type="application/json")
+
+    return build
+
+
+def test_entries_are_tagged() -> None:
+    async def main() -> None:
+        cache = ResponseCache(1 << 20)
+        calls: List[bytes] = []
+
+        assert (await cache.get("/documents", "v1", builder(b"1", calls))).body == b"1"
+        assert (await cache.get("/documents", "v1", builder(b"2", calls))).body == b"1"
+        # a new version of the data replaces the entry
+        assert (await cache.get("/documents", "v2", builder(b"3", calls))).body == b"3"
+        assert (await cache.get("/documents", "v2", builder(b"4", calls))).body == b"3"
+
+        assert calls == [b"1", b"3"]
+        assert cache.stats()["hits"] == 2 and cache.stats()["entries"] == 1
+
+    asyncio.run(main())
+
+
+def test_errors_are_not_kept() -> None:
+    async def main() -> None:
+        cache = ResponseCache(1 << 20)
+        calls: List[bytes] = []
+
+        await cache.get("/documents", "v1", builder(b"error", calls, status_code=500))
+        await cache.get("/documents", "v1", builder(b"ok", calls))
+        assert calls == [b"error", b"ok"]
+
+    asyncio.run(main())
+
+
+def test_concurrent_misses_build_once() -> None:
+    async def main() -> None:
+        cache = ResponseCache(1 << 20)
+        release = asyncio.Event()
+        nbuilds = 0
+
+        async def build() -> Response:
+            nonlocal nbuilds
+            nbuilds += 1
+            await release.wait()
+            return Response(b"listing")
+
+        lookups = [asyncio.ensure_future(cache.get("/documents", "v1", build)) for _ in range(5)]
+        await asyncio.sleep(0)
+        release.set()
+
+        assert [response.body for response in await asyncio.gather(*lookups)] == [b"listing"] * 5
+        assert nbuilds == 1
+        assert cache.stats()["misses"] == 1 and cache.stats()["coalesced"] == 4
+
+    asyncio.run(main())
+
+
+def test_concurrent_misses_share_the_error() -> None:
+    async def main() -> None:
+        cache = ResponseCache(1 << 20)
+        release = asyncio.Event()
+
+        async def build() -> Response:
+            await release.wait()
+            raise RuntimeError("database locked")
+
+        lookups = [asyncio.ensure_future(cache.get("/documents", "v1", build)) for _ in range(3)]
+        await asyncio.sleep(0)
+        release.set()
+
+        results = await asyncio.gather(*lookups, return_exceptions=True)
+        assert all(isinstance(result, RuntimeError) for result in results)
+
+        # the failed flight is not waited for anymore
+        calls: List[bytes] = []
+        assert (await cache.get("/documents", "v1", builder(b"ok", calls))).body == b"ok"
+
+    asyncio.run(main())
+
+
+def test_least_recently_used_entries_are_evicted() -> None:
+    async def main() -> None:
+        entry_size = 100 + ENTRY_OVERHEAD
+        cache = ResponseCache(entry_size * 4)
+        calls: List[bytes] = []
+
+        for key in "abc":
+            await cache.get(key, "v1", builder(bytes(100), calls))
+        await cache.get("a", "v1", builder(bytes(100), calls))
+        await cache.get("d", "v1", builder(bytes(100), calls))
+        assert cache.stats()["evictions"] == 0
+
+        await cache.get("e", "v1", builder(bytes(100), calls))
+        assert cache.stats()["evictions"] == 1
+
+        # b was used the least recently
+        calls.clear()
+        for key in "acdeb":
+            await cache.get(key, "v1", builder(bytes(100), calls))
+        assert len(calls) == 1
+
+        # responses taking more than a quarter of the cache are not kept
+        calls.clear()
+        for _ in range(2):
+            await cache.get("large", "v1", builder(bytes(entry_size), calls))
+        assert len(calls) == 2
+
+    asyncio.run(main())
+
+
+def test_sqlite_cache_round_trip(tmp_path: Path) -> None:
+    cache = SqliteResponseCache(str(tmp_path / "cache" / "completions.sqlite"))
+    assert cache.get("key") is None
+
+    cache.put("key", CachedCompletion("答案", 10, 2))
+    assert cache.get("key") == CachedCompletion("答案", 10, 2)
+
+    cache.put("key", CachedCompletion("another answer", 10, 3))
+    assert cache.get("key") == CachedCompletion("another answer", 10, 3)
+    cache.close()
+
+
+def test_sqlite_cache_expires(tmp_path: Path) -> None:
+    cache = SqliteResponseCache(str(tmp_path / "completions.sqlite"), max_age=0.1)
+    cache.put("key", CachedCompletion("answer", 10, 2))
+    assert cache.get("key") is not None
+
+    sleep(0.2)
+    assert cache.get("key") is None
+    cache.close()
+
+
+def test_sqlite_cache_evicts_least_recently_used(tmp_path: Path) -> None:
+    cache = SqliteResponseCache(str(tmp_path / "completions.sqlite"), max_size=25)
+    for key in ["a", "b", "c"]:
+        cache.put(key, CachedCompletion("0123456789", 10, 2))
+        sleep(0.01)
+
+    cache.get("a")
+    cache.evict()
+
+    assert cache.get("a") is not None
+    assert cache.get("b") is None
+    assert cache.get("c") is not None
+    cache.close()
+
+
+@dataclass(eq=False)
+class StreamingModel(ChatModel):
+    finish_reason: str = "stop"
+
+    def pretty_name(self) -> str:
+        return "streaming"
+
+    def chat_stream(self, context: ChatContext) -> Generator[str, None, None]:
+        yield "an "
+        yield "answer"
+        self.notify_finish(self.finish_reason)
+
+
+@pytest.mark.parametrize("finish_reason, cached", [("stop", True), ("length", False)])
+def test_streams_are_cached_when_complete(tmp_path: Path, finish_reason: str, cached: bool) -> None:
+    model = StreamingModel(finish_reason)
+    model.cache = SqliteResponseCache(str(tmp_path / "completions.sqlite"))
+    context = ChatContext(model, history=[(Role.USER, "question")])
+
+    assert "".join(model.complete_stream(context)) == "an answer"
+    assert (model.cache.get(model.cache_key(context)) is not None) == cached
+
+
+def test_closed_streams_are_not_cached(tmp_path: Path) -> None:
+    model = StreamingModel()
+    model.cache = SqliteResponseCache(str(tmp_path / "completions.sqlite"))
+    context = ChatContext(model, history=[(Role.USER, "question")])
+
+    stream = model.complete_stream(context)
+    assert next(stream) == "an "
+    stream.close()
+    assert model.cache.get(model.cache_key(context)) is None
+
+    # answered from the cache once complete
+    assert "".join(model.complete_stream(context)) == "an answer"
+    assert not context.cached
+    assert "".join(model.complete_stream(context)) == "an answer"
+    assert context.cached
@@ -0,0 +1,89 @@
+from pinhole.models.base import ChatContext, ChatModel
+from pinhole.models.hedging import EXPECTED_OUTPUT_TOKENS, HedgeBudget, Hedging, LatencyTracker
+from pinhole.models.profiler import Currency
+
+from dataclasses import dataclass
+from time import sleep
+from typing import Tuple
+
+import pytest
+
+
+@dataclass(eq=False)
+class DelayedModel(ChatModel):
+    name: str = ""
+    delay: float = 0.0
+
+    def pretty_name(self) -> str:
+        return self.name
+
+    def chat(self, context: ChatContext) -> str:
+        sleep(self.delay)
+        return f"answer of {self.name}"
+
+    def price(self) -> Tuple[float, float, Currency]:
+        return (1E6, 1E6, Currency.USD)
+
+    def __hash__(self) -> int:
+        return id(self)
+
+
+def hedging(budget: float) -> Tuple[Hedging, DelayedModel, DelayedModel]:
+    slow = DelayedModel("slow", 0.5)
+    fast = DelayedModel("fast", 0.0)
+    hedger = Hedging([slow, fast], HedgeBudget({Currency.USD: budget}))
+    for _ in range(20):
+        hedger.latencies[slow].observe(0.05)
+    return hedger, slow, fast
+
+
+def test_latency_percentile() -> None:
+    tracker = LatencyTracker(window=100, min_samples=10)
+    for i in range(9):
+        tracker.observe(i)
+    assert tracker.percentile(0.95) is None
+
+    for i in range(9, 200):
+        tracker.observe(i)
+    # only the latest requests count
+    assert tracker.percentile(0.0) == 100
+    assert tracker.percentile(0.95) == 195
+
+
+def test_no_hedge_below_the_percentile() -> None:
+    hedger, slow, _ = hedging(budget=1E6)
+    slow.delay = 0.0
+
+    context, answer = hedger.chat(ChatContext(slow), "question")
+    assert answer == "answer of slow" and context.model is slow
+    assert hedger.budget.spent == {}
+
+
+def test_hedge_wins_and_is_settled() -> None:
+    hedger, slow, fast = hedging(budget=1E6)
+
+    context, answer = hedger.chat(ChatContext(slow), "question")
+    assert answer == "answer of fast" and context.model is fast
+
+    # the reservation for the expected answer is replaced by the actual cost
+    spent = hedger.budget.spent[Currency.USD]
+    assert 0 < spent < EXPECTED_OUTPUT_TOKENS
+
+
+def test_spent_budget_stops_hedging() -> None:
+    hedger, slow, _ = hedging(budget=EXPECTED_OUTPUT_TOKENS / 2)
+
+    context, answer = hedger.chat(ChatContext(slow), "question")
+    assert answer == "answer of slow" and context.model is slow
+    assert hedger.budget.spent.get(Currency.USD, 0) == 0
+
+
+def test_budget_reservations() -> None:
+    budget = HedgeBudget({Currency.USD: 1.0})
+    assert budget.reserve(Currency.USD, 0.6)
+    assert not budget.reserve(Currency.USD, 0.6)
+    assert not budget.reserve(Currency.CNY, 0.1)
+
+    budget.settle(Currency.USD, 0.6, 0.2)
+    assert budget.spent[Currency.USD] == pytest.approx(0.2)
+    assert budget.reserve(Currency.USD, 0.6)
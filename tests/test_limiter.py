@@ -0,0 +1,170 @@
+from pinhole.models.limiter import AdaptiveConcurrency, Limits, RateLimited, RateLimiter, TokenBucket, \
+    TransientError, parse_retry_after
+
+from math import inf
+from threading import Thread
+from typing import List
+
+import pinhole.models.limiter as limiter
+import pytest
+
+
+@pytest.fixture
+def sleeps(monkeypatch: pytest.MonkeyPatch) -> List[float]:
+    """ The delays the limiters sleep, which are skipped. """
+    delays: List[float] = []
+    monkeypatch.setattr(limiter, "sleep", delays.append)
+    return delays
+
+
+def test_token_bucket_bursts_up_to_capacity() -> None:
+    bucket = TokenBucket(60, capacity=2)
+    assert bucket.reserve(1) == 0
+    assert bucket.reserve(1) == 0
+    # one unit per second
+    assert bucket.reserve(1) == pytest.approx(1, abs=0.05)
+
+
+def test_token_bucket_large_request_is_paid_back() -> None:
+    bucket = TokenBucket(60, capacity=2)
+    # a request larger than the capacity waits for the capacity only
+    assert bucket.reserve(5) == 0
+    assert bucket.available() == pytest.approx(-3, abs=0.05)
+    assert bucket.reserve(1) == pytest.approx(4, abs=0.05)
+
+
+def test_token_bucket_adjust() -> None:
+    bucket = TokenBucket(60, capacity=10)
+    bucket.reserve(8)
+    bucket.adjust(-5)
+    assert bucket.available() == pytest.approx(7, abs=0.05)
+    # giving back never exceeds the capacity
+    bucket.adjust(-100)
+    assert bucket.available() == pytest.approx(10)
+
+
+def test_token_bucket_unlimited() -> None:
+    bucket = TokenBucket(inf)
+    assert bucket.reserve(1E9) == 0
+    assert bucket.available() == inf
+
+
+def test_concurrency_aimd() -> None:
+    concurrency = AdaptiveConcurrency(8)
+    concurrency.throttled()
+    assert concurrency.limit == 4
+    for _ in range(10):
+        concurrency.throttled()
+    assert concurrency.limit == concurrency.minimum == 1
+
+    # about one more per round of successful requests
+    for _ in range(4):
+        concurrency.succeeded(1.0, 0, 100)
+    assert 2 <= concurrency.limit < 4
+
+
+def test_concurrency_shrinks_on_slow_responses() -> None:
+    concurrency = AdaptiveConcurrency(8)
+    concurrency.succeeded(1.0, 0, 100)
+    assert concurrency.limit == 8
+
+    concurrency.succeeded(10.0, 0, 100)
+    assert concurrency.limit == pytest.approx(7.2)
+
+
+def test_concurrency_blocks_at_limit() -> None:
+    concurrency = AdaptiveConcurrency(1)
+    concurrency.acquire()
+    assert concurrency.spare() == 0
+
+    acquired: List[bool] = []
+
+    def acquire() -> None:
+        concurrency.acquire()
+        acquired.append(True)
+
+    waiter = Thread(target=acquire)
+    waiter.start()
+    waiter.join(0.1)
+    assert acquired == []
+
+    concurrency.release()
+    waiter.join(1)
+    assert acquired == [True]
+
+
+def test_parse_retry_after() -> None:
+    assert parse_retry_after(None) is None
+    assert parse_retry_after("3") == 3
+    assert parse_retry_after("-1") == 0
+    assert parse_retry_after("Wed, 21 Oct 2015 07:28:00 GMT") == 0
+    assert parse_retry_after("soon") is None
+
+
+def test_call_retries_transient_errors(sleeps: List[float]) -> None:
+    rate_limiter = RateLimiter("test", Limits(max_retries=2))
+    attempts: List[float] = []
+
+    def send(timeout: float) -> str:
+        attempts.append(timeout)
+        if len(attempts) < 3:
+            raise TransientError("timed out")
+        return "answer"
+
+    assert rate_limiter.call(send, 10, lambda _: (10, 10)) == "answer"
+    assert attempts == [300, 300, 300]
+    assert len(sleeps) == 2
+    assert rate_limiter.concurrency.inflight == 0
+
+
+def test_call_gives_up(sleeps: List[float]) -> None:
+    rate_limiter = RateLimiter("test", Limits(max_retries=1))
+
+    def send(timeout: float) -> str:
+        raise TransientError("server error")
+
+    with pytest.raises(Exception, match="after 2 attempts"):
+        rate_limiter.call(send, 10, lambda _: (10, 10))
+    assert rate_limiter.concurrency.inflight == 0
+
+
+def test_rate_limited_pauses_every_request(sleeps: List[float]) -> None:
+    rate_limiter = RateLimiter("test", Limits(max_concurrency=4))
+    attempts: List[float] = []
+
+    def send(timeout: float) -> str:
+        attempts.append(timeout)
+        if len(attempts) == 1:
+            raise RateLimited("too many requests", retry_after=30)
+        return "answer"
+
+    assert rate_limiter.call(send, 10, lambda _: (10, 10)) == "answer"
+    # halved from 4, then grown a little by the success
+    assert 2 <= rate_limiter.concurrency.limit < 3
+    # the retry waited for the pause, and so would any other request
+    assert sleeps and sleeps[-1] == pytest.approx(30, abs=1)
+    assert not rate_limiter.has_capacity()
+
+
+def test_other_errors_are_not_retried(sleeps: List[float]) -> None:
+    rate_limiter = RateLimiter("test", Limits())
+
+    def send(timeout: float) -> str:
+        raise ValueError("bad request")
+
+    with pytest.raises(ValueError):
+        rate_limiter.call(send, 10, lambda _: (10, 10))
+    assert rate_limiter.concurrency.inflight == 0
+
+
+def test_lease_holds_the_slot_until_closed() -> None:
+    rate_limiter = RateLimiter("test", Limits(tokens_per_minute=600))
+    stream, lease = rate_limiter.open(lambda timeout: "stream", 10)
+    assert stream == "stream"
+    assert rate_limiter.concurrency.inflight == 1
+
+    lease.close(100, 50)
+    lease.close(100, 50)
+    assert rate_limiter.concurrency.inflight == 0
+    # the estimate of 10 tokens was corrected to the 150 used
+    assert rate_limiter.tokens.available() == pytest.approx(100 - 150, abs=0.5)
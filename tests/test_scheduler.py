@@ -0,0 +1,168 @@
+from pinhole.models.base import ChatModel
+from pinhole.models.scheduler import Scheduler, Status, Task, TaskAbandoned
+
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from threading import Event, Lock
+from time import sleep
+from typing import Any, Callable, Dict, List
+
+import pytest
+
+
+@dataclass(eq=False)
+class ModelA(ChatModel):
+    concurrency: int = 1
+
+    def pretty_name(self) -> str:
+        return type(self).__name__
+
+    @property
+    def max_concurrency(self) -> int:
+        return self.concurrency
+
+
+@dataclass(eq=False)
+class ModelB(ModelA):
+    pass
+
+
+@dataclass(eq=False)
+class ModelC(ModelA):
+    pass
+
+
+NOW = datetime.now()
+
+
+def task(name: str, run: Callable[[ChatModel], str], age: int = 0, **kwargs: Any) -> Task[str]:
+    return Task(name, run, NOW - timedelta(days=age), **kwargs)
+
+
+def test_newest_tasks_first() -> None:
+    order: List[str] = []
+
+    def run(name: str) -> Callable[[ChatModel], str]:
+        def run(model: ChatModel) -> str:
+            order.append(name)
+            return name
+        return run
+
+    tasks = [task("old", run("old"), age=3), task("new", run("new"), age=1), task("mid", run("mid"), age=2)]
+    outcomes = list(Scheduler([ModelA()]).run(tasks))
+
+    assert order == ["new", "mid", "old"]
+    assert [outcome.result for outcome in outcomes] == order
+    assert all(outcome.status is Status.DONE for outcome in outcomes)
+
+
+def test_publisher_weights() -> None:
+    order: List[str] = []
+
+    def run(name: str) -> Callable[[ChatModel], str]:
+        def run(model: ChatModel) -> str:
+            order.append(name)
+            return name
+        return run
+
+    tasks = [task("blog", run("blog"), age=2, publisher="blog"), task("paper", run("paper"), age=3, publisher="paper")]
+    list(Scheduler([ModelA()], weights={"paper": 2}).run(tasks))
+    assert order == ["paper", "blog"]
+
+    with pytest.raises(ValueError):
+        Scheduler([ModelA()], weights={"paper": 0})
+
+
+def test_failed_models_fall_back() -> None:
+    a, b = ModelA(), ModelB()
+
+    def run(model: ChatModel) -> str:
+        if model is a:
+            raise Exception("unavailable")
+        return "answer"
+
+    def abandon(model: ChatModel) -> str:
+        raise TaskAbandoned("no content")
+
+    outcomes = {outcome.task.name: outcome for outcome in Scheduler([a, b]).run([
+        task("fallback", run),
+        task("only-a", run, models=[a]),
+        task("abandoned", abandon),
+    ])}
+
+    assert outcomes["fallback"].status is Status.DONE and outcomes["fallback"].model is b
+    assert outcomes["only-a"].status is Status.FAILED
+    assert outcomes["abandoned"].status is Status.FAILED
+
+
+def test_unscheduled_backend() -> None:
+    with pytest.raises(ValueError):
+        list(Scheduler([ModelA()]).run([task("task", lambda model: "", models=[ModelB()])]))
+
+
+def test_deadline_expires_waiting_tasks() -> None:
+    def run(model: ChatModel) -> str:
+        sleep(0.2)
+        return "answer"
+
+    tasks = [task(str(i), run, age=i) for i in range(10)]
+    outcomes = list(Scheduler([ModelA()], deadline=0.3).run(tasks))
+
+    statuses = [outcome.status for outcome in outcomes]
+    assert len(outcomes) == 10
+    # the tasks in flight at the deadline finish
+    assert 1 <= statuses.count(Status.DONE) <= 3
+    assert statuses.count(Status.EXPIRED) == 10 - statuses.count(Status.DONE)
+
+
+def test_routed_tasks_go_to_idle_backends() -> None:
+    a, b = ModelA(), ModelB()
+    release = Event()
+    nroutes = 0
+    lock = Lock()
+
+    def block(model: ChatModel) -> str:
+        release.wait(5)
+        return "blocked"
+
+    def route() -> List[ChatModel]:
+        nonlocal nroutes
+        with lock:
+            nroutes += 1
+        return [a, b]
+
+    def run(model: ChatModel) -> str:
+        return model.pretty_name()
+
+    tasks = [task("block", block, models=[a])] + [task(f"routed {i}", run, age=1, route=route) for i in range(3)]
+    results: Dict[str, Any] = {}
+    for outcome in Scheduler([a, b]).run(tasks):
+        results[outcome.task.name] = outcome.result
+        if len(results) == 3:
+            # every routed task ran on B while A was busy
+            assert results == {f"routed {i}": "ModelB" for i in range(3)}
+            release.set()
+
+    assert results["block"] == "blocked"
+    # routed once each, when they were about to run
+    assert nroutes == 3
+
+
+def test_routed_tasks_are_ranked_again_on_failure() -> None:
+    a, b, c = ModelA(), ModelB(), ModelC()
+    # only A at first, so that it is the one tried
+    ranks: List[List[ChatModel]] = [[a], [c, b]]
+
+    def route() -> List[ChatModel]:
+        return ranks.pop(0)
+
+    def run(model: ChatModel) -> str:
+        if model is a:
+            raise Exception("unavailable")
+        return model.pretty_name()
+
+    outcomes = list(Scheduler([a, b, c]).run([task("routed", run, route=route)]))
+
+    # A was tried and the second ranking put C first
+    assert outcomes[0].status is Status.DONE and outcomes[0].model is c
+    assert ranks == []
@@ -0,0 +1,159 @@
+from pinhole.datasource.document import Document
+from pinhole.datasource.summary import Summary
+from pinhole.project import Project
+from pinhole.storage.bloom import BloomFilter
+from pinhole.storage.schema import MIGRATIONS, migrate
+
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import Iterator, List
+
+import pytest
+import sqlite3
+
+
+EPOCH = datetime(2024, 1, 1)
+
+
+def document(i: int, content: str = "", day: int = 0) -> Document:
+    return Document(f"title {i}", EPOCH + timedelta(days=day), f"https://example.com/{i}", "example", content)
+
+
+@pytest.fixture
+def project(tmp_path: Path) -> Iterator[Project]:
+    project = Project.create(str(tmp_path))
+    yield project
+    project.close()
+
+
+def check_search_indexes(path: str) -> None:
+    """ Raises if an index differs from the content it was built from. """
+    dbconn = sqlite3.connect(path)
+    for table in ["documents", "publications"]:
+        dbconn.execute(f"INSERT INTO {table}_search ({table}_search, rank) VALUES ('integrity-check', 1)")
+    dbconn.close()
+
+
+def matches(path: str, query: str) -> List[int]:
+    dbconn = sqlite3.connect(path)
+    rows = dbconn.execute("SELECT rowid FROM documents_search WHERE documents_search MATCH ? ORDER BY rowid",
+                          (query,)).fetchall()
+    dbconn.close()
+    return [rowid for (rowid,) in rows]
+
+
+def test_migrations_upgrade_existing_data(tmp_path: Path) -> None:
+    path = str(tmp_path / "db.sqlite")
+    dbconn = sqlite3.connect(path, isolation_level=None)
+    for sql in MIGRATIONS[0] + MIGRATIONS[1]:
+        dbconn.execute(sql)
+    dbconn.execute("PRAGMA user_version = 2")
+    dbconn.execute("INSERT INTO documents (title, date, url, content) VALUES ('kernel', 0, 'u1', 'exploit chain')")
+    dbconn.execute("INSERT INTO summaries (document_id, model, content) VALUES (1, 'm', 'sandbox escape')")
+
+    migrate(dbconn)
+    migrate(dbconn)
+    assert dbconn.execute("PRAGMA user_version").fetchone() == (len(MIGRATIONS),)
+    assert dbconn.execute("SELECT version FROM table_versions WHERE name = 'documents'").fetchone() == (0,)
+    dbconn.close()
+
+    check_search_indexes(path)
+    # the rows and summaries stored before are indexed
+    assert matches(path, "exploit") == [1]
+    assert matches(path, "sandbox") == [1]
+
+
+def test_newer_schema_is_refused(tmp_path: Path) -> None:
+    dbconn = sqlite3.connect(str(tmp_path / "db.sqlite"), isolation_level=None)
+    dbconn.execute(f"PRAGMA user_version = {len(MIGRATIONS) + 1}")
+    with pytest.raises(Exception, match="newer than supported"):
+        migrate(dbconn)
+
+
+def test_search_triggers(project: Project) -> None:
+    path = project.database_realpath
+    project.create_documents([document(1, "heap overflow"), document(2, "race condition")])
+    project.create_summary(Summary(1, -1, "m", "use after free"))
+    check_search_indexes(path)
+    assert matches(path, "overflow") == [1]
+    assert matches(path, "free") == [1]
+
+    dbconn = sqlite3.connect(path, isolation_level=None)
+    dbconn.execute("UPDATE documents SET content = 'integer overflow' WHERE id = 2")
+    dbconn.execute("UPDATE summaries SET content = 'double fetch' WHERE document_id = 1")
+    dbconn.close()
+    check_search_indexes(path)
+    assert matches(path, "overflow") == [1, 2]
+    assert matches(path, "race") == []
+    assert matches(path, "free") == []
+    assert matches(path, "fetch") == [1]
+
+    dbconn = sqlite3.connect(path, isolation_level=None)
+    dbconn.execute("DELETE FROM summaries WHERE document_id = 1")
+    dbconn.execute("DELETE FROM documents WHERE id = 2")
+    dbconn.close()
+    check_search_indexes(path)
+    assert matches(path, "overflow") == [1]
+    assert matches(path, "fetch") == []
+
+
+def test_search_pages(project: Project) -> None:
+    project.create_documents([document(i, f"fuzzing report {i}", day=i) for i in range(30)])
+
+    pages = [project.search("fuzz", limit=10, offset=offset, kind='document') for offset in range(0, 40, 10)]
+    assert [len(page) for page in pages] == [10, 10, 10, 0]
+    assert len({hit.id for page in pages for hit in page}) == 30
+    # the newer of equally relevant documents come first
+    assert pages[0][0].title == "title 29"
+
+    assert project.search("fuzz", kind='publication') == []
+    assert project.search("  ") == []
+
+
+def test_create_documents_skips_known_urls(project: Project) -> None:
+    assert project.create_documents([document(1), document(2)]) == [1, 2]
+    ids = project.create_documents([document(2), document(3), document(3)])
+    assert ids[0] == -1 and ids[1] > 0 and ids[2] == -1
+
+    assert project.exists(["https://example.com/3", "https://example.com/4"]) == [True, False]
+
+
+def test_ref_cursors(project: Project) -> None:
+    # pairs of documents on the same day, told apart by their id
+    project.create_documents([document(i, day=i // 2) for i in range(9)])
+    refs = project.get_document_refs()
+    expected = [dref.id for dref in refs]
+    assert len(expected) == 9
+
+    older: List[int] = []
+    page = project.get_document_refs(4)
+    while page:
+        older.extend(dref.id for dref in page)
+        page = project.get_document_refs(4, before=(page[-1].date, page[-1].id))
+    assert older == expected
+
+    # paging back towards the newest keeps the order from the newest
+    last = project.get_document_refs(3, before=(refs[5].date, refs[5].id))
+    assert [dref.id for dref in last] == expected[6:9]
+    newer = project.get_document_refs(3, after=(last[0].date, last[0].id))
+    assert [dref.id for dref in newer] == expected[3:6]
+
+    assert [dref.id for dref in project.iter_document_refs(batch_size=2)] == expected
+
+
+def test_bloom_filter() -> None:
+    urls = [f"https://example.com/{i}" for i in range(1000)]
+    bloom = BloomFilter(len(urls), error_rate=0.01)
+    bloom.update(urls)
+    assert all(url in bloom for url in urls)
+
+    false_positives = sum(f"https://example.org/{i}" in bloom for i in range(10000))
+    assert false_positives < 300
+
+    loaded = BloomFilter.from_json(bloom.to_json())
+    assert all(url in loaded for url in urls)
+
+    data = bloom.to_json()
+    data["nbits"] += 64
+    with pytest.raises(ValueError):
+        BloomFilter.from_json(data)